@@ -0,0 +1,409 @@
+"""
+headless_factory の性能ベンチマーク集。
+
+    python benchmarks.py formatter [--mb 8]
+    python benchmarks.py facts [--episodes 50]
+    python benchmarks.py prompts [--episodes 50]
+    python benchmarks.py dbloop [--episodes 50]
+
+API呼び出しは行わない（ローカル処理のみ計測）。
+"""
+import os
+import re
+import sys
+import shutil
+import asyncio
+import tempfile
+import json
+import time
+import random
+import sqlite3
+import argparse
+
+from headless_factory import (
+    TextFormatter, FactStore, PromptManager, CharacterRegistry, FATAL_FLAWS_GUIDELINES,
+    DatabaseManager, NovelRepository,
+)
+
+
+# ==========================================
+# Corpus
+# ==========================================
+NOISE_HEADS = ["はい、承知しました。以下が本文です。\n", "Here is the story:\n", "**第1話**\n", ""]
+NOISE_TAILS = ["\n以上です。", "\nいかがでしたか？", "\nEnd of episode.", ""]
+NOISE_INLINE = ["…", "...", "..", "！", "？", "！？", "\n\n\n\n", "  \n", "\r\n", "」", "　"]
+NOISE_MARKDOWN = ["**", "##", "```json\n{}\n```"]
+
+
+def build_corpus(target_mb: float, seed: int = 42):
+    """style_samples.json の本文を素材に、AI出力特有のノイズを混ぜた日本語コーパスを生成する"""
+    rng = random.Random(seed)
+    with open("style_samples.json", encoding="utf-8") as f:
+        samples = [s["text"] for s in json.load(f)["samples"]]
+
+    docs, size = [], 0
+    target = int(target_mb * 1024 * 1024)
+    while size < target:
+        paragraphs = rng.sample(samples, k=min(4, len(samples)))
+        body = []
+        for p in paragraphs:
+            chars = list(p)
+            for _ in range(rng.randint(2, 12)):
+                chars.insert(rng.randrange(len(chars) + 1), rng.choice(NOISE_INLINE))
+            if rng.random() < 0.1: # Markdown混入は実出力でも一部の話のみ
+                chars.insert(rng.randrange(len(chars) + 1), rng.choice(NOISE_MARKDOWN))
+            body.append("".join(chars))
+        doc = rng.choice(NOISE_HEADS) + "\n".join(body) + rng.choice(NOISE_TAILS)
+        docs.append(doc)
+        size += len(doc.encode("utf-8"))
+    return docs
+
+
+# ==========================================
+# Reference (旧実装: 逐次パス)
+# ==========================================
+def legacy_format(text):
+    if not text: return ""
+    text = re.sub(r'^(はい|承知|了解|以下|これ|Here|Sure|Certainly|Okay).*?(\n|$)', '', text, flags=re.IGNORECASE | re.MULTILINE).strip()
+    text = re.sub(r'^\*\*.*?\*\*\n', '', text).strip()
+    text = re.sub(r'(\n|^)(以上|End|Hope|Do you|いかが|書き終).*?$', '', text, flags=re.IGNORECASE | re.MULTILINE).strip()
+    text = re.sub(r'…{1,}', '……', text)
+    text = re.sub(r'\.{2,}', '……', text)
+    text = text.replace('………', '……')
+    text = re.sub(r'([！？])(?![\s　」』])', r'\1　', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    lines = [line.rstrip() for line in text.splitlines()]
+    text = "\n".join(lines)
+    text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
+    text = text.replace('**', '').replace('##', '')
+    formatted_lines = []
+    narrative_count = 0
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if not stripped:
+            formatted_lines.append(line)
+            narrative_count = 0
+            continue
+        if not stripped.startswith(('「', '『', '（')):
+            narrative_count += 1
+        else:
+            narrative_count = 0
+        if narrative_count >= 3:
+            formatted_lines.append('')
+            narrative_count = 1
+        formatted_lines.append(line)
+    return "\n".join(formatted_lines).strip()
+
+
+def fuzz_equivalence(formatter, rounds=20000, seed=7):
+    """ノイズ記号を高密度に含む短文で旧実装との出力一致を確認する"""
+    rng = random.Random(seed)
+    alphabet = ["あ", "「", "」", "『", "（", "…", ".", "！", "？", "*", "#", "`", "\n", "\r", " ", "　", "\t", "以上", "はい", "End", "\x0b", " "]
+    for _ in range(rounds):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 60)))
+        expected = legacy_format(text)
+        actual = formatter.format_text(text)
+        if expected != actual:
+            raise AssertionError(f"Mismatch for {text!r}:\n legacy={expected!r}\n new   ={actual!r}")
+    return rounds
+
+
+def bench_formatter(args):
+    formatter = TextFormatter(None)
+    docs = build_corpus(args.mb)
+    total_mb = sum(len(d.encode("utf-8")) for d in docs) / 1024 / 1024
+    print(f"Corpus: {len(docs)} docs, {total_mb:.1f} MB")
+
+    t0 = time.perf_counter()
+    legacy_out = [legacy_format(d) for d in docs]
+    t_legacy = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    new_out = formatter.format_many(docs)
+    t_new = time.perf_counter() - t0
+
+    mismatches = sum(1 for a, b in zip(legacy_out, new_out) if a != b)
+    fuzzed = fuzz_equivalence(formatter)
+
+    print(f"legacy (sequential passes): {t_legacy:.3f}s  ({total_mb / t_legacy:.1f} MB/s)")
+    print(f"engine (format_many)      : {t_new:.3f}s  ({total_mb / t_new:.1f} MB/s)")
+    print(f"speedup: x{t_legacy / t_new:.2f}")
+    print(f"corpus mismatches: {mismatches}, fuzz cases identical: {fuzzed}")
+    if mismatches:
+        sys.exit(1)
+
+
+# ==========================================
+# Fact Store (REVEALED FACTS の肥大化)
+# ==========================================
+FACT_NAMES = ["アリシア", "レオンハルト", "ミレーユ", "黒騎士ヴァルド", "老魔導士ゼノ", "ギルド長バルガス", "聖女セシリア", "密偵クロウ"]
+FACT_ITEMS = ["銀の鍵", "古代の魔導書", "王家の紋章", "封印の剣", "禁書庫の地図", "赤い宝珠", "竜の逆鱗", "契約の指輪"]
+FACT_PLACES = ["井戸の底", "王城の地下牢", "北の大森林", "廃教会の祭壇", "ギルドの金庫", "時計塔の最上階", "港町の酒場", "魔王城の玉座"]
+FACT_ROLES = ["亡国の王女", "魔王軍の元幹部", "前世の恋人", "教会の暗殺者", "勇者の実の兄", "時間遡行者"]
+FACT_RELS = ["主従", "宿敵", "婚約", "師弟", "共犯", "異母兄弟"]
+FACT_TEMPLATES = [
+    "{n}は{i}を{p}に隠している",
+    "{n}の正体は{r}である",
+    "{i}は{p}で発見された",
+    "{n}と{n2}は{rel}の関係にある",
+    "{n}は{p}で{n2}に命を救われた",
+    "{i}には{n}の魂が封じられている",
+]
+FACT_PREFIXES = ["", "", "実は", "判明：", "第三者の証言により、", "本人の告白で"]
+FACT_REWRITES = [("ている", "ていた"), ("である", "だ"), ("された", "されていた"), ("にある", "だった"), ("は", "は、"), ("", "ことが明らかになった")]
+
+
+def make_base_fact(rng):
+    t = rng.choice(FACT_TEMPLATES)
+    n, n2 = rng.sample(FACT_NAMES, 2)
+    return t.format(n=n, n2=n2, i=rng.choice(FACT_ITEMS), p=rng.choice(FACT_PLACES), r=rng.choice(FACT_ROLES), rel=rng.choice(FACT_RELS))
+
+
+def paraphrase(text, rng):
+    """モデルが毎話行う程度の言い換え（接頭辞・語尾・読点）"""
+    old, new = rng.choice(FACT_REWRITES)
+    if old:
+        text = text.replace(old, new, 1)
+    else:
+        text = text + new
+    return rng.choice(FACT_PREFIXES) + text + rng.choice(["", "。"])
+
+
+def simulate_facts(episodes, seed=11):
+    """1話あたり新事実2件 + 既出事実の言い換え3件を出力するモデルを模擬"""
+    rng = random.Random(seed)
+    base, stream = [], []
+    for ep in range(1, episodes + 1):
+        emitted = []
+        for _ in range(2):
+            fact = make_base_fact(rng)
+            while fact in base:
+                fact = make_base_fact(rng)
+            base.append(fact)
+            emitted.append((len(base) - 1, fact))
+        for bid in rng.sample(range(len(base) - 2), k=min(3, len(base) - 2)) if len(base) > 2 else []:
+            emitted.append((bid, paraphrase(base[bid], rng)))
+        stream.append((ep, emitted))
+    return base, stream
+
+
+def bench_facts(args):
+    base, stream = simulate_facts(args.episodes)
+    legacy = []
+    store = FactStore()
+    owner = []          # store のエントリ -> 基底事実ID
+    false_merges = missed = 0
+    rows = []
+    t_store = 0.0
+
+    for ep, emitted in stream:
+        legacy = list(set(legacy + [text for _, text in emitted]))
+        t0 = time.perf_counter()
+        for bid, text in emitted:
+            dup = store.find(text)
+            if dup is None:
+                store.add(text, ep=ep)
+                owner.append(bid)
+                if bid in owner[:-1]:
+                    missed += 1          # 言い換えを別事実として追加
+            else:
+                store.add(text, ep=ep)
+                if owner[dup] != bid:
+                    false_merges += 1    # 別の事実を誤って統合
+        t_store += time.perf_counter() - t0
+        if ep % 10 == 0 or ep == args.episodes:
+            legacy_txt = json.dumps(legacy, ensure_ascii=False)
+            rows.append((ep, len(legacy), len(legacy_txt), len(store), len(store.render()), len(set(owner))))
+
+    print(f"{'ep':>4} {'legacy facts':>13} {'legacy chars':>13} {'store facts':>12} {'store chars':>12} {'distinct':>9}")
+    for ep, lf, lc, sf, sc, distinct in rows:
+        print(f"{ep:>4} {lf:>13} {lc:>13} {sf:>12} {sc:>12} {distinct:>9}")
+    total = sum(len(e) for _, e in stream)
+    print(f"true distinct facts: {len(base)}, emitted: {total}")
+    print(f"missed paraphrases: {missed}, false merges: {false_merges}")
+    print(f"store time: {t_store * 1000:.1f} ms total ({t_store / total * 1e6:.0f} us/fact)")
+    if false_merges:
+        sys.exit(1)
+
+
+# ==========================================
+# Prompt Build (書籍単位の断片キャッシュ)
+# ==========================================
+def make_characters(n_sub=4):
+    def reg(name, role):
+        return CharacterRegistry(
+            name=name, role=role, tone="ぶっきらぼうだが根は優しい", personality="合理主義。" * 20,
+            ability="因果律の書き換え（代償あり）。" * 8, background="滅んだ王家の生き残り。" * 15, monologue_style="自嘲気味",
+            pronouns=json.dumps({"一人称": "俺", "二人称": "お前"}, ensure_ascii=False),
+            keyword_dictionary=json.dumps({f"固有語{i}": f"よみ{i}" for i in range(20)}, ensure_ascii=False),
+            relations=json.dumps({f"キャラ{i}": "信頼(70)" for i in range(8)}, ensure_ascii=False),
+            dialogue_samples=json.dumps({f"状況{i}": "「……別に、お前のためじゃない」" * 3 for i in range(6)}, ensure_ascii=False),
+        )
+    return reg("主人公", "主人公"), [reg(f"サブキャラ{i}", "ヒロイン") for i in range(n_sub)]
+
+
+def episode_kwargs(ep, rng):
+    return dict(
+        ep_num=ep, pending_foreshadowing="[]", must_resolve_instruction="",
+        retrieved_context="抜粋" * rng.randint(200, 800), story_so_far="あらすじ" * 700, prev_context_text="前話" * 250,
+        episode_plot_text="設計図" * 500, expected_version=ep, bible_context="設定" * 2000,
+    )
+
+
+def legacy_writing_prompt(pm, mc, subs, style_key, prev_last_sentence, pacing_instruction, pacing_graph, **kwargs):
+    """旧実装: 話ごとにキャラ定義のJSON再解析・システムルール・全テンプレートを str.format で組み立てる"""
+    sub_ctx = "".join(s.get_context_prompt() + "\n" for s in subs)
+    entity_context = mc.get_context_prompt()
+    if sub_ctx:
+        entity_context += "\n【IMPORTANT: SUB CHARACTERS (Must reflect their personalities)】\n" + sub_ctx
+    system_rules = pm.TEMPLATES["writer_system_rules"].format(
+        mc_name=mc.name, mc_tone=mc.tone, pronouns=mc.pronouns, relations=mc.relations, mc_dialogue_samples=mc.dialogue_samples
+    )
+    lead_rule = pm.TEMPLATES["writer_lead_rule"].format(prev_last_sentence=prev_last_sentence) if prev_last_sentence else ""
+    return pm.TEMPLATES["writer_assembly"].format(
+        lead_rule=lead_rule, system_rules=system_rules, FATAL_FLAWS_GUIDELINES=FATAL_FLAWS_GUIDELINES,
+        pacing_graph=pacing_graph, pacing_instruction=pacing_instruction,
+        base_prompt=pm.TEMPLATES["episode_writer_core"].format(**kwargs),
+        entity_context=entity_context, style_instruction=pm.apply_style(style_key),
+    )
+
+
+def bench_prompts(args, ranges=5):
+    """1冊 (episodes 話) を ranges 本の並列レンジで書く場合のプロンプト構築時間"""
+    rng = random.Random(3)
+    mc, subs = make_characters()
+    eps = [(ep, episode_kwargs(ep, rng)) for ep in range(1, args.episodes + 1)]
+    per_range = max(1, len(eps) // ranges)
+    rounds = 20
+
+    pm = PromptManager()
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        legacy_out = [legacy_writing_prompt(pm, mc, subs, "style_web_standard", "前の文。", "指示", "グラフ" * 50, **kw) for _, kw in eps]
+    t_legacy = (time.perf_counter() - t0) / rounds
+
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        pm = PromptManager()
+        new_out = []
+        for i, (_, kw) in enumerate(eps):
+            if i % per_range == 0: # write_episodes はレンジごとに断片を取得
+                fragments = pm.book_fragments(1, mc, subs, "style_web_standard")
+            new_out.append(pm.build_writing_prompt(fragments, "指示", "グラフ" * 50, prev_last_sentence="前の文。", **kw))
+    t_new = (time.perf_counter() - t0) / rounds
+
+    mismatches = sum(1 for a, b in zip(legacy_out, new_out) if a != b)
+    avg_chars = sum(len(p) for p in new_out) / len(new_out)
+    print(f"{len(eps)} prompts / book ({ranges} ranges), avg {avg_chars:.0f} chars")
+    print(f"legacy (per-episode rebuild): {t_legacy * 1000:.2f} ms/book  ({t_legacy / len(eps) * 1e6:.0f} us/prompt)")
+    print(f"engine (fragment cache)     : {t_new * 1000:.2f} ms/book  ({t_new / len(eps) * 1e6:.0f} us/prompt)")
+    print(f"speedup: x{t_legacy / t_new:.2f}, mismatches: {mismatches}")
+    if mismatches:
+        sys.exit(1)
+
+
+# ==========================================
+# DB Writer (イベントループの停止時間)
+# ==========================================
+class LoopWriterDatabaseManager(DatabaseManager):
+    """旧実装: 書き込みコルーチンがイベントループ上で execute/commit を同期実行する"""
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._worker())
+        await self._init_tables_async()
+
+    async def _submit(self, query, params, op):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, params, future))
+        return await future
+
+    async def _worker(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA foreign_keys = ON;")
+        while True:
+            query, params, future = await self.queue.get()
+            try:
+                if isinstance(query, list):
+                    for q, rows in query:
+                        conn.executemany(q, rows)
+                    conn.commit()
+                    future.set_result(None)
+                    continue
+                cursor = conn.execute(query, params)
+                conn.commit()
+                future.set_result(cursor.lastrowid)
+            except Exception as e:
+                conn.rollback()
+                future.set_exception(e)
+
+    async def stop(self, timeout=30.0):
+        self._task.cancel()
+
+
+async def measure_loop_stalls(manager_cls, workdir, episodes, ranges=5, tick=0.001):
+    """ranges 本の並列レンジがチャプター保存(本文+FTS索引)を行う間、1ms周期タイマーの遅延を計測"""
+    dbm = manager_cls(os.path.join(workdir, f"{manager_cls.__name__}.db"))
+    await dbm.start()
+    repo = NovelRepository(dbm)
+    book_id = await dbm.execute("INSERT INTO books (title) VALUES (?)", ("bench",))
+    with open("style_samples.json", encoding="utf-8") as f:
+        body = "\n\n".join(s["text"] for s in json.load(f)["samples"])[:5000]
+
+    lags, done = [], asyncio.Event()
+
+    async def ticker():
+        loop = asyncio.get_running_loop()
+        while not done.is_set():
+            t0 = loop.time()
+            await asyncio.sleep(tick)
+            lags.append(max(0.0, loop.time() - t0 - tick))
+
+    async def write_range(start, end):
+        for ep in range(start, end + 1):
+            ws = json.dumps({"new_facts": [f"第{ep}話の事実{i}" for i in range(5)]}, ensure_ascii=False)
+            await repo.save_chapter(book_id, ep, f"第{ep}話", body, body[:300], ws)
+            await repo.update_plot_status(book_id, ep, "completed")
+            await asyncio.sleep(0) # API待ちなど他のawaitを挟む
+
+    per = max(1, episodes // ranges)
+    bounds = [(s, min(episodes, s + per - 1)) for s in range(1, episodes + 1, per)]
+    tick_task = asyncio.create_task(ticker())
+    t0 = time.perf_counter()
+    await asyncio.gather(*(write_range(s, e) for s, e in bounds))
+    elapsed = time.perf_counter() - t0
+    done.set()
+    await tick_task
+    await dbm.stop()
+    return elapsed, sorted(lags)
+
+
+def bench_dbloop(args):
+    workdir = tempfile.mkdtemp(prefix="bench_db_", dir=os.getcwd()) # 実ディスク上でfsyncを含めて計測
+    try:
+        print(f"{args.episodes} chapters over 5 concurrent ranges (save_chapter + FTS index + plot status)")
+        print(f"{'writer':<28}{'elapsed(s)':>11}{'ticks':>7}{'p50 lag(ms)':>13}{'p99 lag(ms)':>13}{'max lag(ms)':>13}{'stalled(ms)':>13}")
+        for cls, label in ((LoopWriterDatabaseManager, "event loop (legacy)"), (DatabaseManager, "dedicated thread")):
+            elapsed, lags = asyncio.run(measure_loop_stalls(cls, workdir, args.episodes))
+            p = lambda q: lags[min(len(lags) - 1, int(len(lags) * q))] * 1000 if lags else 0.0
+            stalled = sum(l for l in lags if l > 0.005) * 1000 # 5ms超の遅延をループ停止とみなす
+            print(f"{label:<28}{elapsed:>11.2f}{len(lags):>7}{p(0.5):>13.2f}{p(0.99):>13.2f}{(lags[-1] * 1000 if lags else 0):>13.2f}{stalled:>13.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+BENCHMARKS = {
+    "formatter": bench_formatter,
+    "facts": bench_facts,
+    "prompts": bench_prompts,
+    "dbloop": bench_dbloop,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("--mb", type=float, default=8.0, help="生成するコーパスサイズ (MB)")
+    parser.add_argument("--episodes", type=int, default=50, help="facts / prompts / dbloop: 模擬する話数")
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args)
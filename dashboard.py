@@ -0,0 +1,313 @@
+"""
+Novel Factory ライブ・スループットダッシュボード
+
+factory_run.db を読み取り専用で開き、工場の実行中に進捗・スループット・トークン消費を可視化する。
+前回ポーリング以降に変更された行だけを取得して差分更新する。
+シャード構成（FACTORY_STORAGE=sharded）ではカタログDBを指定すれば各ブックDBも併せて読む。
+
+    streamlit run dashboard.py
+"""
+import os
+import time
+import sqlite3
+import datetime
+
+import pandas as pd
+import streamlit as st
+
+DB_FILE = os.environ.get("FACTORY_DB_FILE", "factory_run.db")
+STALL_MINUTES = 20          # この時間進捗がないレンジを「停滞」とみなす
+LATENCY_BUCKETS = [0, 15, 30, 60, 120, 300, 600, 1800]
+
+
+# ==========================================
+# DB Access (Read-Only)
+# ==========================================
+def connect_ro(path):
+    """WAL書き込み中の工場と競合しないよう読み取り専用URIで接続"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5.0, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def query_df(conn, sql, params=()):
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    except sqlite3.OperationalError:
+        return pd.DataFrame() # テーブル未作成（古いDB）
+    return pd.DataFrame([dict(r) for r in rows])
+
+
+def merge_rows(old, new, keys):
+    """差分取得した行を既存キャッシュへ上書きマージ"""
+    if new.empty:
+        return old
+    if old.empty:
+        return new
+    merged = pd.concat([old, new], ignore_index=True)
+    return merged.drop_duplicates(subset=keys, keep="last").reset_index(drop=True)
+
+
+def shard_sources(conn, db_path):
+    """シャード構成（FACTORY_STORAGE=sharded）ならカタログに記録された各ブックDBのパスを返す"""
+    paths = query_df(conn, "SELECT shard_path FROM books WHERE shard_path IS NOT NULL")
+    sources = []
+    for path in (paths["shard_path"].tolist() if not paths.empty else []):
+        # 工場の作業ディレクトリ基準の相対パス。見つからなければカタログと同じ場所から探す
+        if not os.path.isabs(path) and not os.path.exists(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(db_path)), path)
+        if os.path.exists(path) and path not in sources:
+            sources.append(path)
+    return sources
+
+
+def poll_source(conn, cursor):
+    """1つのDBから前回ポーリング以降の変更行のみを取得する（cursor を更新）"""
+    ranges = query_df(conn, "SELECT book_id, start_ep, end_ep, created_at FROM write_ranges")
+
+    plot_new = query_df(
+        conn,
+        "SELECT book_id, ep_num, title, status, tension, updated_at FROM plot WHERE updated_at > ? OR (? = '' AND updated_at IS NULL)",
+        (cursor["plot_ts"], cursor["plot_ts"])
+    )
+    if not plot_new.empty and plot_new["updated_at"].notna().any():
+        cursor["plot_ts"] = max(cursor["plot_ts"], plot_new["updated_at"].dropna().max())
+
+    # Critic の採点（UPDATE）も拾うため updated_at で追う（列追加前の行は created_at）
+    ch_new = query_df(
+        conn,
+        """SELECT book_id, ep_num, title, created_at, COALESCE(updated_at, created_at) AS updated_at,
+                  critic_status, consistency_score, cliffhanger_score, (summary = 'エラー') AS is_error
+           FROM chapters WHERE COALESCE(updated_at, created_at) > ? AND title NOT LIKE 'ANCHOR_EP_%'""",
+        (cursor["chapters_ts"],)
+    )
+    if not ch_new.empty:
+        cursor["chapters_ts"] = max(cursor["chapters_ts"], ch_new["updated_at"].max())
+
+    api_new = query_df(
+        conn,
+        """SELECT id, book_id, ep_num, stage, model, attempt, success, latency,
+                  prompt_tokens, candidates_tokens, cached_tokens, thinking_tokens, cost, created_at
+           FROM api_calls WHERE id > ? ORDER BY id""",
+        (cursor["api_last_id"],)
+    )
+    if not api_new.empty:
+        cursor["api_last_id"] = int(api_new["id"].max())
+    return ranges, plot_new, ch_new, api_new
+
+
+def concat_frames(frames):
+    frames = [f for f in frames if not f.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def poll(db_path, cache):
+    """カタログと各シャードを順に読み、変更行のみを取得してキャッシュを更新する"""
+    conn = connect_ro(db_path)
+    try:
+        cache["books"] = query_df(conn, "SELECT id AS book_id, title, genre, target_eps, status, created_at FROM books")
+        sources = [db_path] + shard_sources(conn, db_path)
+    finally:
+        conn.close()
+
+    ranges, plot_new, ch_new, api_new = [], [], [], []
+    for path in sources:
+        cursor = cache["cursors"].setdefault(path, {"plot_ts": "", "chapters_ts": "", "api_last_id": 0})
+        if path == db_path and len(sources) > 1:
+            # シャード構成のカタログには未割当のAPIコールしか残らず、ブック確定時にシャードへ移される。
+            # 追記すると二重計上になるので毎回全件を読み直す
+            cursor["api_last_id"] = 0
+        conn = connect_ro(path)
+        try:
+            for acc, df in zip((ranges, plot_new, ch_new, api_new), poll_source(conn, cursor)):
+                acc.append(df)
+        finally:
+            conn.close()
+    pending = api_new.pop(0) if len(sources) > 1 else pd.DataFrame()
+    plot_new, ch_new, api_new = concat_frames(plot_new), concat_frames(ch_new), concat_frames(api_new)
+
+    cache["ranges"] = concat_frames(ranges)
+    cache["plot"] = merge_rows(cache["plot"], plot_new, ["book_id", "ep_num"])
+    cache["chapters"] = merge_rows(cache["chapters"], ch_new, ["book_id", "ep_num"])
+    # api_calls の id はシャードごとの連番なので、キーにせず単純に追記する
+    cache["api_log"] = concat_frames([cache["api_log"], api_new])
+    cache["api_calls"] = concat_frames([cache["api_log"], pending])
+
+    cache["polled_at"] = datetime.datetime.now()
+    cache["last_delta"] = {"sources": len(sources), "plot": len(plot_new), "chapters": len(ch_new), "api_calls": len(api_new)}
+    return cache
+
+
+def new_cache():
+    return {
+        "books": pd.DataFrame(), "ranges": pd.DataFrame(),
+        "plot": pd.DataFrame(), "chapters": pd.DataFrame(), "api_calls": pd.DataFrame(),
+        "api_log": pd.DataFrame(),  # 追記専用分（api_calls = api_log + カタログの未割当分）
+        "cursors": {},          # DBパス -> {plot_ts, chapters_ts, api_last_id}
+        "polled_at": None, "last_delta": {},
+    }
+
+
+# ==========================================
+# Aggregations
+# ==========================================
+def episodes_per_hour(chapters, window_hours=1.0):
+    if chapters.empty:
+        return 0.0, 0.0
+    done = chapters[chapters["is_error"] == 0]
+    if done.empty:
+        return 0.0, 0.0
+    ts = pd.to_datetime(done["created_at"])
+    now = datetime.datetime.now()
+    recent = (ts > now - datetime.timedelta(hours=window_hours)).sum() / window_hours
+    span_hours = max((ts.max() - ts.min()).total_seconds() / 3600, 1 / 60)
+    overall = len(ts) / span_hours
+    return float(recent), float(overall)
+
+
+def episode_latency(api_calls, book_id=None):
+    """1話あたりの執筆所要時間(API合計)と試行回数"""
+    if api_calls.empty:
+        return pd.DataFrame()
+    df = api_calls[api_calls["stage"].isin(["write", "rework"])]
+    if book_id is not None:
+        df = df[df["book_id"] == book_id]
+    if df.empty:
+        return pd.DataFrame()
+    return df.groupby(["book_id", "ep_num"]).agg(latency=("latency", "sum"), attempts=("id", "count")).reset_index()
+
+
+def range_status(book_id, ranges, plot, chapters, per_ep_latency):
+    """レンジ別の残り話数・推定残り時間・停滞判定。残り時間最大のレンジがクリティカルパス"""
+    rows = []
+    book_ranges = ranges[ranges["book_id"] == book_id] if not ranges.empty else ranges
+    if book_ranges.empty:
+        return pd.DataFrame()
+    book_plot = plot[plot["book_id"] == book_id] if not plot.empty else plot
+    book_ch = chapters[chapters["book_id"] == book_id] if not chapters.empty else chapters
+    now = datetime.datetime.now()
+
+    for r in book_ranges.itertuples():
+        eps = set(range(r.start_ep, r.end_ep + 1))
+        done = set()
+        if not book_plot.empty:
+            done = set(book_plot[(book_plot["ep_num"].isin(eps)) & (book_plot["status"] == "completed")]["ep_num"])
+        remaining = len(eps - done)
+
+        last_progress = pd.to_datetime(r.created_at)
+        if not book_ch.empty:
+            in_range = book_ch[book_ch["ep_num"].isin(eps)]
+            if not in_range.empty:
+                last_progress = max(last_progress, pd.to_datetime(in_range["created_at"]).max())
+        idle_min = (now - last_progress).total_seconds() / 60
+
+        rows.append({
+            "range": f"{r.start_ep}-{r.end_ep}",
+            "done": len(done),
+            "remaining": remaining,
+            "est_remaining_min": round(remaining * per_ep_latency / 60, 1),
+            "idle_min": round(idle_min, 1),
+            "stalled": remaining > 0 and idle_min > STALL_MINUTES,
+        })
+
+    df = pd.DataFrame(rows)
+    df["critical_path"] = False
+    if (df["remaining"] > 0).any():
+        df.loc[df["est_remaining_min"].idxmax(), "critical_path"] = True
+    return df
+
+
+def histogram(values, buckets):
+    labels = [f"{buckets[i]}-{buckets[i + 1]}" for i in range(len(buckets) - 1)] + [f"{buckets[-1]}+"]
+    counts = pd.cut(values, bins=buckets + [float("inf")], labels=labels, right=False).value_counts().reindex(labels)
+    return counts.fillna(0).astype(int)
+
+
+# ==========================================
+# Page
+# ==========================================
+st.set_page_config(page_title="Novel Factory Dashboard", layout="wide")
+st.title("Novel Factory ライブダッシュボード")
+
+with st.sidebar:
+    db_path = st.text_input("DB", DB_FILE)
+    auto_refresh = st.checkbox("自動更新", value=True)
+    interval = st.slider("更新間隔(秒)", 5, 120, 15)
+    if st.button("キャッシュ破棄"):
+        st.session_state.pop("cache", None)
+
+if not os.path.exists(db_path):
+    st.warning(f"{db_path} が見つかりません。工場の起動を待っています...")
+    st.stop()
+
+if st.session_state.get("cache_db") != db_path:
+    st.session_state["cache"] = new_cache()
+    st.session_state["cache_db"] = db_path
+cache = st.session_state.setdefault("cache", new_cache())
+
+cache = poll(db_path, cache)
+st.session_state["cache"] = cache
+
+books, plot, chapters, api_calls, ranges = cache["books"], cache["plot"], cache["chapters"], cache["api_calls"], cache["ranges"]
+st.caption(f"最終取得: {cache['polled_at']:%H:%M:%S}  差分: {cache['last_delta']}")
+
+# --- Throughput ---
+recent_rate, overall_rate = episodes_per_hour(chapters)
+lat_df = episode_latency(api_calls)
+c1, c2, c3, c4 = st.columns(4)
+c1.metric("執筆速度 (直近1h)", f"{recent_rate:.1f} 話/h")
+c2.metric("執筆速度 (全体)", f"{overall_rate:.1f} 話/h")
+c3.metric("1話あたり中央値", f"{lat_df['latency'].median():.0f} s" if not lat_df.empty else "-")
+c4.metric("累計コスト", f"${api_calls['cost'].sum():.3f}" if not api_calls.empty else "-")
+
+# --- Per-book progress ---
+st.subheader("ブック別進捗")
+if books.empty:
+    st.info("まだブックがありません。")
+for book in books.sort_values("book_id", ascending=False).itertuples():
+    book_plot = plot[plot["book_id"] == book.book_id] if not plot.empty else plot
+    total = len(book_plot) or (book.target_eps or 0)
+    status_counts = book_plot["status"].value_counts().to_dict() if not book_plot.empty else {}
+    completed = status_counts.get("completed", 0)
+
+    with st.expander(f"#{book.book_id} {book.title} — {completed}/{total}", expanded=(book.book_id == books["book_id"].max())):
+        st.progress(completed / total if total else 0.0)
+        st.write({k: int(v) for k, v in status_counts.items()})
+
+        book_lat = episode_latency(api_calls, book.book_id)
+        per_ep_latency = float(book_lat["latency"].median()) if not book_lat.empty else 120.0
+        rs = range_status(book.book_id, ranges, plot, chapters, per_ep_latency)
+        if not rs.empty:
+            st.markdown("**レンジ状況**（★=クリティカルパス）")
+            rs_view = rs.assign(range=rs.apply(lambda r: f"★ {r['range']}" if r["critical_path"] else r["range"], axis=1))
+            st.dataframe(rs_view.drop(columns=["critical_path"]), hide_index=True)
+            stalled = rs[rs["stalled"]]
+            for r in stalled.itertuples():
+                st.error(f"停滞中: Ep {r.range} ({r.idle_min:.0f}分間進捗なし, 残り{r.remaining}話)")
+
+        if not book_lat.empty:
+            h1, h2 = st.columns(2)
+            h1.markdown("**1話あたりの執筆時間 (秒)**")
+            h1.bar_chart(histogram(book_lat["latency"], LATENCY_BUCKETS))
+            h2.markdown("**1話あたりの試行回数**")
+            h2.bar_chart(book_lat["attempts"].value_counts().sort_index())
+
+# --- Token spend ---
+st.subheader("ステージ別トークン消費")
+if api_calls.empty:
+    st.info("api_calls がまだ記録されていません。")
+else:
+    spend = api_calls.groupby("stage").agg(
+        calls=("id", "count"),
+        prompt_tokens=("prompt_tokens", "sum"),
+        output_tokens=("candidates_tokens", "sum"),
+        thinking_tokens=("thinking_tokens", "sum"),
+        cost=("cost", "sum"),
+    ).sort_values("cost", ascending=False)
+    s1, s2 = st.columns([2, 1])
+    s1.bar_chart(spend[["prompt_tokens", "output_tokens", "thinking_tokens"]])
+    s2.dataframe(spend)
+
+if auto_refresh:
+    time.sleep(interval)
+    st.rerun()
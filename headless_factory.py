@@ -5,18 +5,32 @@ import datetime
 import re
 import random
 import zipfile
-import io
+import hashlib
+import uuid
+import socket
+import unicodedata
+import tempfile
 import sqlite3
+import queue
 import smtplib
 import math
 import asyncio
+import threading
+import concurrent.futures
+import itertools
+import collections
+import string
+import contextlib
+import contextvars
 import urllib.request
 import urllib.parse
+import http.server
 from typing import List, Optional, Dict, Any, Type, Union
 from enum import Enum
 from pydantic import BaseModel, Field, ValidationError
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
 from email import encoders
 from google import genai
 from google.genai import types
@@ -25,9 +39,11 @@ from google.genai import types
 # 0. 設定 & 仕様変更 (Flash / Flash-Lite / 50話プロット / 25話執筆)
 # ==========================================
 API_KEY = os.environ.get("GEMINI_API_KEY")
+# 複数キー（カンマ区切り）。指定時は GEMINI_API_KEY より優先し、キーごとのクォータで負荷分散する
+API_KEYS = [k.strip() for k in os.environ.get("GEMINI_API_KEYS", "").split(",") if k.strip()] or ([API_KEY] if API_KEY else [])
 GMAIL_USER = os.environ.get("GMAIL_USER")
 GMAIL_PASS = os.environ.get("GMAIL_PASS")
-TARGET_EMAIL = os.environ.get("GMAIL_USER")
+TARGET_EMAIL = os.environ.get("FACTORY_MAIL_TO") or GMAIL_USER
 # Google Custom Search API Settings (TrendAnalyst用 - 廃止のため未使用)
 CSE_API_KEY = os.environ.get("CSE_API_KEY")
 SEARCH_ENGINE_ID = os.environ.get("SEARCH_ENGINE_ID")
@@ -39,6 +55,451 @@ MODEL_PRO = "gemini-2.5-flash"            # 重要な局面用
 # MODEL_MARKETING は廃止（MODEL_ULTRALONGに統合）
 
 DB_FILE = "factory_run.db"
+STORAGE_MODE = os.environ.get("FACTORY_STORAGE", "single")  # single: 全ブックを DB_FILE に格納 / sharded: ブックごとに1ファイル + DB_FILE をカタログに使用
+SHARD_DIR = os.environ.get("FACTORY_SHARD_DIR", "books")     # sharded 時のブック別DBの置き場 (book_{id}.db)
+TRACE_FILE = os.environ.get("FACTORY_TRACE_FILE", "")  # トレース出力先（例: factory_trace.jsonl）。空文字で無効
+METRICS_FILE = os.environ.get("FACTORY_METRICS_FILE", "")  # Prometheus textfile の出力先（例: factory_metrics.prom）。空文字で無効
+METRICS_PORT = int(os.environ.get("FACTORY_METRICS_PORT", "0"))  # ローカルHTTPエンドポイント (0で無効)
+METRICS_INTERVAL = 15.0
+
+# メール配送設定 (永続Outbox + バックグラウンド送信スレッド)
+SMTP_HOST = os.environ.get("FACTORY_SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("FACTORY_SMTP_PORT", "465"))
+SMTP_USE_SSL = os.environ.get("FACTORY_SMTP_SSL", "1") == "1"   # 0: 平文SMTP（STARTTLS対応時は昇格）。ローカルのスタンドイン検証用
+OUTBOX_DIR = os.environ.get("FACTORY_OUTBOX_DIR", "outbox")      # 送信待ち添付の置き場（送信成功で削除）
+MAX_ATTACHMENT_BYTES = 18 * 1024 * 1024   # Gmailの25MB上限にbase64膨張(約1.37倍)込みで収まるサイズ
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 30.0                # 秒。試行ごとに倍増
+OUTBOX_BACKOFF_CAP = 1800.0
+
+# 差分エクスポート設定 (コンテンツハッシュのマニフェストで変更分のみ書き出し)
+EXPORT_DIR = os.environ.get("FACTORY_EXPORT_DIR", "")          # 空文字で執筆中の自動エクスポート無効
+EXPORT_MODE = os.environ.get("FACTORY_EXPORT_MODE", "dir")     # dir: ディレクトリへ上書き / zip: 差分ZIPを作成
+EXPORT_EVERY_EPS = int(os.environ.get("FACTORY_EXPORT_EVERY_EPS", "5"))
+
+# 企画シード設定 (同梱JSONからローカルで抽選し、企画プロンプトを縮小)
+SEEDS_FILE = "story_seeds.json"
+AUTHOR_STYLES_FILE = "author_styles.json"
+STYLE_SAMPLES_FILE = "style_samples.json"
+SEED_HISTORY_WINDOW = 6   # 直近何冊分の使用履歴で重みを下げるか
+
+# 過去話検索設定 (FTS5 trigram索引から関連抜粋のみをプロンプトへ注入)
+RETRIEVAL_TOP_K = 5            # 1話あたりに差し込む抜粋数
+RETRIEVAL_MAX_TERMS = 12       # 検索語の上限
+RETRIEVAL_RECENT_FACTS = 20    # 索引有効時、[REVEALED FACTS] は直近分のみ（古い事実は検索で補う）
+PASSAGE_CHARS = 400            # 本文を区切る抜粋サイズ
+PASSAGE_BOOK_STRIDE = 10 ** 7  # passages_fts の rowid = book_id * STRIDE + ep_num * 1000 + 連番
+
+# 確定事実の近似重複判定 (文字n-gram MinHash/LSH)
+FACT_SHINGLE_SIZE = 3          # 日本語は分かち書きなしのため文字3-gram
+FACT_MINHASH_PERM = 64
+FACT_LSH_BANDS = 32            # 2行×32バンド: Jaccard 0.5 で候補漏れ率 < 0.01%
+FACT_DUP_THRESHOLD = 0.5       # 候補のうちJaccard係数がこれ以上、かつ
+FACT_DUP_CONTAINMENT = 0.9     # 短い側のn-gramの9割以上が共通なら同一事実とみなす（固有名詞1語違いの別事実を統合しない）
+FACT_MINHASH_SEED = 20260201
+FORESHADOW_MATCH_THRESHOLD = 0.4    # 回収報告（言い換え）を未回収伏線へ対応付ける判定は事実の重複判定より緩める
+FORESHADOW_MATCH_CONTAINMENT = 0.7
+
+PROMPT_FRAGMENT_CACHE_BOOKS = 32  # 書籍単位のプロンプト断片キャッシュを保持する冊数
+
+# 執筆スケジュール
+SERIAL_MODE = os.environ.get("FACTORY_SERIAL_MODE", "standard")  # standard: 1コールで全話プロット / long: アーク→話の階層プランニング
+STANDARD_TARGET_EPS = 50               # standard の総話数（1コールで出力できるプロット数の上限付近）
+ANCHOR_EPS = [10, 25, 35, 45, 50]      # standard 用のアンカー（並列執筆レンジの区切り）。long ではアーク終端話を使う
+WRITE_PHASE_EPS = int(os.environ.get("FACTORY_WRITE_EPS", "25"))  # 1フェーズで執筆する話数（残りのプロット・アークはDBに残る）
+
+# 長期連載設定 (FACTORY_SERIAL_MODE=long)
+LONG_TARGET_EPS = int(os.environ.get("FACTORY_TARGET_EPS", "200"))
+ARC_MIN_EPS = 8                        # 1アークの話数の目安（企画時にモデルへ指示）
+ARC_MAX_EPS = 25                       # 1回のプロット生成で出力する話数の上限
+ARC_CONTEXT_ARCS = 3                   # アーク単位のプロット生成に渡す直前アークの要約数（プロンプトを一定サイズに保つ）
+
+# 階層ローリング要約設定 (話の要約 → ブロック要約 → 全体あらすじ。執筆プロンプトへは固定長で注入)
+MODEL_SUMMARY = MODEL_LITE             # ブロック要約・畳み込み用（安価モデル）
+STORY_BLOCK_EPS = 5                    # standard のブロック長（長期連載はアーク単位）
+STORY_RECENT_EPS = 3                   # 話ごとの要約をそのまま渡す直近話数（直前話は Bridge Context で渡すので除く）
+STORY_RECENT_BLOCKS = 2                # ブロック要約のまま渡す数。これより古いブロックは全体あらすじへ畳み込む
+STORY_EP_SUMMARY_CHARS = 300
+STORY_BLOCK_CHARS = 600
+STORY_SUMMARY_CHARS = 1200
+
+# ジョブキュー設定 (jobs テーブルのリース付き分散実行。python headless_factory.py worker)
+JOB_LEASE_SECONDS = 120.0              # ハートビートが途絶えてからこの秒数で他ワーカーが再取得できる
+JOB_HEARTBEAT_SECONDS = 30.0
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BASE = 60.0                  # 秒。失敗ごとに倍増
+JOB_POLL_SECONDS = 5.0                 # 取得できるジョブがないときの待機秒数
+JOB_WORKER_SLOTS = int(os.environ.get("FACTORY_WORKER_SLOTS", "2"))  # 1プロセスで同時に実行するジョブ数
+
+# バッチ投入設定 (レイテンシを問わない生成を割引のバッチAPIへ。off / local / provider)
+BATCH_MODE = os.environ.get("FACTORY_BATCH_MODE", "off")
+# anchor / arc_plot も指定できるが、執筆チェーンが結果を待つ（クリティカルパス上の）ため既定では同期呼び出し
+BATCH_STAGES = set(filter(None, os.environ.get("FACTORY_BATCH_STAGES", "critic,summary").split(",")))
+BATCH_DIR = os.environ.get("FACTORY_BATCH_DIR", "batches")
+BATCH_WINDOW = 30.0                    # 秒。この間に積まれたリクエストを1バッチにまとめる
+BATCH_MAX_REQUESTS = 100               # 1バッチの上限（達した時点で即投入）
+BATCH_POLL_SECONDS = 30.0              # provider: 完了確認の間隔
+BATCH_PROVIDER_TIMEOUT = float(os.environ.get("FACTORY_BATCH_PROVIDER_TIMEOUT", "3600"))  # provider: これを過ぎても未完了ならキャンセルして同期呼び出しへ
+BATCH_PRICE_FACTOR = 0.5               # provider: 通常単価に対するバッチ単価の比
+BATCH_LOCAL_CONCURRENCY = 2            # local: バッチファイルを処理する並列数（執筆チェーンとは別枠）
+
+# 実行期限設定 (ジョブのタイムアウト前に縮退し、完成分をパッケージして送信する)
+RUN_DEADLINE_MINUTES = float(os.environ.get("FACTORY_RUN_MINUTES", "0"))  # 0 で期限なし
+BUDGET_DEGRADE_MINUTES = 90.0          # 残りがこれ未満で縮退モード
+BUDGET_RESERVE_MINUTES = 30.0          # 残りがこれ未満で新規着手を止める（エクスポート・ZIP・送信用）
+API_CALL_TIMEOUT = 600.0               # 秒。実行期限があるときのAPI呼び出し1回の上限（期限が近づくと短くなる。期限なしでは上限なし）
+BUDGET_MIN_CALL_TIMEOUT = 60.0
+SHUTDOWN_DRAIN_SECONDS = 300.0         # 終了時、バックグラウンドの採点・要約・バッチを待つ上限（cutoff 後は待たずにキャンセル）
+DEGRADED_MAX_RETRIES = 2               # 縮退モードでの品質リトライ上限（通常5）
+DEGRADED_SCORE_THRESHOLD = 50          # 縮退モードでの即時採用ライン
+
+# API再試行・サーキットブレーカー設定
+API_MAX_RETRIES = 6                    # quota / transient エラーの再試行回数（invalid / blocked は再試行しない）
+API_BACKOFF_BASE = 2.0                 # 秒。full jitter: uniform(0, min(CAP, BASE * 2^n))
+API_BACKOFF_CAP = 60.0
+API_RETRY_AFTER_MAX = 300.0            # サーバー指定の待機秒数の上限
+API_EMPTY_RETRIES = 1                  # 空応答の再送回数（それでも空なら呼び出し側の空応答処理に任せる）
+BLOCK_FINISH_REASONS = {"SAFETY", "PROHIBITED_CONTENT", "BLOCKLIST", "SPII", "RECITATION"}
+BREAKER_WINDOW = 60.0                  # 秒。エラー率の集計期間
+BREAKER_MIN_CALLS = 10                 # これ未満の件数では open にしない
+BREAKER_ERROR_RATE = 0.5
+BREAKER_OPEN_SECONDS = 60.0            # open の期間（half_open の試行が失敗するたびに倍増）
+BREAKER_OPEN_MAX = 600.0
+BREAKER_MAX_WAITS = 5                  # サーキットが開いている間に送信せず待つ回数の上限（API再試行回数とは別枠）
+# サーキットが開いている間の代替モデル
+MODEL_FALLBACKS = {MODEL_ULTRALONG: MODEL_PRO, MODEL_PRO: MODEL_ULTRALONG, MODEL_LITE: MODEL_PRO}
+# 代替モデルへ切り替えるステージ（企画系のみ既定で有効。執筆・採点・要約は単価の高いモデルへ流さず、開いている間は待つ）
+MODEL_FALLBACK_STAGES = set(filter(None, os.environ.get("FACTORY_FALLBACK_STAGES", "bible,plot,anchor,arc_plot").split(",")))
+
+# APIキープール設定 (GEMINI_API_KEYS)
+KEY_SELECT_POLICY = os.environ.get("FACTORY_KEY_POLICY", "least_loaded")  # least_loaded / round_robin
+# キーごとのモデル別RPM上限（例: "gemini-2.5-flash-lite=4000,gemini-2.5-flash=1000"。未指定モデルは無制限）
+KEY_RPM_LIMITS = {m.strip(): int(n) for m, _, n in (p.partition("=") for p in os.environ.get("FACTORY_KEY_RPM", "").split(",")) if m.strip() and n.strip().isdigit()}
+KEY_COOLDOWN_BASE = 30.0               # 秒。クォータエラーを返したキーをそのモデルについて外す時間（連続するたびに倍増）
+KEY_COOLDOWN_MAX = 600.0
+
+# 品質ゲート設定 (インライン自己採点 + 非同期Critic)
+MODEL_CRITIC = MODEL_LITE              # 完成済みチャプターの採点用（安価モデル）
+INLINE_SCORE_THRESHOLD = 70            # 執筆ループでの即時採用ライン（Criticが後段で精査するため低め）
+CRITIC_BATCH_SIZE = 5                  # Critic 1コールあたりの採点話数
+CRITIC_BATCH_WAIT = 30.0               # バッチが埋まるまでの最大待機秒数
+CRITIC_MAX_ATTEMPTS = 3                # 採点に失敗した話を積み直す上限（超えたら critic_status='error'）
+CRITIC_CONSISTENCY_THRESHOLD = 70      # これ未満は差し戻し
+CRITIC_CLIFFHANGER_THRESHOLD = 60      # これ未満は差し戻し
+
+# パッチ改稿設定 (不合格の草稿を全文書き直さず、段落番号付きの差し替えだけを生成してローカルで適用)
+REVISION_MODE = os.environ.get("FACTORY_REVISION_MODE", "patch")  # patch / full
+REVISION_MIN_SCORE = 40                # これ未満の草稿はパッチでは救えないとみなし全文を書き直す
+REVISION_MAX_EDITS = 8                 # 1回の改稿で適用する差し替えの上限
+REVISION_MAX_ROUNDS = 2                # 同じ草稿へのパッチ改稿の連続上限（超えたら全文書き直し）
+
+# モデルカスケード設定 (安価モデル優先 → 品質ゲート失敗時のみ昇格)
+MODEL_PRICING = {                      # USD / 1M tokens (input, output)
+    MODEL_LITE: (0.10, 0.40),
+    MODEL_PRO: (0.30, 2.50),
+    MODEL_ULTRALONG: (0.50, 3.00),
+}
+MODEL_CACHED_PRICING = {               # USD / 1M tokens（コンテキストキャッシュから読まれた入力トークン）
+    MODEL_LITE: 0.025,
+    MODEL_PRO: 0.075,
+    MODEL_ULTRALONG: 0.05,
+}
+LATENCY_COST_WEIGHT = 0.0005           # レイテンシ1秒あたりのコスト換算 (USD)
+PRO_MAX_SHARE = 0.3                    # 1冊のうちMODEL_PROで確定させてよい話数の割合上限
+CASCADE_MIN_SAMPLES = 5                # 学習済み採用率を信頼するための最小試行数
+CASCADE_MAX_CHEAP_ATTEMPTS = 3         # 安価モデルで粘る最大回数
+
+# ==========================================
+# Tracing (ネスト可能なスパン / JSONL + Chrome Trace出力)
+# ==========================================
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "lane", "start", "attrs")
+
+    def __init__(self, name, span_id, parent_id, lane, attrs):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.lane = lane
+        self.start = time.time()
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+class Tracer:
+    """
+    軽量トレーサー。スパンはcontextvarsで親子関係を引き継ぐため、
+    asyncio.gatherで分岐した各レンジのタスクも呼び出し元スパンの子として記録される。
+    終了したスパンはJSONLへ逐次追記し、export_chrome_traceでトレースビューア用JSONに変換する。
+    """
+    def __init__(self, path):
+        self.path = path
+        self._ids = itertools.count(1)
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _lane(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = task.get_name() if task else threading.current_thread().name
+        return self._lanes.setdefault(key, len(self._lanes) + 1)
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        parent = _current_span.get()
+        span = Span(name, next(self._ids), parent.span_id if parent else None, self._lane(), attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs['error'] = repr(e)[:200]
+            raise
+        finally:
+            _current_span.reset(token)
+            self._emit(span, time.time())
+
+    def _emit(self, span, end):
+        if not self.enabled:
+            return
+        record = {
+            "name": span.name, "span_id": span.span_id, "parent_id": span.parent_id, "lane": span.lane,
+            "start": span.start, "duration_ms": round((end - span.start) * 1000, 3), "attrs": span.attrs
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+
+    def flush(self):
+        with self._lock:
+            if self._file:
+                self._file.flush()
+
+    def export_chrome_trace(self, out_path=None):
+        """JSONLをChrome Trace Event形式(chrome://tracing, Perfetto)に変換する"""
+        if not self.enabled or not os.path.exists(self.path):
+            return None
+        self.flush()
+        out_path = out_path or os.path.splitext(self.path)[0] + ".trace.json"
+        events = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue
+                events.append({
+                    "name": r["name"], "ph": "X", "pid": 1, "tid": r["lane"],
+                    "ts": int(r["start"] * 1_000_000), "dur": int(r["duration_ms"] * 1000),
+                    "args": dict(r["attrs"], span_id=r["span_id"], parent_id=r["parent_id"])
+                })
+        with open(out_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return out_path
+
+tracer = Tracer(TRACE_FILE)
+
+# ==========================================
+# Metrics (Counter / Gauge / Histogram → Prometheus textfile / HTTP)
+# ==========================================
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _fmt_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key)) + (extra or [])
+        if not pairs:
+            return ""
+        body = ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+        return "{" + body + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{self._fmt_labels(key)} {value}")
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, state["counts"]):
+                    lines.append(f"{self.name}_bucket{self._fmt_labels(key, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{self._fmt_labels(key, [('le', '+Inf')])} {state['count']}")
+                lines.append(f"{self.name}_sum{self._fmt_labels(key)} {state['sum']}")
+                lines.append(f"{self.name}_count{self._fmt_labels(key)} {state['count']}")
+        return lines
+
+class MetricsRegistry:
+    """
+    実行中のキュー深度・同時リクエスト数・リトライ率などを集計するレジストリ。
+    Prometheus textfile collector 用ファイルへの定期書き出しと、任意のローカルHTTPエンドポイントで公開する。
+    """
+    def __init__(self):
+        self._metrics = []
+        self._server = None
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path=METRICS_FILE):
+        if not path:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path) # node_exporterが書きかけを読まないようアトミックに置換
+
+    def serve(self, port=METRICS_PORT):
+        """/metrics をローカルHTTPで公開する（デーモンスレッド）"""
+        if not port or self._server:
+            return
+        registry = self
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"Metrics endpoint: http://127.0.0.1:{port}/metrics")
+
+    async def run_exporter(self, interval=METRICS_INTERVAL):
+        """textfileを定期的に書き出すバックグラウンドタスク"""
+        while True:
+            try:
+                await asyncio.to_thread(self.write_textfile)
+            except Exception as e:
+                print(f"Metrics Export Error: {e}")
+            await asyncio.sleep(interval)
+
+metrics = MetricsRegistry()
+API_INFLIGHT = metrics.gauge("factory_api_inflight", "In-flight generate_content requests", ("model",))
+API_REQUESTS = metrics.counter("factory_api_requests_total", "generate_content attempts by outcome", ("model", "stage", "outcome"))
+API_RETRIES = metrics.counter("factory_api_retries_total", "Transport-level retries in _generate_with_retry", ("model", "stage"))
+API_LATENCY = metrics.histogram("factory_api_latency_seconds", "generate_content latency", ("model", "stage"),
+                                buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600))
+DB_QUEUE_DEPTH = metrics.gauge("factory_db_queue_depth", "Pending requests in DatabaseManager.queue")
+DB_QUEUE_LATENCY = metrics.histogram("factory_db_queue_seconds", "DatabaseManager enqueue-to-result latency", ("op",))
+SEMAPHORE_WAITERS = metrics.gauge("factory_semaphore_waiters", "Coroutines waiting on the writing semaphore")
+SEMAPHORE_WAIT = metrics.histogram("factory_semaphore_wait_seconds", "Time spent waiting on the writing semaphore")
+PARSE_RESULTS = metrics.counter("factory_parse_total", "_parse_json_response outcomes by method", ("method",))
+QUALITY_GATE = metrics.counter("factory_quality_gate_total", "Writing quality gate results", ("model", "result"))
+OUTBOX_DELIVERIES = metrics.counter("factory_outbox_deliveries_total", "Outbox send attempts by outcome", ("outcome",))
+PROMPT_BUILD = metrics.histogram("factory_prompt_build_seconds", "Prompt construction time by template", ("template",),
+                                 buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.01))
+PROMPT_FRAGMENT_CACHE = metrics.counter("factory_prompt_fragment_cache_total", "Per-book prompt fragment cache lookups", ("result",))
+JOB_RUNS = metrics.counter("factory_jobs_total", "Job executions by kind and outcome", ("kind", "outcome"))
+KEY_INFLIGHT = metrics.gauge("factory_api_key_inflight", "In-flight requests per API key", ("key", "model"))
+KEY_DRAINS = metrics.counter("factory_api_key_drains_total", "API keys taken out of rotation by reason", ("key", "reason"))
+BREAKER_STATE = metrics.gauge("factory_circuit_state", "Per-model circuit breaker state (0 closed, 1 half-open, 2 open)", ("model",))
+API_FAILOVERS = metrics.counter("factory_api_failovers_total", "Requests routed to a fallback model while the circuit is open", ("model", "fallback"))
+RUN_BUDGET_LEFT = metrics.gauge("factory_run_budget_seconds", "Seconds left until the run deadline")
+REVISIONS = metrics.counter("factory_revisions_total", "Patch revision attempts by result", ("result",))
+BATCH_REQUESTS = metrics.counter("factory_batch_requests_total", "Deferred requests by batch mode and outcome", ("mode", "stage", "outcome"))
+
+@contextlib.asynccontextmanager
+async def instrumented_acquire(semaphore, **attrs):
+    """セマフォ取得待ちをトレース(semaphore_wait)とメトリクス(待機数・待機時間)に記録する"""
+    SEMAPHORE_WAITERS.inc()
+    started = time.monotonic()
+    try:
+        with tracer.span("semaphore_wait", **attrs):
+            await semaphore.acquire()
+    finally:
+        SEMAPHORE_WAITERS.dec()
+    SEMAPHORE_WAIT.observe(time.monotonic() - started)
+    try:
+        yield
+    finally:
+        semaphore.release()
 
 # ==========================================
 # 文体定義 & サンプルデータ
@@ -183,6 +644,116 @@ PLOT_STRUCTURES = {
     }
 }
 
+# ==========================================
+# Seed Registry (story_seeds.json / author_styles.json / style_samples.json)
+# ==========================================
+# シードのジャンルごとに相性の良い文体（STYLE_DEFINITIONS のキー）。未登録のジャンルは全文体から抽選する
+SEED_GENRE_STYLES = {
+    "現代ダンジョン（配信・インフラ化）": ["style_chat_log", "style_action_heroic", "style_spider_chaos", "style_comedy_speed", "style_magic_engineering", "style_web_standard"],
+    "異世界転生・転移（帰還・逆転）": ["style_serious_fantasy", "style_average_gag", "style_dark_hero", "style_overlord", "style_slime_nation", "style_psychological_loop", "style_action_heroic", "style_web_standard"],
+    "悪役令嬢（武闘派・ビジネス）": ["style_villainess_elegant", "style_otome_misunderstand", "style_comedy_speed", "style_bookworm_daily", "style_web_standard"],
+    "ラブコメ（重愛・関係性リセット）": ["style_romcom_cynical", "style_comedy_speed", "style_otome_misunderstand", "style_psychological_loop", "style_web_standard"],
+    "SF・サイバーパンク・スペースオペラ": ["style_magic_engineering", "style_military_rational", "style_vrmmo_introspection", "style_dark_hero", "style_web_standard"],
+    "ホラー・ミステリー（モキュメンタリー）": ["style_psychological_loop", "style_chat_log", "style_serious_fantasy", "style_web_standard"],
+    "スローライフ・クラフト（箱庭・ガチャ）": ["style_slow_life", "style_bookworm_daily", "style_slime_nation", "style_comedy_speed", "style_web_standard"],
+}
+
+class SeedRegistry:
+    """
+    同梱のシード・文体データを起動時に一度だけ読み込み、索引化する。
+    企画段階でシードと文体をローカルで重み付き抽選し、モデルには絞り込んだ企画書（brief）だけを渡す。
+    """
+    def __init__(self, seeds_file=SEEDS_FILE, styles_file=AUTHOR_STYLES_FILE, samples_file=STYLE_SAMPLES_FILE):
+        self.seeds = []          # テンプレート単位に平坦化したシード
+        self.by_id = {}
+        self.by_genre = {}
+        self.styles = {}         # style_id -> author_styles.json のエントリ
+        self.samples = {}        # style_id -> style_samples.json の本文
+        self._load(seeds_file, styles_file, samples_file)
+
+    @staticmethod
+    def _read_json(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"SeedRegistry: {path} could not be loaded ({e})")
+            return {}
+
+    def _load(self, seeds_file, styles_file, samples_file):
+        for g_idx, genre in enumerate(self._read_json(seeds_file).get("seeds", [])):
+            for t_idx, tmpl in enumerate(genre.get("templates", [])):
+                seed = dict(tmpl, seed_id=f"{g_idx}-{t_idx}", genre=genre["genre"], genre_description=genre.get("description", ""))
+                self.seeds.append(seed)
+                self.by_id[seed["seed_id"]] = seed
+                self.by_genre.setdefault(seed["genre"], []).append(seed)
+        self.styles = {s["id"]: s for s in self._read_json(styles_file).get("styles", [])}
+        self.samples = {s["id"]: s["text"] for s in self._read_json(samples_file).get("samples", [])}
+
+    @property
+    def available(self):
+        return bool(self.seeds)
+
+    @staticmethod
+    def _recency_weights(candidates, recent_ids, key):
+        """直近に使ったものほど重みを下げる（最新: 0.1倍 → 古いほど1.0倍に回復）"""
+        weights = []
+        for c in candidates:
+            w = 1.0
+            if c[key] in recent_ids:
+                age = recent_ids.index(c[key])   # 0 = 最新
+                w *= 0.1 + 0.9 * age / max(1, len(recent_ids))
+            weights.append(w)
+        return weights
+
+    def pick(self, history, rng=random):
+        """
+        history: 直近の使用履歴 [{'seed_id', 'genre', 'style_key'}, ...]（新しい順）
+        戻り値: (seed, style_key)
+        """
+        recent_seeds = [h['seed_id'] for h in history]
+        recent_genres = list(dict.fromkeys(h['genre'] for h in history))
+        recent_styles = [h['style_key'] for h in history]
+
+        seed_weights = self._recency_weights(self.seeds, recent_seeds, "seed_id")
+        # ジャンル単位でも連続を避け、テンプレート数の多いジャンルへの偏りを均す
+        for i, seed in enumerate(self.seeds):
+            seed_weights[i] /= len(self.by_genre[seed["genre"]])
+            if seed["genre"] in recent_genres[:2]:
+                seed_weights[i] *= 0.3
+        seed = rng.choices(self.seeds, weights=seed_weights, k=1)[0]
+
+        # 下流（apply_style）と互換で、かつシードのジャンルに合う文体キーのみ候補にする
+        style_candidates = [{"id": k} for k in SEED_GENRE_STYLES.get(seed["genre"], ()) if k in STYLE_DEFINITIONS]
+        if not style_candidates:
+            style_candidates = [{"id": k} for k in STYLE_DEFINITIONS]
+        style_weights = self._recency_weights(style_candidates, recent_styles, "id")
+        style_key = rng.choices(style_candidates, weights=style_weights, k=1)[0]["id"]
+        return seed, style_key
+
+    def seed_brief(self, seed) -> str:
+        beats = "\n".join(f"  - {b}" for b in seed.get("plot_beats", []))
+        return (
+            f"- ジャンル: {seed['genre']}（{seed['genre_description']}）\n"
+            f"- 型: {seed['type']}\n"
+            f"- キーワード: {'、'.join(seed.get('keywords', []))}\n"
+            f"- 主人公像: {seed.get('mc_profile', '')}\n"
+            f"- フック: {seed.get('hook', '')}\n"
+            f"- バズ要因: {seed.get('viral_factor', '')}\n"
+            f"- 想定展開:\n{beats}"
+        )
+
+    def style_brief(self, style_key) -> str:
+        style = self.styles.get(style_key)
+        name = STYLE_DEFINITIONS.get(style_key, {}).get("name", style_key)
+        lines = [f"- style_key: {style_key}（{name}）"]
+        if style:
+            lines.append(f"- 特徴: {style.get('description', '')}")
+        sample = self.samples.get(style_key)
+        if sample:
+            lines.append(f"- 文体サンプル（抜粋）:\n{sample[:200]}")
+        return "\n".join(lines)
+
 # ==========================================
 # 小説プロット＆執筆におけるAIの致命的な欠陥と対策定数
 # ==========================================
@@ -335,12 +906,24 @@ class QualityReport(BaseModel):
     stress_level: int = Field(..., description="読者が感じるストレスレベル(0-100)")
     catharsis_level: int = Field(..., description="読者が感じるカタルシスレベル(0-100)")
     improvement_advice: str = Field(..., description="改善アドバイス")
-    suggested_diff: str = Field(default="", description="具体的な修正済み原稿の差分提案。品質不足と判断した箇所の書き換え案。")
+    suggested_diff: str = Field(default="", description="品質不足と判断した段落の書き換え案。段落番号（[P3] 形式）を付けて箇所ごとに記述する。")
+
+class CriticVerdict(BaseModel):
+    ep_num: int = Field(..., description="採点対象の話数")
+    report: QualityReport
+
+class CriticBatch(BaseModel):
+    verdicts: List[CriticVerdict] = Field(..., description="採点対象エピソードごとの品質レポート")
 
 class MarketingAssets(BaseModel):
     catchcopies: List[str] = Field(..., description="読者を惹きつけるキャッチコピー案（3つ以上）")
     tags: List[str] = Field(..., description="検索用タグ（5つ以上）")
 
+class ForeshadowingEntry(BaseModel):
+    id: str = Field(default="", description="伏線ID (例: F12)")
+    text: str = Field(default="", description="伏線の内容")
+    target_ep: Optional[Union[int, str]] = Field(default=None, description="回収予定話数")
+
 class WorldState(BaseModel):
     # 指令に基づき、settingsのDiff更新を廃止。new_facts (Facts List) 方式に変更。
     # LLMはsettings全体を返すのではなく、新事実のリストのみを返す。
@@ -348,6 +931,8 @@ class WorldState(BaseModel):
     revealed_mysteries: Optional[List[str]] = Field(default=None, description="新たに解明された伏線リスト (Append Only)")
     pending_foreshadowing: Optional[List[str]] = Field(default=None, description="新たに追加された伏線リスト (Append Only)")
     dependency_graph: Optional[str] = Field(default=None, description="JSON mapping of foreshadowing ID to target ep_num (Diff only)")
+    resolved_foreshadowing: Optional[List[str]] = Field(default=None, description="本エピソードで回収した伏線ID (Append Only)")
+    planted_foreshadowing: Optional[List[Union[ForeshadowingEntry, str]]] = Field(default=None, description="本エピソードで設置した伏線 {id, text, target_ep} のリスト (追加分のみ)")
 
 class AnchorResponse(BaseModel):
     ep_num: int = Field(..., description="対象となる話数")
@@ -372,6 +957,23 @@ class WorldBible(BaseModel):
 class PlotBlueprint(BaseModel):
     plots: List[PlotEpisode]
 
+# 【長期連載用モデル定義】 - 企画時はアーク構成のみ、各話プロットはアーク単位で執筆直前に生成
+class ArcOutline(BaseModel):
+    arc_no: int = Field(..., description="アーク番号（1から連番）")
+    title: str
+    start_ep: int = Field(..., description="アークの開始話数")
+    end_ep: int = Field(..., description="アークの終了話数（この話の終了時点がアンカーになる）")
+    synopsis: str = Field(..., description="アークのあらすじ（300文字程度）")
+    climax: str = Field(..., description="アーク終盤の山場")
+
+class SerialBible(WorldBible):
+    anchors: List[AnchorResponse] = Field(default_factory=list, description="長期連載では空配列（アンカーはアーク単位で生成）")
+    arcs: List[ArcOutline] = Field(..., description="全話を分割したアーク構成")
+
+class ArcPlotBlueprint(BaseModel):
+    plots: List[PlotEpisode]
+    end_state: AnchorResponse = Field(..., description="アーク最終話の終了時点の到達状態")
+
 # 統合モデル（既存互換 + anchors追加）
 class NovelStructure(BaseModel):
     title: str
@@ -382,6 +984,8 @@ class NovelStructure(BaseModel):
     plots: List[PlotEpisode]
     marketing_assets: MarketingAssets
     anchors: Optional[List[AnchorResponse]] = None # 追加: 2段階生成で得たアンカーを保持
+    arcs: Optional[List[ArcOutline]] = None        # 長期連載のアーク構成（plots はアーク単位で後から追加）
+    target_eps: int = STANDARD_TARGET_EPS
 
 class EpisodeResponse(BaseModel):
     content: str = Field(..., description="エピソード本文 (2500文字程度)")
@@ -390,11 +994,61 @@ class EpisodeResponse(BaseModel):
     low_quality_reason: Optional[str] = Field(default=None, description="点数が低い場合の理由。")
     next_world_state: WorldState = Field(default_factory=WorldState, description="この話の結果更新された世界状態 (Fact Append)")
 
+class ParagraphEdit(BaseModel):
+    index: int = Field(..., description="対象段落の番号（[P3] なら 3）。改稿前の草稿の番号")
+    action: str = Field(default="replace", description="replace: 差し替え / insert_after: 直後に挿入 / delete: 削除")
+    text: str = Field(default="", description="差し替え後または挿入する段落の本文（段落番号は付けない）。delete では空")
+
+class RevisionResponse(BaseModel):
+    edits: List[ParagraphEdit] = Field(default_factory=list, description="指摘を解消するのに必要な段落だけの修正")
+    summary: Optional[str] = Field(default=None, description="修正で要約が変わる場合のみ、改稿後の要約 (300文字程度)")
+    self_evaluation_score: int = Field(..., description="改稿後のエピソード全体の自己採点 (0-100)")
+    low_quality_reason: Optional[str] = Field(default=None, description="点数が低い場合の理由。")
+
 # TrendSeedは廃止（WorldBibleに統合）
 
 # ==========================================
 # Prompt Manager (ContextBuilder実装)
 # ==========================================
+class CompiledTemplate:
+    """
+    str.format 互換のテンプレートを一度だけ解析しておき、描画時はリテラルと値の連結のみ行う。
+    partial() で一部のフィールドを埋めた派生テンプレートを作れる（埋めた値はリテラル扱いで再解析しない）。
+    """
+    def __init__(self, template: str = "", parts=None):
+        if parts is None:
+            parts = []
+            for literal, field, spec, conv in string.Formatter().parse(template):
+                if field is not None and (spec or conv or not field.isidentifier()):
+                    raise ValueError(f"Unsupported replacement field in template: {{{field}}}")
+                parts.append((literal, field))
+        # 隣接するリテラルを結合
+        merged = []
+        for literal, field in parts:
+            if merged and merged[-1][1] is None:
+                merged[-1] = (merged[-1][0] + literal, field)
+            else:
+                merged.append((literal, field))
+        self.parts = merged
+        self.fields = {f for _, f in merged if f is not None}
+
+    def render(self, values) -> str:
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is not None:
+                out.append(format(values[field]))
+        return "".join(out)
+
+    def partial(self, **values) -> "CompiledTemplate":
+        parts = []
+        for literal, field in self.parts:
+            if field in values:
+                parts.append((literal + format(values[field]), None))
+            else:
+                parts.append((literal, field))
+        return CompiledTemplate(parts=parts)
+
 class PromptManager:
     TEMPLATES = {
         "trend_analysis_prompt": """
@@ -420,8 +1074,8 @@ JSON形式で以下のキーを含めて出力せよ:
         "generate_world_bible": """
 あなたはWeb小説の神級プロットアーキテクト（設定・構成担当）です。
 以下の【2026年2月 Web小説最新トレンド】を分析し、最もヒットする可能性が高い「ジャンル・キーワード・設定」の組み合わせを一つ企画してください。
-そして、その企画に基づき、そのまま「世界観設定（Bible）」と「章ごとのマイルストーン（Anchor）」を一気通貫で作成してください。
-全体の構成は**全50話**です。
+そして、その企画に基づき、そのまま「世界観設定（Bible）」と「{structure_name}」を一気通貫で作成してください。
+全体の構成は**全{total_eps}話**です。
 
 【2026年2月 Web小説最新トレンド（ここから企画を選定せよ）】
 {trend_context}
@@ -434,18 +1088,36 @@ JSON形式で以下のキーを含めて出力せよ:
 - 主人公の設定（Registry）に加え、**物語に深みを与えるサブキャラクター（ヒロイン、ライバル、黒幕など）を3〜5名**作成せよ。
 - 作品のコンセプト、あらすじ、マーケティング要素を定義せよ。
 
-【Task 2: Anchors (Chapter Milestones)】
-物語の整合性を保つため、以下の話数終了時点での「到達状態（あらすじと世界状態）」を確定させよ。
-対象話数: [10, 25, 35, 45, 50]
-※これらは物語の「チェックポイント」となる。特に**第25話**は第一部のクライマックスとして意識すること。
-各Anchorには必ず `ep_num` を含めること。
+{structure_task}
+
+Output strictly in JSON format following this schema:
+{schema}
+""",
+        "generate_world_bible_seeded": """
+あなたはWeb小説の神級プロットアーキテクト（設定・構成担当）です。
+以下の【企画シード】と【文体】は確定済みです（トレンド分析・企画選定は不要）。
+このシードを核に「世界観設定（Bible）」と「{structure_name}」を作成してください。
+全体の構成は**全{total_eps}話**です。
+
+【企画シード（確定）】
+{seed_brief}
+
+【文体（確定）】
+{style_brief}
+
+【Task 1: Settings】
+- genre は「{genre}」、style_key は「{style_key}」をそのまま出力せよ。keywords はシードのキーワードから3つ選べ。
+- 主人公の設定（Registry）はシードの主人公像を具体化し、**サブキャラクター（ヒロイン、ライバル、黒幕など）を3〜5名**作成せよ。
+- シードのフックと想定展開を活かし、タイトル・コンセプト・あらすじ・マーケティング要素を定義せよ。
+
+{structure_task}
 
 Output strictly in JSON format following this schema:
 {schema}
 """,
         "generate_plot_flow": """
 あなたはWeb小説の神級プロットアーキテクト（ストーリー構成担当）です。
-以下の「確定した世界観・マイルストーン」に基づき、スタートからゴールまでを繋ぐ**全50話のプロットフロー**を作成してください。
+以下の「確定した世界観・マイルストーン」に基づき、スタートからゴールまでを繋ぐ**全{total_eps}話のプロットフロー**を作成してください。
 
 【既知の設定とマイルストーン（World Bible）】
 {world_bible_json}
@@ -456,12 +1128,12 @@ Output strictly in JSON format following this schema:
 
 {FATAL_FLAWS_GUIDELINES}
 
-【Task: Plot Flow Generation (Ep 1-50)】
-アンカー（目的地）に矛盾なく到達するように、間のエピソード（1〜50話）のタイトルと**詳細なあらすじ（detailed_blueprint）**を埋めよ。
+【Task: Plot Flow Generation (Ep 1-{total_eps})】
+アンカー（目的地）に矛盾なく到達するように、間のエピソード（1〜{total_eps}話）のタイトルと**詳細なあらすじ（detailed_blueprint）**を埋めよ。
 
 **【重要：出力ルール】**
-1. **省略禁止**: 第1話から第50話まで、**1話も飛ばさずに**全てのプロットを出力せよ。
-2. **連続性**: リストには必ず50個のオブジェクトを含めること（ep_num: 1, 2, 3... 50）。
+1. **省略禁止**: 第1話から第{total_eps}話まで、**1話も飛ばさずに**全てのプロットを出力せよ。
+2. **連続性**: リストには必ず{total_eps}個のオブジェクトを含めること（ep_num: 1, 2, 3... {total_eps}）。
 3. **内容（詳細プロット）**:
    - 執筆担当AIが物語を書きやすいよう、各話 **500文字以上** で記述せよ。
    - 具体的な会話の流れ、情景、アクション、感情の動きを明確に含めること。
@@ -469,6 +1141,68 @@ Output strictly in JSON format following this schema:
 
 Output strictly in JSON format following this schema:
 {schema}
+""",
+        "structure_task_anchors": """【Task 2: Anchors (Chapter Milestones)】
+以下の話数終了時点での「到達状態（あらすじと世界状態）」を確定させよ。
+対象話数: {anchor_eps}
+※特に**第{part_end_ep}話**は第一部のクライマックスとして意識すること。
+各Anchorには必ず `ep_num` を含めること。""",
+        "structure_task_arcs": """【Task 2: Arcs (長期連載のアーク構成)】
+全{total_eps}話を、連続するアーク（{arc_min}〜{arc_max}話程度の章）に分割して構成せよ。
+- 各アークに arc_no（1から連番）、start_ep / end_ep（前のアークの end_ep + 1 から開始し、最後のアークは第{total_eps}話で終わる）、
+  タイトル、あらすじ（300文字程度）、終盤の山場（climax）を定義せよ。
+- 各アークは単体でも読み応えのある起承転結を持ち、終盤の山場で次のアークへの引きを作ること。
+- 各話のプロットは執筆直前にアーク単位で作成するため、ここでは出力しない。anchors は空配列でよい。
+{plot_structure_instruction}
+※上記パターンの話数配分は全50話を想定したもの。比率を保ったまま全{total_eps}話に拡大してアークへ割り当てよ。""",
+        "generate_arc_plot_flow": """
+あなたはWeb小説の神級プロットアーキテクト（ストーリー構成担当）です。
+長期連載（全{total_eps}話）の第{arc_no}アーク「{arc_title}」（第{start_ep}話〜第{end_ep}話）の各話プロットを作成してください。
+
+【作品の基本設定】
+{book_brief}
+
+【これまでのアーク（直近分の要約）】
+{previous_arcs}
+
+【直前の到達状態（第{prev_ep}話終了時点）】
+{prev_state}
+
+【今回のアーク】
+{arc_outline}
+
+【次のアーク（このアークの終わりで引きを作る先）】
+{next_arc}
+
+{FATAL_FLAWS_GUIDELINES}
+
+【Task】
+1. plots: 第{start_ep}話から第{end_ep}話まで、**1話も飛ばさずに** {arc_eps}個のプロットを出力せよ（ep_num: {start_ep}〜{end_ep}）。
+   各話の detailed_blueprint は **500文字以上** で、具体的な会話の流れ、情景、アクション、感情の動きを含めること。
+   アークの終盤（第{end_ep}話付近）に山場を置くこと。
+2. end_state: 第{end_ep}話終了時点の「あらすじ（500文字程度）」と「世界の状態（WorldState）」。ep_num は {end_ep} とせよ。
+   これは次のアークのプロット作成と並列執筆の起点（アンカー）として使用される。
+
+Output strictly in JSON format following this schema:
+{schema}
+""",
+        "story_block_summary": """
+以下はWeb小説「{title}」の第{start_ep}話〜第{end_ep}話の各話要約です。
+この区間で起きた出来事を、因果関係・人物関係の変化・未解決の謎が分かるように{max_chars}文字以内の1段落に要約せよ。
+固有名詞は省略しないこと。前置きや見出しは不要、要約本文のみを出力せよ。
+
+{episode_summaries}
+""",
+        "story_fold_summary": """
+以下はWeb小説「{title}」の「第{story_end_ep}話までのあらすじ」と、その続き（第{start_ep}話〜第{end_ep}話）の要約です。
+両者を統合し、第{end_ep}話までのあらすじを{max_chars}文字以内で書き直せ。
+古い出来事ほど簡潔にし、現在の状況・主要な人物関係・未解決の謎は必ず残すこと。前置きや見出しは不要、本文のみを出力せよ。
+
+【第{story_end_ep}話までのあらすじ】
+{story}
+
+【第{start_ep}話〜第{end_ep}話】
+{block}
 """,
         "anchor_generator": """
 あなたは物語のシミュレーターです。
@@ -492,13 +1226,62 @@ Output strictly in JSON format following this schema:
     "dependency_graph": "{{}}"
   }}
 }}
+""",
+        "critic_batch": """
+あなたはカクヨム編集部の校閲担当（Critic）です。
+以下の完成済みエピソード群を、世界観設定（Bible）との整合性と「引き」の強さの観点から厳しく採点してください。
+
+【World Context】
+{bible_context}
+
+【採点対象エピソード】
+{episodes_text}
+
+【採点ルール】
+1. 各エピソードにつき1つの `report` を作成し、必ず `ep_num` を含めること。
+2. `fatal_errors` には設定矛盾・キャラ崩壊・時系列破綻など、修正必須の問題のみを列挙せよ（軽微な好みは含めない）。
+3. `consistency_score` はBibleとの整合性、`cliffhanger_score` は次話への引きの強さを0-100で評価せよ。
+4. `improvement_advice` には書き直し担当が即座に実行できる具体的な指示を書け。
+5. 本文は段落番号（[P1], [P2], ...）付きで示している。`suggested_diff` には修正が必要な段落だけを「[P番号] 書き換え案」の形式で書け（問題がなければ空文字）。
+
+Output strictly in JSON format following this schema:
+{schema}
+""",
+        "episode_revision": """
+[SYSTEM]
+OUTPUT STRICTLY IN JSON FORMAT.
+
+【ROLE: Revision Editor ({current_model})】
+以下の第{ep_num}話の草稿は品質審査で差し戻された。全文を書き直さず、指摘を解消するのに必要な段落だけを修正せよ。
+
+【差し戻し理由】
+{critique}
+
+{must_resolve_instruction}
+
+【今回の設計図 (Detailed Blueprint)】
+{episode_plot_text}
+
+【草稿（段落番号付き）】
+{numbered_draft}
+
+【改稿ルール】
+1. 修正は `edits` に段落単位で最大{max_edits}件まで。`index` は上の草稿の段落番号（[P3] なら 3）をそのまま使え。
+2. `action` は replace（段落の差し替え）/ insert_after（段落の直後に新しい段落を挿入）/ delete（段落の削除）のいずれか。
+3. `text` には段落番号を付けず本文のみを書け。修正しない段落は出力するな。
+4. 文体・口調・一人称、冒頭の書き出し、結末の「引き」は、指摘がない限り維持せよ。
+5. 設計図にない新キャラ・新設定を追加してはならない。
+6. 改稿後の全体を自己採点して `self_evaluation_score` に記入せよ。`summary` は要約が変わる場合のみ記入せよ。
+
+Output strictly in JSON format following this schema:
+{schema}
 """,
         # テンプレートから断片的なルール変数を削除し、build_writing_promptで動的に構築する形に変更
         "episode_writer_core": """
 [SYSTEM]
 OUTPUT STRICTLY IN JSON FORMAT.
 
-【ROLE: High-Performance Novelist ({current_model})】
+【ROLE: High-Performance Novelist】
 以下の詳細な設計図（Blueprint）に基づき、**Chain of Thought (CoT)** プロセスを用いて最高品質の**第{ep_num}話**を執筆せよ。
 
 【STEP 1: DRAFTING】
@@ -520,6 +1303,10 @@ OUTPUT STRICTLY IN JSON FORMAT.
 
 {must_resolve_instruction}
 
+{retrieved_context}
+
+{story_so_far}
+
 【Bridge Context (前話からの接続・必須)】
 以下の文脈から1秒も時間を飛ばさず、直結するように書き始めよ。
 {prev_context_text}
@@ -544,36 +1331,13 @@ Schema:
   "next_world_state": {{
     "new_facts": ["本エピソードで確定した新しい事実や設定のリスト (Append Only)"],
     "revealed_mysteries": ["新しく解明された謎"],
-    "pending_foreshadowing": ["新しく追加された伏線"],
-    "dependency_graph": "更新された依存グラフJSON文字列"
+    "planted_foreshadowing": [{{"id": "新しく追加した伏線ID (例: F12)", "text": "伏線の内容", "target_ep": 0}}],
+    "resolved_foreshadowing": ["本エピソードで回収した伏線ID"]
   }}
 }}
-"""
-    }
-
-    def get(self, name, **kwargs):
-        if name not in self.TEMPLATES:
-            raise ValueError(f"Template '{name}' not found.")
-        return self.TEMPLATES[name].format(**kwargs)
-
-    def apply_style(self, style_key: str) -> str:
-        """指定されたスタイルのFew-Shot指示文を取得する"""
-        style_def = STYLE_DEFINITIONS.get(style_key, STYLE_DEFINITIONS["style_web_standard"])
-        return f"【Target Style: {style_def['name']}】\n{style_def['instruction']}"
-
-    def build_writing_prompt(self, 
-                             mc_name, mc_tone, pronouns, relations, mc_dialogue_samples, # System Rules params
-                             style_instruction, entity_context, # Context params
-                             pacing_instruction, pacing_graph,
-                             prev_last_sentence=None, # 強制接続用
-                             **kwargs # Template params
-                             ) -> str:
-        """
-        断片的なルールを統合し、最適な順序（Recency Bias考慮）でプロンプトを構築する ContextBuilder。
-        """
-        
-        # 1. System Rules (Hard strict rules)
-        system_rules = f"""# SYSTEM RULES: STRICT ADHERENCE REQUIRED
+""",
+        # build_writing_prompt 用: 書籍単位で不変のシステムルールと最終組み立て順序
+        "writer_system_rules": """# SYSTEM RULES: STRICT ADHERENCE REQUIRED
 【キャラクター・ロック（絶対遵守）】
 以下のキャラクター定義から1ミリでも逸脱してはならない。
 1. **主人公名**: {mc_name}
@@ -626,25 +1390,16 @@ Schema:
 
 【究極の「引き」生成ロジック: Cliffhanger Protocol】
 各エピソードの結末は、文脈に応じて最も効果的な「引き」を自律的に判断し、**「読者が次を読まずにいられない状態」**を強制的に作り出せ。
-"""
-
-        # 強制接続ルールの追加
-        if prev_last_sentence:
-            system_rules = f"""
+""",
+        "writer_lead_rule": """
 【絶対ルール：書き出しの指定】
 書き出しのルール：以下の文から書き始めよ『{prev_last_sentence}』
 ※この文を冒頭に置くことで、前話からの連続性を物理的に維持せよ。
 
-{system_rules}"""
-
-        # 2. Core Template Interpolation
-        base_prompt = self.get("episode_writer_core", **kwargs)
-
-        # 3. Assemble Final Prompt with Recency Bias (Style & Entity at the end)
+""",
         # 構造: [System Rules] -> [Pacing Info] -> [Base Prompt (Blueprint/Context)] -> [Entity/Style Instructions (Recency)]
-        
-        final_prompt = f"""
-{system_rules}
+        "writer_assembly": """
+{lead_rule}{system_rules}
 
 {FATAL_FLAWS_GUIDELINES}
 
@@ -668,12 +1423,116 @@ Gemmaモデルは以下の指示を最優先で実行せよ。
 
 **重要: もし自信がなければ低い点数をつけよ。基準点未満をつけると、自動的にリトライが行われる。**
 """
-        return final_prompt
+    }
+
+    def __init__(self):
+        self._compiled = {}          # テンプレート名 -> CompiledTemplate
+        self._book_fragments = {}    # book_id -> (content_hash, 書籍単位の事前組み立て済みテンプレート)
+
+    def compiled(self, name) -> "CompiledTemplate":
+        tpl = self._compiled.get(name)
+        if tpl is None:
+            if name not in self.TEMPLATES:
+                raise ValueError(f"Template '{name}' not found.")
+            tpl = self._compiled[name] = CompiledTemplate(self.TEMPLATES[name])
+        return tpl
+
+    def get(self, name, **kwargs):
+        started = time.perf_counter()
+        prompt = self.compiled(name).render(kwargs)
+        PROMPT_BUILD.observe(time.perf_counter() - started, template=name)
+        return prompt
+
+    def apply_style(self, style_key: str) -> str:
+        """指定されたスタイルのFew-Shot指示文を取得する"""
+        style_def = STYLE_DEFINITIONS.get(style_key, STYLE_DEFINITIONS["style_web_standard"])
+        return f"【Target Style: {style_def['name']}】\n{style_def['instruction']}"
+
+    def book_fragments(self, book_id, char_registry, sub_registries, style_key) -> "CompiledTemplate":
+        """
+        書籍単位で不変の断片（システムルール・キャラ定義・サブキャラ・文体・FATAL_FLAWS）を埋め込んだ
+        組み立てテンプレートを返す。同一書籍の全レンジで共有し、キャラ定義/文体の内容ハッシュが変われば作り直す。
+        """
+        content_hash = hashlib.sha1(json.dumps(
+            [char_registry.model_dump(), [r.model_dump() for r in sub_registries], style_key],
+            ensure_ascii=False, sort_keys=True
+        ).encode("utf-8")).hexdigest()
+        cached = self._book_fragments.get(book_id)
+        if cached and cached[0] == content_hash:
+            PROMPT_FRAGMENT_CACHE.inc(result="hit")
+            return cached[1]
+        PROMPT_FRAGMENT_CACHE.inc(result="miss")
+
+        system_rules = self.get(
+            "writer_system_rules",
+            mc_name=char_registry.name, mc_tone=char_registry.tone, pronouns=char_registry.pronouns,
+            relations=char_registry.relations, mc_dialogue_samples=char_registry.dialogue_samples
+        )
+        entity_context = char_registry.get_context_prompt()
+        sub_chars_context = "".join(r.get_context_prompt() + "\n" for r in sub_registries)
+        if sub_chars_context:
+            entity_context += "\n【IMPORTANT: SUB CHARACTERS (Must reflect their personalities)】\n" + sub_chars_context
+        fragments = self.compiled("writer_assembly").partial(
+            system_rules=system_rules,
+            FATAL_FLAWS_GUIDELINES=FATAL_FLAWS_GUIDELINES,
+            entity_context=entity_context,
+            style_instruction=self.apply_style(style_key),
+        )
+        self._book_fragments.pop(book_id, None)
+        self._book_fragments[book_id] = (content_hash, fragments)
+        while len(self._book_fragments) > PROMPT_FRAGMENT_CACHE_BOOKS:
+            self._book_fragments.pop(next(iter(self._book_fragments)))
+        return fragments
+
+    def build_writing_prompt(self, fragments: "CompiledTemplate",
+                             pacing_instruction, pacing_graph,
+                             prev_last_sentence=None, # 強制接続用
+                             **kwargs # Template params
+                             ) -> str:
+        """
+        断片的なルールを統合し、最適な順序（Recency Bias考慮）でプロンプトを構築する ContextBuilder。
+        fragments: book_fragments() の書籍単位テンプレート。話ごとに変わる部分だけを差し込む。
+        """
+        started = time.perf_counter()
+        # 強制接続ルール（書き出しの指定）
+        lead_rule = self.compiled("writer_lead_rule").render({"prev_last_sentence": prev_last_sentence}) if prev_last_sentence else ""
+        base_prompt = self.compiled("episode_writer_core").render(kwargs)
+        prompt = fragments.render({
+            "lead_rule": lead_rule,
+            "pacing_graph": pacing_graph,
+            "pacing_instruction": pacing_instruction,
+            "base_prompt": base_prompt,
+        })
+        PROMPT_BUILD.observe(time.perf_counter() - started, template="episode_writer")
+        return prompt
 
 # ==========================================
-# Formatter Class (Regex-based)
+# Formatter Class (Regex-based, Precompiled Single-Pass Engine)
 # ==========================================
 class TextFormatter:
+    """
+    カクヨム向け本文整形エンジン。
+    パターンはクラス定義時に一度だけコンパイルし、正規化ルールを可能な限り同一パスに融合する。
+    出力は従来の逐次パス実装（正規化→空行圧縮→行末整理→Markdown除去→物理整形）と同一。
+    """
+    # 0. チャットアーティファクト
+    _RE_HEAD_ARTIFACT = re.compile(r'^(はい|承知|了解|以下|これ|Here|Sure|Certainly|Okay).*?(\n|$)', re.IGNORECASE | re.MULTILINE)
+    _RE_MD_HEADER = re.compile(r'^\*\*.*?\*\*\n')
+    # 末尾ノイズ: 旧パターン (\n|^)(...).*?$ は「文頭」か「改行直後」でしか一致しないため、
+    # 文頭はmatch、以降は改行始まりのパターンに分けて全位置での ^ 判定を省く
+    _RE_TAIL_ARTIFACT_LEAD = re.compile(r'(?:以上|End|Hope|Do you|いかが|書き終).*?$', re.IGNORECASE | re.MULTILINE)
+    _RE_TAIL_ARTIFACT = re.compile(r'\n(?:以上|End|Hope|Do you|いかが|書き終).*?$', re.IGNORECASE | re.MULTILINE)
+    # 1. 三点リーダー (…の連続と..以上を1パスで……に統一。文字集合が排他なので逐次適用と等価)
+    #    先頭を文字クラスにしてsreの高速スキャンを効かせる
+    _RE_ELLIPSIS = re.compile(r'[….](?:(?<=…)…*|(?<=\.)\.+)')
+    # 2. 感嘆符・疑問符の後のスペース
+    _RE_BANG_SPACE = re.compile(r'([！？])(?![\s　」』])')
+    # 3. 連続する空行
+    _RE_BLANK_RUN = re.compile(r'\n{3,}')
+    # 5. Markdownコードブロック
+    _RE_CODE_BLOCK = re.compile(r'```.*?```', re.DOTALL)
+    _DIALOGUE_OPENERS = ('「', '『', '（')
+
     def __init__(self, engine):
         self.engine = engine # 互換性のために保持するが使用しない
 
@@ -695,79 +1554,99 @@ class TextFormatter:
     def _remove_chat_artifacts(self, text):
         """チャット特有のノイズ（Artifacts）を除去する"""
         # 冒頭のノイズ: "はい、承知しました" "以下が小説です" "Here is the story" 等
-        text = re.sub(r'^(はい|承知|了解|以下|これ|Here|Sure|Certainly|Okay).*?(\n|$)', '', text, flags=re.IGNORECASE | re.MULTILINE).strip()
+        text = self._RE_HEAD_ARTIFACT.sub('', text).strip()
         # Markdownの冒頭ブロック除去
-        text = re.sub(r'^\*\*.*?\*\*\n', '', text).strip()
+        text = self._RE_MD_HEADER.sub('', text).strip()
         
         # 末尾のノイズ: "以上です" "いかがでしたか" "End of episode" 等
-        text = re.sub(r'(\n|^)(以上|End|Hope|Do you|いかが|書き終).*?$', '', text, flags=re.IGNORECASE | re.MULTILINE).strip()
+        lead = self._RE_TAIL_ARTIFACT_LEAD.match(text)
+        if lead:
+            text = text[lead.end():]
+        text = self._RE_TAIL_ARTIFACT.sub('', text).strip()
         
         return text
 
-    def _clean_kakuyomu_style(self, text):
-        """カクヨム向け物理整形: 強制空行挿入"""
-        # 地の文3行以上で強制空行
-        lines = text.split('\n')
+    def _kakuyomu_lines(self, lines, rstrip=False):
+        """カクヨム向け物理整形: 地の文3行以上で強制空行（rstrip=Trueで行末空白除去も同一パスで行う）"""
         formatted_lines = []
+        append = formatted_lines.append
+        openers = self._DIALOGUE_OPENERS
         narrative_count = 0
         
         for line in lines:
-            stripped = line.strip()
+            if rstrip:
+                line = line.rstrip()
+            # 判定は行頭側のみで決まるため strip() ではなく lstrip() で十分
+            stripped = line.lstrip()
             
             # 空行の場合
             if not stripped:
-                formatted_lines.append(line)
+                append(line)
                 narrative_count = 0
                 continue
                 
             # 会話文判定（カギ括弧で始まるか）
-            is_dialogue = stripped.startswith(('「', '『', '（'))
-            
-            if not is_dialogue:
-                narrative_count += 1
-            else:
+            if stripped.startswith(openers):
                 narrative_count = 0 # 会話文でリセット
+            else:
+                narrative_count += 1
             
             # 3行連続した場合、その行の前に空行を入れる（読みやすさのため）
             if narrative_count >= 3:
-                formatted_lines.append('') # 空行挿入
+                append('') # 空行挿入
                 narrative_count = 1 # カウントリセット（この行が新たなブロックの1行目となる）
             
-            formatted_lines.append(line)
+            append(line)
             
-        return "\n".join(formatted_lines)
+        return formatted_lines
 
-    async def format(self, text, k_dict=None):
+    def _clean_kakuyomu_style(self, text):
+        """カクヨム向け物理整形: 強制空行挿入"""
+        return "\n".join(self._kakuyomu_lines(text.split('\n')))
+
+    def format_text(self, text, k_dict=None):
+        """同期版の整形本体（CPU処理のみ。イベントループ外から呼ぶこと）"""
         if not text: return ""
         
-        # 0. チャットアーティファクトの除去 (新規追加)
+        # 0. チャットアーティファクトの除去
         text = self._remove_chat_artifacts(text)
 
-        # 1. 三点リーダーの正規化 (…1つや...を……に)
-        text = re.sub(r'…{1,}', '……', text)
-        text = re.sub(r'\.{2,}', '……', text)
-        # 奇数個の……を偶数個に補正（簡易的）
-        text = text.replace('………', '……') 
+        # 1. 三点リーダーの正規化 (…1つや...を……に) + 奇数個の補正（簡易的）
+        if '…' in text or '..' in text:
+            text = self._RE_ELLIPSIS.sub('……', text)
+            text = text.replace('………', '……')
         
-        # 2. 感嘆符・疑問符の後のスペース挿入
-        # 閉じ括弧の前以外で、全角スペースがない場合に挿入
-        text = re.sub(r'([！？])(?![\s　」』])', r'\1　', text)
+        # 2. 感嘆符・疑問符の後のスペース挿入（閉じ括弧の前以外で、全角スペースがない場合）
+        if '！' in text or '？' in text:
+            text = self._RE_BANG_SPACE.sub(r'\1　', text)
         
         # 3. 連続する空行の削除（最大1行まで）
-        text = re.sub(r'\n{3,}', '\n\n', text)
-        
-        # 4. 行頭・行末の空白削除
-        lines = [line.rstrip() for line in text.splitlines()]
-        text = "\n".join(lines)
-        
-        # 5. 不要なMarkdown削除
-        text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
+        if '\n\n\n' in text:
+            text = self._RE_BLANK_RUN.sub('\n\n', text)
+
+        # 4-6. 行末空白削除 → Markdown削除 → カクヨム物理整形
+        # Markdown記号は行分割・行末整理で生成/消滅しないため、分割前に有無を判定できる
+        if '```' not in text and '**' not in text and '##' not in text:
+            # 高速パス: 行分割1回で行末整理と物理整形を同時に行う
+            return "\n".join(self._kakuyomu_lines(text.splitlines(), rstrip=True)).strip()
+
+        text = "\n".join([line.rstrip() for line in text.splitlines()])
+        text = self._RE_CODE_BLOCK.sub('', text)
         text = text.replace('**', '').replace('##', '')
+        return self._clean_kakuyomu_style(text).strip()
 
-        # 6. カクヨム物理整形
-        text = self._clean_kakuyomu_style(text)
+    def format_many(self, texts, k_dict=None) -> List[str]:
+        """複数本文の一括整形（ブック全体の再整形用）"""
+        format_text = self.format_text
+        return [format_text(t, k_dict) for t in texts]
+
+    async def format(self, text, k_dict=None):
+        """イベントループを塞がないようワーカースレッドで整形する"""
+        if not text: return ""
+        return await asyncio.to_thread(self.format_text, text, k_dict)
 
-        return text.strip()
+    async def aformat_many(self, texts, k_dict=None) -> List[str]:
+        return await asyncio.to_thread(self.format_many, list(texts), k_dict)
 
 # ==========================================
 # 1. データベース管理
@@ -778,15 +1657,39 @@ class DatabaseManager:
     NOTE: Direct usage of this class from business logic is prohibited.
     Use NovelRepository instead.
     """
+    _STOP = object()     # 書き込みスレッドの停止マーカー
+    _FLUSH = object()    # それまでに積まれた書き込みの完了待ちマーカー
+
     def __init__(self, db_path):
         self.db_path = db_path
-        self.queue = asyncio.Queue()
-        self._worker_task = None
+        self.queue = queue.Queue()   # 書き込み要求 (query, params, concurrent.futures.Future)
+        self._writer_thread = None
+        self.fts_enabled = False
 
     async def start(self):
-        self._worker_task = asyncio.create_task(self._worker())
+        """単一の書き込みスレッドを起動する（SQLiteの実行・commit/fsyncはイベントループ外で行う）"""
+        if self._writer_thread and self._writer_thread.is_alive():
+            return
+        self._writer_thread = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer_thread.start()
         await self._init_tables_async()
 
+    async def flush(self):
+        """ここまでに積まれた書き込みがすべてcommitされるまで待つ"""
+        await self._submit(self._FLUSH, None, "FLUSH")
+
+    async def stop(self, timeout: float = 30.0):
+        """キューに残った書き込みを処理し終えてから書き込みスレッドを終了する"""
+        thread = self._writer_thread
+        if not thread or not thread.is_alive():
+            return
+        self.queue.put((self._STOP, None, None))
+        await asyncio.to_thread(thread.join, timeout)
+        if thread.is_alive():
+            print(f"DatabaseManager: writer did not stop within {timeout}s ({self.queue.qsize()} requests pending)")
+        else:
+            self._writer_thread = None
+
     async def _init_tables_async(self):
         await self.execute('''
                 CREATE TABLE IF NOT EXISTS books (
@@ -796,6 +1699,10 @@ class DatabaseManager:
                     status TEXT DEFAULT 'active', created_at TEXT, marketing_data TEXT, sub_plots TEXT
                 );
             ''')
+        # booksテーブル更新: シャード構成時のブック別DBファイル（カタログ側のみ使用）
+        try:
+            await self.execute('ALTER TABLE books ADD COLUMN shard_path TEXT')
+        except: pass
         # Bibleテーブル更新: version追加
         await self.execute('''
                 CREATE TABLE IF NOT EXISTS bible (
@@ -812,6 +1719,10 @@ class DatabaseManager:
         try:
             await self.execute('ALTER TABLE plot ADD COLUMN detailed_blueprint TEXT')
         except: pass
+        # plotテーブル更新: ダッシュボードの差分取得用に updated_at 追加
+        try:
+            await self.execute('ALTER TABLE plot ADD COLUMN updated_at TEXT')
+        except: pass
 
         await self.execute('''
                 CREATE TABLE IF NOT EXISTS plot (
@@ -823,18 +1734,26 @@ class DatabaseManager:
                     cliffhanger_score INTEGER DEFAULT 0,
                     status TEXT DEFAULT 'planned', 
                     setup TEXT, conflict TEXT, climax TEXT, resolution TEXT,
-                    scenes TEXT, detailed_blueprint TEXT,
+                    scenes TEXT, detailed_blueprint TEXT, updated_at TEXT,
                     PRIMARY KEY(book_id, ep_num),
                     FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE
                 );
             ''')
+        # chaptersテーブル更新: Critic採点結果 (consistency_score, cliffhanger_score, fatal_errors, critic_status) と最終更新時刻 追加
+        for col_def in ('consistency_score INTEGER', 'cliffhanger_score INTEGER', 'fatal_errors TEXT', 'critic_status TEXT', 'suggested_diff TEXT', 'updated_at TEXT'):
+            try:
+                await self.execute(f'ALTER TABLE chapters ADD COLUMN {col_def}')
+            except: pass
+
         await self.execute('''
                 CREATE TABLE IF NOT EXISTS chapters (
                     book_id INTEGER, ep_num INTEGER, title TEXT, content TEXT,
                     score_story INTEGER, killer_phrase TEXT, reader_retention_score INTEGER,
                     ending_emotion TEXT, discomfort_score INTEGER DEFAULT 0, tags TEXT,
                     ai_insight TEXT, retention_data TEXT, summary TEXT, world_state TEXT,
-                    created_at TEXT, PRIMARY KEY(book_id, ep_num),
+                    consistency_score INTEGER, cliffhanger_score INTEGER, fatal_errors TEXT,
+                    critic_status TEXT, suggested_diff TEXT,
+                    created_at TEXT, updated_at TEXT, PRIMARY KEY(book_id, ep_num),
                     FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE
                 );
             ''')
@@ -845,9 +1764,121 @@ class DatabaseManager:
                 );
             ''')
         
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS write_ranges (
+                    book_id INTEGER, start_ep INTEGER, end_ep INTEGER, created_at TEXT,
+                    PRIMARY KEY(book_id, start_ep)
+                );
+            ''')
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS api_calls (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, book_id INTEGER, ep_num INTEGER, stage TEXT, model TEXT,
+                    attempt INTEGER, success INTEGER, error TEXT, latency REAL,
+                    prompt_tokens INTEGER DEFAULT 0, candidates_tokens INTEGER DEFAULT 0,
+                    cached_tokens INTEGER DEFAULT 0, thinking_tokens INTEGER DEFAULT 0, total_tokens INTEGER DEFAULT 0,
+                    cost REAL DEFAULT 0, created_at TEXT
+                );
+            ''')
+        # api_callsテーブル更新: 呼び出しに使ったキー（ClientPool の連番）、book_id 確定前の企画サイクルのキー
+        for col_def in ('api_key TEXT', 'planning_key TEXT', 'source_id INTEGER'):
+            try:
+                await self.execute(f'ALTER TABLE api_calls ADD COLUMN {col_def}')
+            except: pass
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS model_outcomes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, book_id INTEGER, ep_num INTEGER, model TEXT,
+                    accepted INTEGER, score INTEGER, latency REAL, cost REAL, created_at TEXT
+                );
+            ''')
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, book_id INTEGER, recipient TEXT, subject TEXT,
+                    attachment_path TEXT, attachment_name TEXT, part_no INTEGER DEFAULT 1, part_total INTEGER DEFAULT 1,
+                    status TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, next_attempt_at REAL DEFAULT 0,
+                    last_error TEXT, created_at TEXT, sent_at TEXT
+                );
+            ''')
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS export_manifest (
+                    book_id INTEGER, target TEXT, path TEXT, content_hash TEXT, exported_at TEXT,
+                    PRIMARY KEY(book_id, target, path)
+                );
+            ''')
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS seed_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, seed_id TEXT, genre TEXT, style_key TEXT, created_at TEXT
+                );
+            ''')
+        # 伏線台帳 (bible.dependency_graph のJSONを置き換え。1伏線1行で回収状況まで追跡)
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS foreshadowing (
+                    book_id INTEGER, fs_id TEXT, text TEXT, planted_ep INTEGER, target_ep INTEGER,
+                    status TEXT DEFAULT 'open', resolved_ep INTEGER, updated_at TEXT,
+                    PRIMARY KEY(book_id, fs_id)
+                );
+            ''')
+        
+        # 長期連載のアーク構成 (status: planned → plotted。plotted で各話プロットとアンカーが保存済み)
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS arcs (
+                    book_id INTEGER, arc_no INTEGER, title TEXT, start_ep INTEGER, end_ep INTEGER,
+                    synopsis TEXT, climax TEXT, status TEXT DEFAULT 'planned', updated_at TEXT,
+                    PRIMARY KEY(book_id, arc_no)
+                );
+            ''')
+        # 階層ローリング要約 (level: block = ブロック/アーク要約, story = 第1話〜end_ep の全体あらすじ)
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS story_summaries (
+                    book_id INTEGER, level TEXT, start_ep INTEGER, end_ep INTEGER, summary TEXT, source_hash TEXT, updated_at TEXT,
+                    PRIMARY KEY(book_id, level, start_ep, end_ep)
+                );
+            ''')
+        # ジョブキュー (カタログに置き、複数ワーカープロセスでリースを取り合う)
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, job_key TEXT UNIQUE, kind TEXT, book_id INTEGER, payload TEXT,
+                    status TEXT DEFAULT 'pending', priority INTEGER DEFAULT 0,
+                    attempts INTEGER DEFAULT 0, max_attempts INTEGER DEFAULT 3, run_after REAL DEFAULT 0,
+                    lease_owner TEXT, lease_token TEXT, lease_expires_at REAL, heartbeat_at REAL,
+                    last_error TEXT, created_at TEXT, finished_at TEXT
+                );
+            ''')
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS job_deps (
+                    job_key TEXT, depends_on TEXT,
+                    PRIMARY KEY(job_key, depends_on)
+                );
+            ''')
+        # バッチ投入の記録 (カタログ。status: submitted → completed / failed)
+        await self.execute('''
+                CREATE TABLE IF NOT EXISTS batches (
+                    batch_id TEXT PRIMARY KEY, mode TEXT, model TEXT, provider_name TEXT, file_path TEXT,
+                    request_count INTEGER, ok_count INTEGER DEFAULT 0, error_count INTEGER DEFAULT 0,
+                    status TEXT DEFAULT 'submitted', error TEXT, created_at TEXT, finished_at TEXT
+                );
+            ''')
+        
         # インデックスの作成
         await self.execute('CREATE INDEX IF NOT EXISTS idx_plot_book_ep ON plot(book_id, ep_num);')
         await self.execute('CREATE INDEX IF NOT EXISTS idx_chapters_book_ep ON chapters(book_id, ep_num);')
+        await self.execute('CREATE INDEX IF NOT EXISTS idx_model_outcomes_book_model ON model_outcomes(book_id, model);')
+        await self.execute('CREATE INDEX IF NOT EXISTS idx_api_calls_book_stage ON api_calls(book_id, stage);')
+        # シャードへ移したカタログ行の元ID（移し直しても重複しない）
+        await self.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_api_calls_source ON api_calls(source_id) WHERE source_id IS NOT NULL;')
+        await self.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at);')
+        await self.execute('CREATE INDEX IF NOT EXISTS idx_foreshadowing_target ON foreshadowing(book_id, target_ep);')
+        await self.execute('CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(status, run_after);')
+
+        # 過去話検索用の全文索引（FTS5/trigram 非対応のSQLiteでは検索なしで動作）
+        try:
+            await self.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS passages_fts USING fts5(
+                        book_id UNINDEXED, ep_num UNINDEXED, kind UNINDEXED, body, tokenize='trigram'
+                    );
+                ''')
+            self.fts_enabled = True
+        except sqlite3.OperationalError as e:
+            print(f"FTS5 unavailable, passage retrieval disabled: {e}")
 
     def _convert_params(self, params):
         new_params = []
@@ -860,12 +1891,32 @@ class DatabaseManager:
                 new_params.append(p)
         return tuple(new_params)
 
+    async def _submit(self, query, params, op):
+        """書き込みスレッドへ要求を渡し、結果をイベントループ側のFutureとして待つ"""
+        if not self._writer_thread or not self._writer_thread.is_alive():
+            raise RuntimeError("DatabaseManager writer is not running (call start() first)")
+        started = time.monotonic()
+        with tracer.span("db.queue", op=op, queue_depth=self.queue.qsize()):
+            future = concurrent.futures.Future()
+            self.queue.put((query, params, future))
+            DB_QUEUE_DEPTH.set(self.queue.qsize())
+            try:
+                return await asyncio.wrap_future(future)
+            finally:
+                DB_QUEUE_LATENCY.observe(time.monotonic() - started, op=op)
+
     async def execute(self, query, params=()):
         # パラメータの自動JSON変換
         converted_params = self._convert_params(params)
-        future = asyncio.get_running_loop().create_future()
-        await self.queue.put((query, converted_params, future))
-        return await future
+        return await self._submit(query, converted_params, query.split(None, 1)[0].upper())
+
+    async def execute_batch(self, statements):
+        """
+        複数の書き込みを1トランザクションで実行する。
+        statements: [(query, [params, ...]), ...]（各クエリは executemany で実行）
+        """
+        batch = [(q, [self._convert_params(p) for p in rows]) for q, rows in statements]
+        return await self._submit(batch, None, "BATCH")
 
     async def save_model(self, query, params):
         """PydanticモデルやDictを自動的にJSON文字列に変換して保存する"""
@@ -887,25 +1938,45 @@ class DatabaseManager:
         # 行全体を辞書として渡す
         return model_class.model_validate(dict(row))
 
-    async def _worker(self):
+    def _writer_loop(self):
+        """書き込みスレッド本体。接続はこのスレッド専用で、要求を到着順に1件ずつ実行する"""
         conn = sqlite3.connect(self.db_path, check_same_thread=False)
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA journal_mode=WAL;")
         conn.execute("PRAGMA foreign_keys = ON;") # 外部キー制約の有効化
-        while True:
-            query, params, future = await self.queue.get()
-            try:
-                is_write = query.strip().upper().startswith(("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER"))
-                cursor = conn.execute(query, params)
-                if is_write:
-                    conn.commit()
-                    future.set_result(cursor.lastrowid)
-                else:
-                    future.set_result(None) 
-            except Exception as e:
-                future.set_exception(e)
-            finally:
-                self.queue.task_done()
+        try:
+            while True:
+                query, params, future = self.queue.get()
+                DB_QUEUE_DEPTH.set(self.queue.qsize())
+                if query is self._STOP:
+                    break
+                if not future.set_running_or_notify_cancel(): # 待ち手がキャンセル済み
+                    continue
+                try:
+                    if query is self._FLUSH:
+                        future.set_result(None)
+                        continue
+                    if isinstance(query, list): # execute_batch
+                        try:
+                            for q, rows in query:
+                                conn.executemany(q, rows)
+                            conn.commit()
+                        except Exception:
+                            conn.rollback()
+                            raise
+                        future.set_result(None)
+                        continue
+                    is_write = query.strip().upper().startswith(("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER"))
+                    cursor = conn.execute(query, params)
+                    if is_write:
+                        conn.commit()
+                        future.set_result(cursor.lastrowid)
+                    else:
+                        future.set_result(None)
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            conn.close()
 
     async def fetch_all(self, query, params=()):
         def _fetch():
@@ -924,9 +1995,97 @@ class DatabaseManager:
                 return dict(row) if row else None
         return await asyncio.to_thread(_fetch)
 
-db = DatabaseManager(DB_FILE)
+    # --- NovelRepository のルーティング用（単一ファイル構成ではカタログも全ブックも同じDB） ---
+    @property
+    def catalog(self):
+        return self
 
-# ==========================================
+    async def for_book(self, book_id: int):
+        return self
+
+    async def close_book(self, book_id: int, timeout: float = 30.0):
+        pass   # 単一ファイル構成ではブック単位に閉じるものがない
+
+    def book_path(self, book_id: int) -> str:
+        return self.db_path
+
+    def backup_to(self, dest_path, book_id: int = None):
+        """オンラインバックアップAPIで一貫したスナップショットを作成（WAL書き込み中でも安全）。同期処理なのでスレッドから呼ぶ"""
+        src = sqlite3.connect(self.db_path, check_same_thread=False)
+        dst = sqlite3.connect(dest_path)
+        try:
+            src.backup(dst) # pages=-1: 1ステップで全ページをコピー（読み取りトランザクション内で完結）
+        finally:
+            dst.close()
+            src.close()
+
+class ShardedStorage:
+    """
+    ブックごとに1つのSQLiteファイル（SHARD_DIR/book_{id}.db）と、横断データ用のカタログDB（DB_FILE）に分けた構成。
+    カタログ: books（ID採番・一覧・ステータス）、seed_history、outbox、model_outcomes、book_id確定前のapi_calls。
+    シャード: そのブックの本文・プロット・Bible・伏線台帳・索引・api_callsなど。
+    シャードごとに独立した DatabaseManager（書き込みスレッド・WAL）を持つため、並行するブック同士が書き込みロックを奪い合わない。
+    """
+    def __init__(self, catalog_path, shard_dir):
+        self.catalog = DatabaseManager(catalog_path)
+        self.shard_dir = shard_dir
+        self._shards = {}
+        self._opening = {}
+
+    @property
+    def fts_enabled(self):
+        return self.catalog.fts_enabled
+
+    def book_path(self, book_id: int) -> str:
+        return os.path.join(self.shard_dir, f"book_{book_id}.db")
+
+    async def start(self):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        await self.catalog.start()
+
+    async def for_book(self, book_id: int) -> DatabaseManager:
+        """ブックのシャードを返す（初回アクセス時に書き込みスレッドを起動しテーブルを作成）"""
+        shard = self._shards.get(book_id)
+        if shard is not None:
+            return shard
+        opening = self._opening.get(book_id)
+        if opening is None: # 同時に初回アクセスしたコルーチンは同じ起動処理を待つ
+            opening = self._opening[book_id] = asyncio.ensure_future(self._open(book_id))
+        return await asyncio.shield(opening)
+
+    async def _open(self, book_id: int) -> DatabaseManager:
+        try:
+            shard = DatabaseManager(self.book_path(book_id))
+            await shard.start()
+            self._shards[book_id] = shard
+            return shard
+        finally:
+            self._opening.pop(book_id, None)
+
+    def backup_to(self, dest_path, book_id: int = None):
+        """book_id 指定時はそのブックのシャード、未指定ならカタログのスナップショットを作成"""
+        if book_id is None:
+            return self.catalog.backup_to(dest_path)
+        shard = self._shards.get(book_id) or DatabaseManager(self.book_path(book_id))
+        return shard.backup_to(dest_path)
+
+    async def close_book(self, book_id: int, timeout: float = 30.0):
+        """書き上げたブックのシャードを閉じる（書き込みスレッドと接続を解放）。以後のアクセスでは開き直す"""
+        shard = self._shards.pop(book_id, None)
+        if shard is not None:
+            await shard.stop(timeout)
+
+    async def flush(self):
+        await asyncio.gather(self.catalog.flush(), *(s.flush() for s in list(self._shards.values())))
+
+    async def stop(self, timeout: float = 30.0):
+        await asyncio.gather(*(s.stop(timeout) for s in list(self._shards.values())))
+        self._shards.clear()
+        await self.catalog.stop(timeout)
+
+db = ShardedStorage(DB_FILE, SHARD_DIR) if STORAGE_MODE == "sharded" else DatabaseManager(DB_FILE)
+
+# ==========================================
 # Repository Pattern (指令により強化)
 # ==========================================
 class NovelRepository:
@@ -949,28 +2108,36 @@ class NovelRepository:
         
         marketing_data_model = data.marketing_assets if isinstance(data, BaseModel) else MarketingAssets.model_validate(data_dict['marketing_assets'])
 
-        # target_eps を 50 に設定 (50話プロットに対応)
-        bid = await self.db.save_model(
+        book_row = (
+            data_dict['title'], 
+            genre, 
+            data_dict['synopsis'], 
+            data_dict['concept'], 
+            data_dict.get('target_eps') or STANDARD_TARGET_EPS,
+            dna, 
+            'active', 
+            ability_val, 
+            datetime.datetime.now().isoformat(),
+            marketing_data_model
+        )
+        # IDはカタログで採番（単一ファイル構成ではカタログ = 本体）
+        bid = await self.db.catalog.save_model(
             "INSERT INTO books (title, genre, synopsis, concept, target_eps, style_dna, status, special_ability, created_at, marketing_data) VALUES (?,?,?,?,?,?,?,?,?,?)",
-            (
-                data_dict['title'], 
-                genre, 
-                data_dict['synopsis'], 
-                data_dict['concept'], 
-                50, # Changed to 50
-                dna, 
-                'active', 
-                ability_val, 
-                datetime.datetime.now().isoformat(),
-                marketing_data_model
-            )
+            book_row
         )
+        shard = await self.db.for_book(bid)
+        if shard is not self.db.catalog:
+            await shard.save_model(
+                "INSERT INTO books (id, title, genre, synopsis, concept, target_eps, style_dna, status, special_ability, created_at, marketing_data) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                (bid, *book_row)
+            )
+            await self.db.catalog.save_model("UPDATE books SET shard_path=? WHERE id=?", (self.db.book_path(bid), bid))
         
         # 主人公保存
         registry_json = json.dumps(data_dict['mc_profile'], ensure_ascii=False)
         monologue_val = data_dict['mc_profile'].get('monologue_style', '')
         
-        await self.db.save_model("INSERT INTO characters (book_id, name, role, registry_data, monologue_style) VALUES (?,?,?,?,?)", 
+        await shard.save_model("INSERT INTO characters (book_id, name, role, registry_data, monologue_style) VALUES (?,?,?,?,?)", 
                           (bid, data_dict['mc_profile']['name'], '主人公', registry_json, monologue_val))
         
         # サブキャラクター保存
@@ -980,10 +2147,10 @@ class NovelRepository:
             char_dict = char.model_dump() if isinstance(char, BaseModel) else char
             c_reg_json = json.dumps(char_dict, ensure_ascii=False)
             c_mono = char_dict.get('monologue_style', '')
-            await self.db.save_model("INSERT INTO characters (book_id, name, role, registry_data, monologue_style) VALUES (?,?,?,?,?)", 
+            await shard.save_model("INSERT INTO characters (book_id, name, role, registry_data, monologue_style) VALUES (?,?,?,?,?)", 
                               (bid, char_dict['name'], char_dict['role'], c_reg_json, c_mono))
 
-        await self.db.save_model("INSERT INTO bible (book_id, settings, revealed, revealed_mysteries, pending_foreshadowing, dependency_graph, version, last_updated) VALUES (?,?,?,?,?,?,?,?)",
+        await shard.save_model("INSERT INTO bible (book_id, settings, revealed, revealed_mysteries, pending_foreshadowing, dependency_graph, version, last_updated) VALUES (?,?,?,?,?,?,?,?)",
                              (bid, "{}", [], [], [], "{}", 0, datetime.datetime.now().isoformat()))
 
         saved_plots = []
@@ -992,29 +2159,35 @@ class NovelRepository:
             main_ev = f"{p.get('setup','')}->{p.get('climax','')}"
             scenes_list = p.get('scenes', []) 
             
-            await self.db.save_model(
-                """INSERT INTO plot (book_id, ep_num, title, main_event, setup, conflict, climax, resolution, tension, stress, catharsis, status, scenes, detailed_blueprint)
-                   VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            await shard.save_model(
+                """INSERT INTO plot (book_id, ep_num, title, main_event, setup, conflict, climax, resolution, tension, stress, catharsis, status, scenes, detailed_blueprint, updated_at)
+                   VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
                 (bid, p['ep_num'], full_title, main_ev, 
                  p.get('setup'), p.get('conflict'), p.get('climax'), p.get('next_hook'),
-                 p.get('tension', 50), p.get('stress', 0), p.get('catharsis', 0), 'planned', scenes_list, p.get('detailed_blueprint', ''))
+                 p.get('tension', 50), p.get('stress', 0), p.get('catharsis', 0), 'planned', scenes_list, p.get('detailed_blueprint', ''),
+                 datetime.datetime.now().isoformat())
             )
             saved_plots.append(p)
+        if data_dict.get('arcs'):
+            await self.save_arcs(bid, data_dict['arcs'])
         return bid, saved_plots
 
     async def add_plots(self, book_id, data_p2):
+        """追加プロットを保存（アーク単位の生成をやり直した場合は同じ話数を上書き）"""
+        shard = await self.db.for_book(book_id)
         saved_plots = []
         for p in data_p2['plots']:
             full_title = f"第{p['ep_num']}話 {p['title']}"
             main_ev = f"{p.get('setup','')}->{p.get('climax','')}"
             scenes_list = p.get('scenes', [])
             
-            await self.db.save_model(
-                """INSERT INTO plot (book_id, ep_num, title, main_event, setup, conflict, climax, resolution, tension, stress, catharsis, status, scenes, detailed_blueprint)
-                   VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            await shard.save_model(
+                """INSERT OR REPLACE INTO plot (book_id, ep_num, title, main_event, setup, conflict, climax, resolution, tension, stress, catharsis, status, scenes, detailed_blueprint, updated_at)
+                   VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
                 (book_id, p['ep_num'], full_title, main_ev, 
                  p.get('setup'), p.get('conflict'), p.get('climax'), p.get('next_hook'), 
-                 p.get('tension', 50), p.get('stress', 0), p.get('catharsis', 0), 'planned', scenes_list, p.get('detailed_blueprint', ''))
+                 p.get('tension', 50), p.get('stress', 0), p.get('catharsis', 0), 'planned', scenes_list, p.get('detailed_blueprint', ''),
+                 datetime.datetime.now().isoformat())
             )
             saved_plots.append(p)
         return saved_plots
@@ -1022,11 +2195,13 @@ class NovelRepository:
     # --- Bible / Chapter / Plot CRUD (Consolidated from Scattered Calls) ---
     async def get_bible_latest(self, book_id: int):
         """最新のBibleレコードを取得"""
-        return await self.db.fetch_one("SELECT * FROM bible WHERE book_id=? ORDER BY id DESC LIMIT 1", (book_id,))
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_one("SELECT * FROM bible WHERE book_id=? ORDER BY id DESC LIMIT 1", (book_id,))
 
     async def save_bible_node(self, book_id: int, settings, revealed, mysteries, foreshadowing, graph, version):
         """Bibleの新規バージョンを保存"""
-        return await self.db.save_model(
+        shard = await self.db.for_book(book_id)
+        return await shard.save_model(
             "INSERT INTO bible (book_id, settings, revealed, revealed_mysteries, pending_foreshadowing, dependency_graph, version, last_updated) VALUES (?,?,?,?,?,?,?,?)",
             (
                 book_id, settings, revealed, mysteries, foreshadowing, graph, version, datetime.datetime.now().isoformat()
@@ -1035,55 +2210,685 @@ class NovelRepository:
 
     async def save_chapter(self, book_id: int, ep_num: int, title: str, content: str, summary: str, world_state: str):
         """チャプターを保存（アンカーや生成結果）"""
-        return await self.db.save_model(
-            """INSERT OR REPLACE INTO chapters (book_id, ep_num, title, content, summary, ai_insight, world_state, created_at)
-               VALUES (?,?,?,?,?,?,?,?)""",
-            (book_id, ep_num, title, content, summary, '', world_state, datetime.datetime.now().isoformat())
+        shard = await self.db.for_book(book_id)
+        now = datetime.datetime.now().isoformat()
+        rowid = await shard.save_model(
+            """INSERT OR REPLACE INTO chapters (book_id, ep_num, title, content, summary, ai_insight, world_state, created_at, updated_at)
+               VALUES (?,?,?,?,?,?,?,?,?)""",
+            (book_id, ep_num, title, content, summary, '', world_state, now, now)
+        )
+        if shard.fts_enabled and not title.startswith("ANCHOR_EP_"):
+            await self.index_chapter_passages(book_id, ep_num, content, summary, world_state)
+        return rowid
+
+    async def index_chapter_passages(self, book_id: int, ep_num: int, content: str, summary: str, world_state):
+        """チャプターの本文抜粋・要約・新規事実を全文索引に登録（同じ話の既存分は置き換え）"""
+        shard = await self.db.for_book(book_id)
+        facts = []
+        try:
+            ws = json.loads(world_state) if isinstance(world_state, str) else (world_state or {})
+            facts = [str(f) for f in ws.get('new_facts', []) if f]
+        except: pass
+        passages = [('summary', summary)] if summary else []
+        passages += [('content', c) for c in PassageRetriever.chunk_content(content or "")]
+        passages += [('fact', f) for f in facts]
+
+        base = book_id * PASSAGE_BOOK_STRIDE + ep_num * 1000
+        rows = [(base + i, book_id, ep_num, kind, body) for i, (kind, body) in enumerate(passages[:1000])]
+        await shard.execute_batch([
+            ("DELETE FROM passages_fts WHERE rowid BETWEEN ? AND ?", [(base, base + 999)]),
+            ("INSERT INTO passages_fts (rowid, book_id, ep_num, kind, body) VALUES (?,?,?,?,?)", rows),
+        ])
+
+    async def search_passages(self, book_id: int, terms: List[str], before_ep: int, limit: int):
+        """
+        検索語のいずれかを含む抜粋をbm25順に取得（before_ep 未満の話のみ）
+        trigram 索引で引けない3文字未満の語は、同じ rowid 範囲を LIKE で走査して残り枠を埋める。
+        """
+        if not terms or before_ep < 1:
+            return []
+        shard = await self.db.for_book(book_id)
+        lo = book_id * PASSAGE_BOOK_STRIDE
+        hi = lo + before_ep * 1000 - 1
+        long_terms = [t for t in terms if len(t) >= 3]
+        short_terms = [t for t in terms if len(t) < 3]
+        rows = []
+        if long_terms:
+            match = " OR ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+            rows = await shard.fetch_all(
+                """SELECT rowid, ep_num, kind, body FROM passages_fts
+                   WHERE passages_fts MATCH ? AND rowid BETWEEN ? AND ?
+                   ORDER BY bm25(passages_fts) LIMIT ?""",
+                (match, lo, hi, limit)
+            )
+        if short_terms and len(rows) < limit:
+            seen = [r['rowid'] for r in rows]
+            like = " OR ".join("body LIKE ? ESCAPE '\\'" for _ in short_terms)
+            params = ['%' + t.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for t in short_terms]
+            exclude = f" AND rowid NOT IN ({','.join('?' * len(seen))})" if seen else ""
+            rows += await shard.fetch_all(
+                f"""SELECT rowid, ep_num, kind, body FROM passages_fts
+                    WHERE rowid BETWEEN ? AND ? AND ({like}){exclude}
+                    ORDER BY rowid DESC LIMIT ?""",
+                (lo, hi, *params, *seen, limit - len(rows))
+            )
+        return rows
+
+    async def apply_foreshadowing(self, book_id: int, ep_num: int, planted, resolved):
+        """
+        伏線台帳への一括反映（1トランザクション）。
+        planted: [(fs_id, text, target_ep), ...]  既存IDは回収予定話数のみ更新（初出話数・本文は保持）
+        resolved: [IDまたは本文, ...]  未回収のものを ep_num で回収済みにする
+        """
+        shard = await self.db.for_book(book_id)
+        now = datetime.datetime.now().isoformat()
+        await shard.execute_batch([
+            (
+                """INSERT INTO foreshadowing (book_id, fs_id, text, planted_ep, target_ep, status, updated_at)
+                   VALUES (?,?,?,?,?,'open',?)
+                   ON CONFLICT(book_id, fs_id) DO UPDATE SET
+                       target_ep=COALESCE(excluded.target_ep, foreshadowing.target_ep), updated_at=excluded.updated_at""",
+                [(book_id, fs_id, text, ep_num, target_ep, now) for fs_id, text, target_ep in planted]
+            ),
+            (
+                "UPDATE foreshadowing SET status='resolved', resolved_ep=?, updated_at=? WHERE book_id=? AND status='open' AND (fs_id=? OR text=?)",
+                [(ep_num, now, book_id, r, r) for r in resolved]
+            ),
+        ])
+
+    async def get_due_foreshadowing(self, book_id: int, ep_num: int):
+        """ep_num で回収予定の未回収伏線（idx_foreshadowing_target による索引検索）"""
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all(
+            "SELECT fs_id, text, planted_ep, target_ep FROM foreshadowing WHERE book_id=? AND target_ep=? AND status='open' ORDER BY planted_ep",
+            (book_id, ep_num)
+        )
+
+    async def get_open_foreshadowing(self, book_id: int):
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all(
+            "SELECT fs_id, text, planted_ep, target_ep FROM foreshadowing WHERE book_id=? AND status='open' ORDER BY planted_ep, fs_id",
+            (book_id,)
+        )
+
+    async def get_overdue_foreshadowing(self, book_id: int, through_ep: int):
+        """回収予定話数を過ぎても未回収の伏線"""
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all(
+            "SELECT fs_id, text, planted_ep, target_ep FROM foreshadowing WHERE book_id=? AND target_ep < ? AND status='open' ORDER BY target_ep",
+            (book_id, through_ep + 1)
         )
 
     async def check_chapter_exists(self, book_id: int, ep_num: int):
         """指定したエピソードのチャプターが存在するか確認"""
-        return await self.db.fetch_one("SELECT book_id FROM chapters WHERE book_id=? AND ep_num=?", (book_id, ep_num))
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_one("SELECT book_id FROM chapters WHERE book_id=? AND ep_num=?", (book_id, ep_num))
 
     async def update_plot_status(self, book_id: int, ep_num: int, status: str):
         """プロットのステータスを更新"""
-        await self.db.save_model("UPDATE plot SET status=? WHERE book_id=? AND ep_num=?", (status, book_id, ep_num))
+        shard = await self.db.for_book(book_id)
+        await shard.save_model("UPDATE plot SET status=?, updated_at=? WHERE book_id=? AND ep_num=?", (status, datetime.datetime.now().isoformat(), book_id, ep_num))
+
+    async def record_write_ranges(self, book_id: int, ranges):
+        """並列執筆レンジの割り当てを記録（ダッシュボードのクリティカルパス/停滞検知用）"""
+        shard = await self.db.for_book(book_id)
+        now = datetime.datetime.now().isoformat()
+        for s, e in ranges:
+            await shard.save_model(
+                "INSERT OR REPLACE INTO write_ranges (book_id, start_ep, end_ep, created_at) VALUES (?,?,?,?)",
+                (book_id, s, e, now)
+            )
+
+    async def enqueue_outbox(self, book_id: int, recipient: str, subject: str, parts) -> List[int]:
+        """送信待ちメールを登録。parts: [(添付パス, 添付名), ...]（分割時は1パート1通）"""
+        now = datetime.datetime.now().isoformat()
+        ids = []
+        for i, (path, name) in enumerate(parts, 1):
+            part_subject = subject if len(parts) == 1 else f"{subject} [{i}/{len(parts)}]"
+            ids.append(await self.db.catalog.save_model(
+                "INSERT INTO outbox (book_id, recipient, subject, attachment_path, attachment_name, part_no, part_total, created_at) VALUES (?,?,?,?,?,?,?,?)",
+                (book_id, recipient, part_subject, path, name, i, len(parts), now)
+            ))
+        return ids
+
+    async def get_due_outbox(self, now: float):
+        return await self.db.catalog.fetch_one(
+            "SELECT * FROM outbox WHERE status='pending' AND next_attempt_at <= ? ORDER BY id LIMIT 1", (now,)
+        )
+
+    async def get_next_outbox_due(self):
+        row = await self.db.catalog.fetch_one("SELECT MIN(next_attempt_at) AS due FROM outbox WHERE status='pending'")
+        return row['due'] if row else None
+
+    async def mark_outbox(self, outbox_id: int, status: str, attempts: int, next_attempt_at: float = 0, error: str = None):
+        """送信結果の記録。status: pending(再試行待ち) / sent / failed"""
+        sent_at = datetime.datetime.now().isoformat() if status == 'sent' else None
+        await self.db.catalog.save_model(
+            "UPDATE outbox SET status=?, attempts=?, next_attempt_at=?, last_error=?, sent_at=? WHERE id=?",
+            (status, attempts, next_attempt_at, error, sent_at, outbox_id)
+        )
+
+    async def record_seed_use(self, seed_id: str, genre: str, style_key: str):
+        await self.db.catalog.save_model(
+            "INSERT INTO seed_history (seed_id, genre, style_key, created_at) VALUES (?,?,?,?)",
+            (seed_id, genre, style_key, datetime.datetime.now().isoformat())
+        )
+
+    async def get_recent_seed_uses(self, limit: int):
+        """企画シードの使用履歴（新しい順）"""
+        return await self.db.catalog.fetch_all("SELECT seed_id, genre, style_key FROM seed_history ORDER BY id DESC LIMIT ?", (limit,))
+
+    # --- Job Queue (カタログ) ---
+    async def enqueue_jobs(self, jobs):
+        """
+        ジョブと依存関係を1トランザクションで登録する（job_key が既存のものは無視 = 冪等）。
+        jobs: [{'job_key', 'kind', 'book_id', 'payload', 'depends_on': [job_key, ...], 'priority'}, ...]
+        """
+        now = datetime.datetime.now().isoformat()
+        await self.db.catalog.execute_batch([
+            (
+                "INSERT OR IGNORE INTO jobs (job_key, kind, book_id, payload, priority, max_attempts, created_at) VALUES (?,?,?,?,?,?,?)",
+                [(j['job_key'], j['kind'], j.get('book_id'), j.get('payload') or {}, j.get('priority', 0), j.get('max_attempts', JOB_MAX_ATTEMPTS), now) for j in jobs]
+            ),
+            (
+                "INSERT OR IGNORE INTO job_deps (job_key, depends_on) VALUES (?,?)",
+                [(j['job_key'], dep) for j in jobs for dep in j.get('depends_on', ())]
+            ),
+        ])
+
+    async def get_claimable_jobs(self, now: float, limit: int):
+        """実行可能なジョブ（待機中で依存先がすべて完了、またはリース切れ）を優先度順に取得"""
+        return await self.db.catalog.fetch_all('''
+            SELECT * FROM jobs j
+            WHERE ((j.status='pending' AND j.run_after <= ?) OR (j.status='running' AND j.lease_expires_at < ?))
+              AND j.attempts < j.max_attempts
+              AND NOT EXISTS (
+                  SELECT 1 FROM job_deps d JOIN jobs p ON p.job_key = d.depends_on
+                  WHERE d.job_key = j.job_key AND p.status != 'done'
+              )
+            ORDER BY j.priority DESC, j.id LIMIT ?
+        ''', (now, now, limit))
+
+    async def try_lease_job(self, job_id: int, owner: str, token: str, now: float, lease: float):
+        """
+        楽観ロックによるリース取得。他プロセスが先に取得していれば何も更新されない。
+        候補を選んでから更新までの間に状態が変わることがあるので、実行可能時刻と依存ジョブの完了もここで確かめ直す。
+        更新の成否は lease_token を読み直して確認する（戻り値: 取得したジョブ行 or None）
+        """
+        await self.db.catalog.save_model(
+            '''UPDATE jobs SET status='running', attempts=attempts+1, lease_owner=?, lease_token=?, lease_expires_at=?, heartbeat_at=?
+               WHERE id=? AND attempts < max_attempts
+                 AND ((status='pending' AND run_after <= ?) OR (status='running' AND lease_expires_at < ?))
+                 AND NOT EXISTS (
+                     SELECT 1 FROM job_deps d JOIN jobs p ON p.job_key = d.depends_on
+                     WHERE d.job_key = jobs.job_key AND p.status != 'done'
+                 )''',
+            (owner, token, now + lease, now, job_id, now, now)
+        )
+        return await self.db.catalog.fetch_one("SELECT * FROM jobs WHERE id=? AND lease_token=?", (job_id, token))
+
+    async def set_job_book(self, job_id: int, token: str, book_id: int):
+        """ジョブが作成したブックを記録（再実行時は作り直さずにこのブックから再開する）"""
+        await self.db.catalog.save_model("UPDATE jobs SET book_id=? WHERE id=? AND lease_token=?", (book_id, job_id, token))
+
+    async def heartbeat_job(self, job_id: int, token: str, now: float, lease: float) -> bool:
+        """リースを延長する。他ワーカーに再取得されていた場合は False"""
+        await self.db.catalog.save_model(
+            "UPDATE jobs SET lease_expires_at=?, heartbeat_at=? WHERE id=? AND lease_token=? AND status='running'",
+            (now + lease, now, job_id, token)
+        )
+        return bool(await self.db.catalog.fetch_one("SELECT 1 FROM jobs WHERE id=? AND lease_token=? AND status='running'", (job_id, token)))
+
+    async def requeue_job(self, job_id: int, token: str, reason: str):
+        """試行回数に数えずに待機中へ戻す（実行期限による中断。次回の実行で続きから再開する）"""
+        await self.db.catalog.save_model(
+            '''UPDATE jobs SET status='pending', attempts=MAX(0, attempts-1), run_after=0, last_error=?, lease_token=NULL, lease_expires_at=NULL
+               WHERE id=? AND lease_token=?''',
+            (reason, job_id, token)
+        )
+
+    async def finish_job(self, job_id: int, token: str, error: str = None, retry_at: float = 0):
+        """完了（error=None）または失敗を記録。失敗は試行回数が残っていれば retry_at 以降に再実行"""
+        if error is None:
+            await self.db.catalog.save_model(
+                "UPDATE jobs SET status='done', lease_token=NULL, lease_expires_at=NULL, finished_at=? WHERE id=? AND lease_token=?",
+                (datetime.datetime.now().isoformat(), job_id, token)
+            )
+            return
+        await self.db.catalog.save_model(
+            '''UPDATE jobs SET status=CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                   run_after=?, last_error=?, lease_token=NULL, lease_expires_at=NULL
+               WHERE id=? AND lease_token=?''',
+            (retry_at, error, job_id, token)
+        )
+
+    async def reap_jobs(self, now: float):
+        """リース切れのまま試行回数を使い切ったジョブと、依存先が失敗したジョブを failed にする"""
+        await self.db.catalog.execute_batch([
+            (
+                "UPDATE jobs SET status='failed', last_error=COALESCE(last_error, 'lease expired') WHERE status='running' AND lease_expires_at < ? AND attempts >= max_attempts",
+                [(now,)]
+            ),
+            (
+                '''UPDATE jobs SET status='failed', last_error='dependency failed'
+                   WHERE status='pending' AND EXISTS (
+                       SELECT 1 FROM job_deps d JOIN jobs p ON p.job_key = d.depends_on
+                       WHERE d.job_key = jobs.job_key AND p.status = 'failed'
+                   )''',
+                [()]
+            ),
+        ])
+
+    async def get_job_summary(self):
+        return await self.db.catalog.fetch_all("SELECT kind, status, COUNT(*) AS n FROM jobs GROUP BY kind, status ORDER BY kind, status")
+
+    async def get_active_jobs(self):
+        """実行中・失敗ジョブの一覧（jobs コマンド表示用）"""
+        return await self.db.catalog.fetch_all(
+            "SELECT id, job_key, status, attempts, max_attempts, lease_owner, lease_expires_at, last_error FROM jobs WHERE status IN ('running', 'failed') ORDER BY id"
+        )
+
+    async def save_batch(self, batch_id: str, mode: str, model: str, request_count: int, file_path: str):
+        await self.db.catalog.save_model(
+            "INSERT INTO batches (batch_id, mode, model, file_path, request_count, created_at) VALUES (?,?,?,?,?,?)",
+            (batch_id, mode, model, file_path, request_count, datetime.datetime.now().isoformat())
+        )
+
+    async def update_batch_provider(self, batch_id: str, provider_name: str):
+        await self.db.catalog.save_model("UPDATE batches SET provider_name=? WHERE batch_id=?", (provider_name, batch_id))
+
+    async def finish_batch(self, batch_id: str, status: str, ok_count: int, error_count: int, error: Optional[str] = None):
+        await self.db.catalog.save_model(
+            "UPDATE batches SET status=?, ok_count=?, error_count=?, error=?, finished_at=? WHERE batch_id=?",
+            (status, ok_count, error_count, error, datetime.datetime.now().isoformat(), batch_id)
+        )
+
+    async def get_batch_summary(self):
+        return await self.db.catalog.fetch_all(
+            "SELECT mode, status, COUNT(*) AS n, SUM(request_count) AS requests FROM batches GROUP BY mode, status ORDER BY mode, status"
+        )
+
+    async def get_export_manifest(self, book_id: int, target: str) -> Dict[str, str]:
+        """前回エクスポート時の {ZIP内パス: content_hash}"""
+        shard = await self.db.for_book(book_id)
+        rows = await shard.fetch_all("SELECT path, content_hash FROM export_manifest WHERE book_id=? AND target=?", (book_id, target))
+        return {r['path']: r['content_hash'] for r in rows}
+
+    async def update_export_manifest(self, book_id: int, target: str, changed: Dict[str, str], removed: List[str]):
+        shard = await self.db.for_book(book_id)
+        now = datetime.datetime.now().isoformat()
+        for path, digest in changed.items():
+            await shard.save_model(
+                "INSERT OR REPLACE INTO export_manifest (book_id, target, path, content_hash, exported_at) VALUES (?,?,?,?,?)",
+                (book_id, target, path, digest, now)
+            )
+        for path in removed:
+            await shard.save_model("DELETE FROM export_manifest WHERE book_id=? AND target=? AND path=?", (book_id, target, path))
+
+    async def save_critic_report(self, book_id: int, ep_num: int, report: QualityReport, critic_status: str):
+        """Criticの採点結果をチャプターに記録"""
+        shard = await self.db.for_book(book_id)
+        await shard.save_model(
+            "UPDATE chapters SET consistency_score=?, cliffhanger_score=?, fatal_errors=?, ai_insight=?, suggested_diff=?, critic_status=?, updated_at=? WHERE book_id=? AND ep_num=?",
+            (report.consistency_score, report.cliffhanger_score, report.fatal_errors, report.improvement_advice, report.suggested_diff, critic_status,
+             datetime.datetime.now().isoformat(), book_id, ep_num)
+        )
+
+    async def record_model_outcome(self, book_id: int, ep_num: int, model: str, accepted: bool, score: int, latency: float, cost: float):
+        """執筆試行1回分のモデル別成績（品質ゲート通過可否・レイテンシ・コスト）を記録"""
+        await self.db.catalog.save_model(
+            "INSERT INTO model_outcomes (book_id, ep_num, model, accepted, score, latency, cost, created_at) VALUES (?,?,?,?,?,?,?,?)",
+            (book_id, ep_num, model, 1 if accepted else 0, score, latency, cost, datetime.datetime.now().isoformat())
+        )
+
+    async def record_api_call(self, book_id, ep_num, stage: str, model: str, attempt: int, success: bool, error: Optional[str], latency: float, usage: Dict[str, int], cost: float, api_key: Optional[str] = None):
+        """APIレスポンス1件分のトークン使用量・レイテンシを記録（book_id確定前は企画サイクルのキーを付けてカタログへ）"""
+        target = await self.db.for_book(book_id) if book_id is not None else self.db.catalog
+        planning_key = _planning_key.get() if book_id is None else None
+        await target.save_model(
+            """INSERT INTO api_calls (book_id, ep_num, stage, model, attempt, success, error, latency,
+                                      prompt_tokens, candidates_tokens, cached_tokens, thinking_tokens, total_tokens, cost, created_at, api_key, planning_key)
+               VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            (book_id, ep_num, stage, model, attempt, 1 if success else 0, error, latency,
+             usage.get('prompt', 0), usage.get('candidates', 0), usage.get('cached', 0), usage.get('thinking', 0), usage.get('total', 0),
+             cost, datetime.datetime.now().isoformat(), api_key, planning_key)
+        )
+
+    async def claim_unassigned_api_calls(self, book_id: int, planning_key: str):
+        """
+        book_id確定前（企画・プロット生成）に記録したAPIコールのうち、planning_key が一致するものだけを指定ブックに紐付ける。
+        失敗した企画サイクルや他プロセスの企画中のコールは未割当のまま残る
+        """
+        shard = await self.db.for_book(book_id)
+        if shard is self.db.catalog:
+            await shard.save_model("UPDATE api_calls SET book_id=? WHERE book_id IS NULL AND planning_key=?", (book_id, planning_key))
+            return
+        # シャード構成: カタログの該当分をブックのシャードへ移す。元IDを source_id に残して INSERT OR IGNORE し、
+        # シャードに入ったことを確認できた行だけカタログから消す（途中で落ちても再実行で重複・欠落しない）
+        rows = await self.db.catalog.fetch_all("SELECT * FROM api_calls WHERE book_id IS NULL AND planning_key=? ORDER BY id", (planning_key,))
+        if not rows:
+            return
+        cols = [c for c in rows[0] if c not in ('id', 'source_id')] + ['source_id']
+        await shard.execute_batch([(
+            f"INSERT OR IGNORE INTO api_calls ({', '.join(cols)}) VALUES ({','.join('?' * len(cols))})",
+            [tuple(book_id if c == 'book_id' else r['id'] if c == 'source_id' else r[c] for c in cols) for r in rows]
+        )])
+        ids = [r['id'] for r in rows]
+        moved = await shard.fetch_all(f"SELECT source_id FROM api_calls WHERE source_id IN ({','.join('?' * len(ids))})", tuple(ids))
+        if moved:
+            await self.db.catalog.execute_batch([("DELETE FROM api_calls WHERE id=?", [(r['source_id'],) for r in moved])])
+
+    async def set_book_status(self, book_id: int, status: str):
+        """ブックのステータス（active / completed など）をカタログとシャードの両方に反映"""
+        shard = await self.db.for_book(book_id)
+        await self.db.catalog.save_model("UPDATE books SET status=? WHERE id=?", (status, book_id))
+        if shard is not self.db.catalog:
+            await shard.save_model("UPDATE books SET status=? WHERE id=?", (status, book_id))
 
     # --- Read / Fetch Methods ---
     async def get_book(self, book_id: int):
-        return await self.db.fetch_one("SELECT * FROM books WHERE id=?", (book_id,))
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_one("SELECT * FROM books WHERE id=?", (book_id,))
 
     async def get_plots(self, book_id: int):
-        return await self.db.fetch_all("SELECT * FROM plot WHERE book_id=? ORDER BY ep_num", (book_id,))
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all("SELECT * FROM plot WHERE book_id=? ORDER BY ep_num", (book_id,))
+
+    async def get_plots_between(self, book_id: int, start_ep: int, end_ep: int):
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all("SELECT * FROM plot WHERE book_id=? AND ep_num BETWEEN ? AND ? ORDER BY ep_num", (book_id, start_ep, end_ep))
+
+    async def save_arcs(self, book_id: int, arcs):
+        """アーク構成を保存。arcs: ArcOutline またはその辞書のリスト"""
+        shard = await self.db.for_book(book_id)
+        now = datetime.datetime.now().isoformat()
+        rows = []
+        for a in arcs:
+            a = a.model_dump() if isinstance(a, BaseModel) else a
+            rows.append((book_id, a['arc_no'], a['title'], a['start_ep'], a['end_ep'], a.get('synopsis', ''), a.get('climax', ''), now))
+        await shard.execute_batch([(
+            "INSERT OR REPLACE INTO arcs (book_id, arc_no, title, start_ep, end_ep, synopsis, climax, status, updated_at) VALUES (?,?,?,?,?,?,?,'planned',?)",
+            rows
+        )])
+
+    async def get_arcs(self, book_id: int):
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all("SELECT * FROM arcs WHERE book_id=? ORDER BY arc_no", (book_id,))
+
+    async def update_arc_status(self, book_id: int, arc_no: int, status: str):
+        shard = await self.db.for_book(book_id)
+        await shard.save_model(
+            "UPDATE arcs SET status=?, updated_at=? WHERE book_id=? AND arc_no=?",
+            (status, datetime.datetime.now().isoformat(), book_id, arc_no)
+        )
+
+    async def get_episode_summaries(self, book_id: int, start_ep: int, end_ep: int, include_errors: bool = False):
+        """執筆済みの話の要約（アンカーを除く。include_errors=False ならエラー話も除く）"""
+        shard = await self.db.for_book(book_id)
+        error_filter = "" if include_errors else " AND summary != 'エラー'"
+        return await shard.fetch_all(
+            f"SELECT ep_num, summary FROM chapters WHERE book_id=? AND ep_num BETWEEN ? AND ? AND title NOT LIKE 'ANCHOR_EP_%'{error_filter} ORDER BY ep_num",
+            (book_id, start_ep, end_ep)
+        )
+
+    async def save_story_summary(self, book_id: int, level: str, start_ep: int, end_ep: int, summary: str, source_hash: str):
+        shard = await self.db.for_book(book_id)
+        await shard.save_model(
+            "INSERT OR REPLACE INTO story_summaries (book_id, level, start_ep, end_ep, summary, source_hash, updated_at) VALUES (?,?,?,?,?,?,?)",
+            (book_id, level, start_ep, end_ep, summary, source_hash, datetime.datetime.now().isoformat())
+        )
+
+    async def get_story_summaries(self, book_id: int, level: str, before_ep: int, limit: int):
+        """end_ep が before_ep 未満の要約を新しい順に取得"""
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all(
+            "SELECT start_ep, end_ep, summary, source_hash FROM story_summaries WHERE book_id=? AND level=? AND end_ep < ? ORDER BY end_ep DESC LIMIT ?",
+            (book_id, level, before_ep, limit)
+        )
 
     async def get_characters(self, book_id: int):
-        return await self.db.fetch_all("SELECT * FROM characters WHERE book_id=?", (book_id,))
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all("SELECT * FROM characters WHERE book_id=?", (book_id,))
     
     async def get_main_character(self, book_id: int):
-        return await self.db.fetch_one("SELECT * FROM characters WHERE book_id=? AND role='主人公'", (book_id,))
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_one("SELECT * FROM characters WHERE book_id=? AND role='主人公'", (book_id,))
 
     async def get_chapters(self, book_id: int):
-        return await self.db.fetch_all("SELECT * FROM chapters WHERE book_id=? ORDER BY ep_num", (book_id,))
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all("SELECT * FROM chapters WHERE book_id=? ORDER BY ep_num", (book_id,))
+
+    async def get_chapter(self, book_id: int, ep_num: int):
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_one("SELECT * FROM chapters WHERE book_id=? AND ep_num=?", (book_id, ep_num))
+
+    async def get_chapters_for_review(self, book_id: int, ep_nums: List[int]):
+        """Critic採点用に指定話数のチャプター本文を取得（アンカー・エラー行は除外）"""
+        shard = await self.db.for_book(book_id)
+        if not ep_nums: return []
+        placeholders = ",".join("?" * len(ep_nums))
+        return await shard.fetch_all(
+            f"SELECT ep_num, title, content, summary FROM chapters WHERE book_id=? AND ep_num IN ({placeholders}) AND title NOT LIKE 'ANCHOR_EP_%' AND summary != 'エラー' ORDER BY ep_num",
+            (book_id, *ep_nums)
+        )
+
+    async def get_flagged_chapters(self, book_id: int, start_ep: int, end_ep: int):
+        """Criticに差し戻されたチャプター（リワーク待ち）を取得"""
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all(
+            "SELECT ep_num, fatal_errors, ai_insight, suggested_diff, consistency_score, cliffhanger_score FROM chapters WHERE book_id=? AND ep_num BETWEEN ? AND ? AND critic_status='flagged' ORDER BY ep_num",
+            (book_id, start_ep, end_ep)
+        )
+
+    async def mark_critic_error(self, book_id: int, ep_num: int):
+        """採点できなかったチャプターを critic_status='error' にする（未採点のまま放置しない）"""
+        shard = await self.db.for_book(book_id)
+        await shard.save_model("UPDATE chapters SET critic_status='error', updated_at=? WHERE book_id=? AND ep_num=?", (datetime.datetime.now().isoformat(), book_id, ep_num))
+
+    async def get_model_stats(self, window: int = 500):
+        """直近window試行におけるモデル別の採用率・平均レイテンシ・平均コスト"""
+        return await self.db.catalog.fetch_all(
+            """SELECT model, COUNT(*) AS attempts, AVG(accepted) AS accept_rate, AVG(latency) AS avg_latency, AVG(cost) AS avg_cost
+               FROM (SELECT * FROM model_outcomes ORDER BY id DESC LIMIT ?) GROUP BY model""",
+            (window,)
+        )
+
+    async def count_model_accepts(self, book_id: int, model: str):
+        """指定モデルで品質ゲートを通過した話数"""
+        row = await self.db.catalog.fetch_one(
+            "SELECT COUNT(DISTINCT ep_num) AS cnt FROM model_outcomes WHERE book_id=? AND model=? AND accepted=1",
+            (book_id, model)
+        )
+        return row['cnt'] if row else 0
+
+    API_USAGE_SUMMARY_SQL = """SELECT stage, model, CASE WHEN attempt = 1 THEN 'first' ELSE 'retry' END AS attempt_kind,
+                      COUNT(*) AS calls, SUM(1 - success) AS errors,
+                      SUM(prompt_tokens) AS prompt_tokens, SUM(candidates_tokens) AS candidates_tokens,
+                      SUM(cached_tokens) AS cached_tokens, SUM(thinking_tokens) AS thinking_tokens,
+                      SUM(cost) AS cost, SUM(latency) AS latency
+               FROM api_calls WHERE book_id=? GROUP BY stage, model, attempt_kind ORDER BY stage, model, attempt_kind"""
+
+    async def get_api_usage_summary(self, book_id: int):
+        """ステージ別・初回/リトライ別のトークン使用量とコストの集計"""
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all(self.API_USAGE_SUMMARY_SQL, (book_id,))
+
+    FORESHADOWING_LEDGER_SQL = """SELECT fs_id, text, planted_ep, target_ep, status, resolved_ep
+               FROM foreshadowing WHERE book_id=? ORDER BY COALESCE(target_ep, planted_ep), planted_ep, fs_id"""
+
+    async def get_foreshadowing_ledger(self, book_id: int):
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all(self.FORESHADOWING_LEDGER_SQL, (book_id,))
 
     async def get_latest_chapter(self, book_id: int, ep_num: int):
         """指定エピソードの直前のチャプターを取得"""
-        return await self.db.fetch_one("SELECT content, summary, world_state FROM chapters WHERE book_id=? AND ep_num=? ORDER BY ep_num DESC LIMIT 1", (book_id, ep_num - 1))
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_one("SELECT content, summary, world_state FROM chapters WHERE book_id=? AND ep_num=? ORDER BY ep_num DESC LIMIT 1", (book_id, ep_num - 1))
 
     async def get_recent_plot_metrics(self, book_id: int, current_ep: int, limit: int = 5):
         """直近のエピソードのストレス/カタルシス指標を取得"""
-        return await self.db.fetch_all(
+        shard = await self.db.for_book(book_id)
+        return await shard.fetch_all(
             "SELECT ep_num, stress, catharsis FROM plot WHERE book_id=? AND ep_num < ? ORDER BY ep_num DESC LIMIT ?",
             (book_id, current_ep, limit)
         )
     
     async def save_error_chapter(self, book_id: int, ep_num: int, title: str, reason: str):
         """エラー時のチャプターレコードを保存"""
-        await self.db.save_model(
-             """INSERT OR REPLACE INTO chapters (book_id, ep_num, title, content, summary, ai_insight, world_state, created_at)
-                VALUES (?,?,?,?,?,?,?,?)""",
-             (book_id, ep_num, title, f"（生成エラー：{reason}）", "エラー", '', json.dumps({}, ensure_ascii=False), datetime.datetime.now().isoformat())
+        shard = await self.db.for_book(book_id)
+        now = datetime.datetime.now().isoformat()
+        await shard.save_model(
+             """INSERT OR REPLACE INTO chapters (book_id, ep_num, title, content, summary, ai_insight, world_state, created_at, updated_at)
+                VALUES (?,?,?,?,?,?,?,?,?)""",
+             (book_id, ep_num, title, f"（生成エラー：{reason}）", "エラー", '', json.dumps({}, ensure_ascii=False), now, now)
         )
 
+# ==========================================
+# 2a. Fact Store (近似重複の集約・出典付き確定事実リスト)
+# ==========================================
+class FactStore:
+    """
+    bible.revealed に保存する確定事実の集合。
+    追加順と出典話数を保持し、言い回しだけ違う同一事実を文字n-gram MinHash/LSHで1件に集約する。
+    保存形式: [{"text": str, "ep": 初出話数, "eps": [言及した話数...]}, ...]（旧形式の文字列リストも読み込み可）
+    """
+    _NORMALIZE = re.compile(r'[\s、。・,，.．!！?？「」『』（）()【】\[\]"\'…ー〜~]+')
+    _MASK = (1 << 61) - 1   # メルセンヌ素数（ハッシュ置換の法）
+    _loaded = {}            # book_id -> (bible行id, FactStore)。同じ版の再ロードで署名を作り直さない
+
+    def __init__(self, num_perm=FACT_MINHASH_PERM, bands=FACT_LSH_BANDS, threshold=FACT_DUP_THRESHOLD, containment=FACT_DUP_CONTAINMENT):
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.containment = containment
+        rng = random.Random(FACT_MINHASH_SEED) # 起動ごとに同じ置換を使う
+        self._perms = [(rng.randrange(1, self._MASK), rng.randrange(0, self._MASK)) for _ in range(num_perm)]
+        self.facts = []
+        self._shingles = []
+        self._buckets = {}
+
+    @classmethod
+    def load(cls, raw):
+        """DB値（JSON文字列 / list）から復元。旧形式の文字列要素は出典なしとして取り込む"""
+        if isinstance(raw, str):
+            try: raw = json.loads(raw) if raw else []
+            except json.JSONDecodeError: raw = []
+        facts = []
+        for item in raw or []:
+            if isinstance(item, dict) and item.get("text"):
+                facts.append({"text": item["text"], "ep": item.get("ep"), "eps": list(item.get("eps") or ([item["ep"]] if item.get("ep") else []))})
+            elif isinstance(item, str) and item.strip():
+                facts.append({"text": item, "ep": None, "eps": []})
+        store = cls()
+        for f in facts:
+            dup = store._find_duplicate(store._shingle(f["text"])) # 旧データ内の重複もここで畳む
+            if dup is None:
+                store._append(f)
+            else:
+                store.facts[dup]["eps"].extend(e for e in f["eps"] if e not in store.facts[dup]["eps"])
+        return store
+
+    @classmethod
+    def load_for_book(cls, book_id, row):
+        """bible 行から復元。同じ行の復元結果は使い回し、呼び出し側が変更してよい複製を返す"""
+        hit = cls._loaded.get(book_id)
+        if hit is None or hit[0] != row['id']:
+            hit = (row['id'], cls.load(row['revealed']))
+            cls._loaded[book_id] = hit
+        return hit[1].copy()
+
+    def copy(self):
+        """署名・バケットを再計算せずに複製（シングル集合は変更しないので共有）"""
+        other = object.__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        other.facts = [dict(f, eps=list(f["eps"])) for f in self.facts]
+        other._shingles = list(self._shingles)
+        other._buckets = {k: list(v) for k, v in self._buckets.items()}
+        return other
+
+    def _shingle(self, text):
+        norm = self._NORMALIZE.sub("", unicodedata.normalize("NFKC", str(text))).lower()
+        n = FACT_SHINGLE_SIZE
+        if len(norm) <= n:
+            return {norm}
+        return {norm[i:i + n] for i in range(len(norm) - n + 1)}
+
+    def _signature(self, shingles):
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in shingles]
+        return [min((a * h + b) & self._MASK for h in hashes) for a, b in self._perms]
+
+    def _band_keys(self, signature):
+        r = self.rows
+        return [(i, tuple(signature[i * r:(i + 1) * r])) for i in range(self.bands)]
+
+    def _find_duplicate(self, shingles):
+        """LSHで候補を絞り、Jaccard係数と包含率で確認。重複先のインデックスを返す"""
+        candidates = set()
+        for key in self._band_keys(self._signature(shingles)):
+            candidates.update(self._buckets.get(key, ()))
+        best, best_sim = None, self.threshold
+        for idx in sorted(candidates):
+            other = self._shingles[idx]
+            common = len(shingles & other)
+            sim = common / len(shingles | other)
+            if sim >= best_sim and common / min(len(shingles), len(other)) >= self.containment:
+                best, best_sim = idx, sim
+        return best
+
+    def _append(self, fact):
+        shingles = self._shingle(fact["text"])
+        idx = len(self.facts)
+        self.facts.append(fact)
+        self._shingles.append(shingles)
+        for key in self._band_keys(self._signature(shingles)):
+            self._buckets.setdefault(key, []).append(idx)
+
+    def find(self, text) -> Optional[int]:
+        """近似重複とみなす既存事実のインデックス（なければ None）"""
+        return self._find_duplicate(self._shingle(str(text).strip()))
+
+    def add(self, text, ep=None) -> bool:
+        """新規事実なら追加してTrue。近似重複なら出典話数だけ記録してFalse"""
+        text = str(text).strip()
+        if not text:
+            return False
+        dup = self.find(text)
+        if dup is not None:
+            eps = self.facts[dup]["eps"]
+            if ep is not None and ep not in eps:
+                eps.append(ep)
+            return False
+        self._append({"text": text, "ep": ep, "eps": [ep] if ep is not None else []})
+        return True
+
+    def add_many(self, texts, ep=None) -> int:
+        return sum(1 for t in texts if self.add(t, ep))
+
+    def to_list(self):
+        return [dict(f) for f in self.facts]
+
+    def __len__(self):
+        return len(self.facts)
+
+    def render(self, recent: Optional[int] = None) -> str:
+        """プロンプト用の簡潔な表記（話数ごとに1行）。recent 指定時は直近の事実のみ"""
+        facts = self.facts[-recent:] if recent else self.facts
+        lines, current_ep, bucket = [], object(), []
+        for f in facts:
+            if f["ep"] != current_ep and bucket:
+                lines.append(self._render_line(current_ep, bucket))
+                bucket = []
+            current_ep = f["ep"]
+            bucket.append(f["text"])
+        if bucket:
+            lines.append(self._render_line(current_ep, bucket))
+        return "\n".join(lines) if lines else "(なし)"
+
+    @staticmethod
+    def _render_line(ep, texts):
+        return f"- Ep{ep}: " + " / ".join(texts) if ep is not None else "- " + " / ".join(texts)
+
 # ==========================================
 # 2. Dynamic Bible Manager (Optimistic Locking)
 # ==========================================
@@ -1101,6 +2906,8 @@ class DynamicBibleManager:
         row = await self.repo.get_bible_latest(self.book_id)
         if not row:
             state = WorldState(new_facts=[], revealed_mysteries=[], pending_foreshadowing=[], dependency_graph="{}")
+            self._current_settings = "{}"
+            self._current_revealed = FactStore()
             return state, 0
         try:
             state = WorldState(
@@ -1111,23 +2918,24 @@ class DynamicBibleManager:
             )
             # 便宜上、設定データなどは内部保持しておく（プロンプト生成用）
             self._current_settings = row['settings'] if row['settings'] else "{}"
-            self._current_revealed = json.loads(row['revealed']) if row['revealed'] else []
+            self._current_revealed = FactStore.load_for_book(self.book_id, row)
             return state, row.get('version', 0)
         except:
             state = WorldState(new_facts=[], revealed_mysteries=[], pending_foreshadowing=[], dependency_graph="{}")
             self._current_settings = "{}"
-            self._current_revealed = []
+            self._current_revealed = FactStore()
             return state, 0
 
-    async def get_prompt_context(self) -> str:
+    async def get_prompt_context(self, recent_facts: Optional[int] = None) -> str:
+        """recent_facts 指定時は確定事実を直近分のみに絞る（古い事実は PassageRetriever で補う）"""
         state, ver = await self.get_current_state()
         return f"""
 【WORLD STATE (Current v{ver})】
 [SETTINGS]: {self._current_settings}
-[REVEALED FACTS]: {json.dumps(self._current_revealed, ensure_ascii=False)}
+[REVEALED FACTS]:
+{self._current_revealed.render(recent=recent_facts)}
 [SOLVED MYSTERIES]: {json.dumps(state.revealed_mysteries, ensure_ascii=False)}
 [PENDING FORESHADOWING (FOR FUTURE USE ONLY)]: {json.dumps(state.pending_foreshadowing, ensure_ascii=False)}
-[DEPENDENCY GRAPH (Resolution Plan)]: {state.dependency_graph}
 """
 
 class BibleSynchronizer:
@@ -1135,12 +2943,27 @@ class BibleSynchronizer:
         self.book_id = book_id
         self.bible_manager = DynamicBibleManager(book_id)
         self.repo = NovelRepository(db)
+        self.ledger = ForeshadowingLedger(self.repo)
 
-    async def save_atomic(self, chapter_data: Dict[str, Any], next_state: WorldState):
+    async def save_atomic(self, chapter_data: Dict[str, Any], next_state: WorldState, from_saved: bool = False):
         """
         本文生成と同時にBibleとChapterをアトミックに更新する。
         Fact Append 方式に対応。Python側で安全にマージを行う。
+        from_saved=True（保存済み本文のパッチ改稿）: 本文は整形済みなので Formatter を通さず（非冪等のため）、
+        next_state も保存済みのものなので Bible・伏線台帳へは再マージしない。
         """
+        if from_saved:
+            await self.repo.save_chapter(
+                self.book_id,
+                chapter_data['ep_num'],
+                chapter_data.get('title', f"第{chapter_data['ep_num']}話"),
+                chapter_data['content'],
+                chapter_data.get('summary', ''),
+                json.dumps(next_state.model_dump(), ensure_ascii=False) if hasattr(next_state, 'model_dump') else json.dumps(next_state, ensure_ascii=False)
+            )
+            await self.repo.update_plot_status(self.book_id, chapter_data['ep_num'], 'completed')
+            return (await self.bible_manager.get_current_state())[1]
+
         # 1. 現在のBible状態を取得 (ロード)
         current_state_obj, current_ver = await self.bible_manager.get_current_state()
         
@@ -1148,41 +2971,31 @@ class BibleSynchronizer:
         row = await self.repo.get_bible_latest(self.book_id)
         if row:
             curr_settings_str = row['settings']
-            curr_revealed = json.loads(row['revealed']) if row['revealed'] else []
+            curr_revealed = FactStore.load_for_book(self.book_id, row)
             curr_mysteries = json.loads(row['revealed_mysteries']) if row.get('revealed_mysteries') else []
             curr_foreshadowing = json.loads(row['pending_foreshadowing']) if row.get('pending_foreshadowing') else []
-            curr_dep_graph_str = row['dependency_graph'] if row['dependency_graph'] else "{}"
+            legacy_graph = row['dependency_graph'] # 旧形式のJSONは初回保存時に台帳へ移行
         else:
             curr_settings_str = "{}"
-            curr_revealed = []
+            curr_revealed = FactStore()
             curr_mysteries = []
             curr_foreshadowing = []
-            curr_dep_graph_str = "{}"
+            legacy_graph = None
 
         # 2. Bible状態のマージ (Append Only Logic)
         
-        # Facts: next_state.new_facts を existing revealed list に追加
-        new_facts_list = next_state.new_facts or []
-        updated_revealed = list(set(curr_revealed + new_facts_list)) # 重複排除しつつマージ
-
-        # Mysteries & Foreshadowing: 単純追加
-        updated_mysteries = list(set(curr_mysteries + (next_state.revealed_mysteries or [])))
-        updated_foreshadowing = list(set(curr_foreshadowing + (next_state.pending_foreshadowing or [])))
+        # Facts: next_state.new_facts を追加順・出典話数付きで追記（言い換えの近似重複は集約）
+        curr_revealed.add_many(next_state.new_facts or [], ep=chapter_data['ep_num'])
+        updated_revealed = curr_revealed.to_list()
+
+        # Mysteries & Foreshadowing: 順序を保ったまま完全一致のみ重複排除
+        updated_mysteries = list(dict.fromkeys(curr_mysteries + (next_state.revealed_mysteries or [])))
+        planted_texts = [e if isinstance(e, str) else (e.text or e.id) for e in next_state.planted_foreshadowing or []]
+        updated_foreshadowing = list(dict.fromkeys(curr_foreshadowing + (next_state.pending_foreshadowing or []) + [t for t in planted_texts if t]))
         
         # Settings: 指令によりLLMに書き換えさせない。
         merged_settings = curr_settings_str 
 
-        # Dependency Graph (Merge)
-        merged_graph = curr_dep_graph_str
-        if next_state.dependency_graph:
-            try:
-                curr_dep = json.loads(curr_dep_graph_str)
-                next_dep = json.loads(next_state.dependency_graph) if next_state.dependency_graph else {}
-                curr_dep.update(next_dep) # マージ
-                merged_graph = json.dumps(curr_dep, ensure_ascii=False)
-            except:
-                merged_graph = next_state.dependency_graph # 失敗時は上書き
-
         new_version = current_ver + 1
 
         # 3. Formatterの適用（Chapter保存用）
@@ -1197,7 +3010,8 @@ class BibleSynchronizer:
                 k_dict = json.loads(k_str) if isinstance(k_str, str) else k_str
             except: pass
         
-        content_formatted = await formatter.format(chapter_data['content'], k_dict=k_dict)
+        with tracer.span("format", book_id=self.book_id, ep_num=chapter_data['ep_num']):
+            content_formatted = await formatter.format(chapter_data['content'], k_dict=k_dict)
         
         # 4. DBへのアトミック更新 (Via Repo)
         # Bible Insert
@@ -1207,9 +3021,12 @@ class BibleSynchronizer:
             updated_revealed, 
             updated_mysteries,
             updated_foreshadowing,
-            merged_graph,
+            "{}", # 依存グラフは foreshadowing テーブルで管理
             new_version
         )
+
+        # 伏線台帳: 新規伏線と回収予定話数の登録、回収済みの記録
+        await self.ledger.apply(self.book_id, chapter_data['ep_num'], next_state, legacy_graph=legacy_graph)
         
         # Chapter Insert/Update
         await self.repo.save_chapter(
@@ -1226,16 +3043,222 @@ class BibleSynchronizer:
 
         return new_version
 
+# ==========================================
+# 2b. Passage Retrieval (FTS5 trigram index)
+# ==========================================
+class PassageRetriever:
+    """
+    執筆済みチャプターの本文・要約・確定事実をFTS5で索引化し、
+    今回の設計図に関係する過去の抜粋だけをプロンプトへ差し込む。
+    日本語は分かち書きがないため trigram トークナイザを使う。
+    trigram で引けない3文字未満の語（短いキャラ名など）は LIKE で補う。
+    """
+    _TERM_SPLIT = re.compile(r'[\s、。・,，.:：;；/／!！?？「」『』（）()\[\]【】〈〉《》"\'=＝\-ー〜~]+')
+
+    def __init__(self, repo, top_k=RETRIEVAL_TOP_K):
+        self.repo = repo
+        self.top_k = top_k
+
+    @staticmethod
+    def chunk_content(content: str, size=PASSAGE_CHARS) -> List[str]:
+        """段落境界で PASSAGE_CHARS 前後の抜粋に区切る"""
+        chunks, buf = [], ""
+        for para in content.split("\n"):
+            para = para.strip()
+            if not para:
+                continue
+            if buf and len(buf) + len(para) > size:
+                chunks.append(buf)
+                buf = ""
+            buf = f"{buf}\n{para}" if buf else para
+        if buf:
+            chunks.append(buf)
+        return chunks
+
+    @classmethod
+    def extract_terms(cls, texts, max_terms=RETRIEVAL_MAX_TERMS, vocab=()) -> List[str]:
+        """
+        伏線ID・キャラ名・固有語から検索語を抽出（順序維持・重複除去）
+        texts は区切って3文字以上の語を、vocab（キャラ名・辞書語）は長さに関わらず分割せずそのまま使う。
+        """
+        terms = []
+        tokens = [t for text in texts for t in cls._TERM_SPLIT.split(str(text)) if len(t) >= 3]
+        for token in tokens + [str(v).strip() for v in vocab]:
+            if token and token not in terms:
+                terms.append(token)
+                if len(terms) >= max_terms:
+                    return terms
+        return terms
+
+    @staticmethod
+    def build_vocab(char_registries) -> List[str]:
+        """キャラ名とキーワード辞書の見出し語（レンジ内で共通）"""
+        vocab = []
+        for reg in char_registries:
+            vocab.append(reg.name)
+            try:
+                k_dict = json.loads(reg.keyword_dictionary) if isinstance(reg.keyword_dictionary, str) else reg.keyword_dictionary
+                vocab.extend(k_dict.keys() if isinstance(k_dict, dict) else [])
+            except: pass
+        return [v for v in dict.fromkeys(vocab) if v]
+
+    async def context_for(self, book_id: int, ep_num: int, episode_plot_text: str, vocab: List[str], must_resolve: List[str]) -> str:
+        """設計図に登場する語と回収予定の伏線で過去話を検索し、プロンプト用ブロックを返す（該当なしは空文字）"""
+        if not db.fts_enabled:
+            return ""
+        mentioned = [v for v in vocab if v in episode_plot_text]
+        terms = self.extract_terms(must_resolve, vocab=mentioned)
+        if not terms:
+            return ""
+        # 直前話は Bridge Context で渡しているので除外
+        rows = await self.repo.search_passages(book_id, terms, before_ep=ep_num - 1, limit=self.top_k)
+        if not rows:
+            return ""
+        lines = ["【Retrieved Past Passages (関連する過去話の抜粋。設定・伏線の根拠として参照せよ)】"]
+        for r in sorted(rows, key=lambda x: (x['ep_num'], x['kind'])):
+            lines.append(f"- 第{r['ep_num']}話 [{r['kind']}]: {r['body']}")
+        return "\n".join(lines)
+
+# ==========================================
+# 2c. Foreshadowing Ledger (伏線台帳)
+# ==========================================
+class ForeshadowingLedger:
+    """
+    WorldState の pending_foreshadowing / dependency_graph / resolved_foreshadowing を
+    foreshadowing テーブルへ差分反映する。回収予定の検索は (book_id, target_ep) 索引で行い、
+    依存グラフ全体をプロンプトに載せない。
+    """
+    _EP_NUM = re.compile(r'\d+')
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    @classmethod
+    def parse_target_ep(cls, value) -> Optional[int]:
+        """12 / "12" / "第12話" などを話数に変換（解釈できなければ None）"""
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, int):
+            return value
+        m = cls._EP_NUM.search(str(value or ""))
+        return int(m.group()) if m else None
+
+    @classmethod
+    def planted_from_state(cls, state: WorldState, legacy_graph: str = None):
+        """
+        [(fs_id, text, target_ep), ...]
+        planted_foreshadowing の {id, text, target_ep} を優先し、旧形式（pending_foreshadowing の本文と
+        dependency_graph の ID -> 話数）は本文にIDが含まれるもの、残りは件数が一致すれば出現順で対応付ける。
+        対応の取れない本文は本文自体をIDとする。
+        """
+        graph = {}
+        for raw in (legacy_graph, state.dependency_graph):
+            if not raw:
+                continue
+            try:
+                parsed = json.loads(raw) if isinstance(raw, str) else raw
+                if isinstance(parsed, dict):
+                    graph.update({str(k).strip(): v for k, v in parsed.items() if str(k).strip()})
+            except json.JSONDecodeError: pass
+
+        def target(value):
+            ep = cls.parse_target_ep(value)
+            return ep if ep and ep > 0 else None
+
+        planted = {}
+        texts = []
+        for entry in state.planted_foreshadowing or []:
+            if isinstance(entry, str):
+                texts.append(entry)
+                continue
+            fs_id, text = entry.id.strip(), entry.text.strip()
+            if fs_id or text:
+                fs_id = fs_id or text
+                planted[fs_id] = (fs_id, text or fs_id, target(entry.target_ep) or target(graph.get(fs_id)))
+        linked = set(planted)
+        unlinked = []
+        for text in texts + list(state.pending_foreshadowing or []):
+            text = str(text).strip()
+            if not text or text in linked:
+                continue
+            linked.add(text)
+            fs_id = text if text in graph else next((k for k in graph if k not in linked and k in text), None)
+            if fs_id:
+                linked.add(fs_id)
+                planted[fs_id] = (fs_id, text, target(graph[fs_id]))
+            else:
+                unlinked.append(text)
+        ids = [k for k in graph if k not in linked]
+        if unlinked and len(unlinked) == len(ids):
+            for fs_id, text in zip(ids, unlinked):
+                planted[fs_id] = (fs_id, text, target(graph[fs_id]))
+            unlinked, ids = [], []
+        for text in unlinked:
+            planted[text] = (text, text, None)
+        for fs_id in ids:
+            planted.setdefault(fs_id, (fs_id, fs_id, target(graph[fs_id])))
+        return list(planted.values())
+
+    @staticmethod
+    def match_resolved(open_rows, resolved, loose: bool = True) -> List[str]:
+        """
+        回収報告（ID・本文・言い換え）を未回収伏線の fs_id に対応付ける。
+        ID/本文の完全一致 → IDを語として含む報告（F1 は F12 に一致しない）→ 本文を含む報告
+        → 文字n-gramの近似一致（FactStore の判定を緩めたもの）の順に探す。loose=False では前2段だけを使う。
+        """
+        ids = []
+        store = FactStore(threshold=FORESHADOW_MATCH_THRESHOLD, containment=FORESHADOW_MATCH_CONTAINMENT)
+        owners = []   # store のエントリ -> 未回収伏線の行
+        for row in open_rows:
+            if store.add(row['text']):
+                owners.append(row)
+        for r in resolved:
+            hit = next((row for row in open_rows if r in (row['fs_id'], row['text'])), None)
+            if hit is None:
+                hit = next((row for row in open_rows if len(row['fs_id']) >= 2
+                            and re.search(rf"(?<![A-Za-z0-9_]){re.escape(row['fs_id'])}(?![A-Za-z0-9_])", r)), None)
+            if hit is None and loose:
+                hit = next((row for row in open_rows if row['text'] in r or (len(r) >= 3 and r in row['text'])), None)
+            if hit is None and loose:
+                idx = store.find(r)
+                hit = owners[idx] if idx is not None else None
+            ids.append(hit['fs_id'] if hit else r)
+        return list(dict.fromkeys(ids))
+
+    async def apply(self, book_id: int, ep_num: int, state: WorldState, legacy_graph: str = None):
+        planted = self.planted_from_state(state, legacy_graph)
+        resolved = [str(r).strip() for r in state.resolved_foreshadowing or [] if str(r).strip()]
+        # 解明された謎は伏線の回収報告ではないので、IDを明示したものだけを回収扱いにする（言い換えの近似一致はしない）
+        revealed = [str(r).strip() for r in state.revealed_mysteries or [] if str(r).strip()]
+        if resolved or revealed:
+            open_rows = await self.repo.get_open_foreshadowing(book_id)
+            open_ids = {row['fs_id'] for row in open_rows}
+            resolved = self.match_resolved(open_rows, list(dict.fromkeys(resolved)))
+            resolved += [i for i in self.match_resolved(open_rows, list(dict.fromkeys(revealed)), loose=False) if i in open_ids]
+            resolved = list(dict.fromkeys(resolved))
+        if planted or resolved:
+            await self.repo.apply_foreshadowing(book_id, ep_num, planted, resolved)
+
+    async def due(self, book_id: int, ep_num: int):
+        return await self.repo.get_due_foreshadowing(book_id, ep_num)
+
+    async def open_texts(self, book_id: int) -> List[str]:
+        return [r['text'] for r in await self.repo.get_open_foreshadowing(book_id)]
+
+    async def overdue(self, book_id: int, through_ep: int):
+        return await self.repo.get_overdue_foreshadowing(book_id, through_ep)
+
 # ==========================================
 # 4. New Classes (Pacing Only) - TrendAnalyst removed
 # ==========================================
 
 class PacingGraph:
     @staticmethod
-    async def analyze(book_id: int, current_ep: int, total_eps: int = 50) -> Dict[str, Any]:
+    async def analyze(book_id: int, current_ep: int, total_eps: int = STANDARD_TARGET_EPS, arc: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
         構造的ペーシングロジック。
         単純な数値計算ではなく、プロット構造上の位置（起承転結）と周期的なクライマックスを重視する。
+        arc（長期連載のアーク）を渡した場合、クライマックスはアークの終端・中間点から決める。
         """
         repo = NovelRepository(db)
         history = await repo.get_recent_plot_metrics(book_id, current_ep)
@@ -1249,15 +3272,20 @@ class PacingGraph:
             graph_lines.append(f"Ep{h['ep_num']}: [Stress:{s_level}] -> [Catharsis:{c_level}]")
         graph_visualization = " -> ".join(graph_lines) if graph_lines else "(First Episode)"
 
-        # --- 構造的ペーシングロジック (50話用に調整) ---
+        # --- 構造的ペーシングロジック (50話用に調整。長期連載はアーク単位) ---
         
         # 1. 位置による判定
         is_first_ep = (current_ep == 1)
         is_final_ep = (current_ep == total_eps)
         
         # 2. 周期的なクライマックス判定
-        is_big_climax = (current_ep % 10 == 0) or (current_ep == 25) # 10話ごと＆25話（第1部完結）
-        is_small_climax = (current_ep % 5 == 0) and not is_big_climax
+        if arc:
+            arc_len = arc['end_ep'] - arc['start_ep'] + 1
+            is_big_climax = (current_ep == arc['end_ep']) # アークの締め
+            is_small_climax = arc_len >= 6 and current_ep == arc['start_ep'] + arc_len // 2 # アークの中間点
+        else:
+            is_big_climax = (current_ep % 10 == 0) or (current_ep == WRITE_PHASE_EPS) # 10話ごと＆第1部完結
+            is_small_climax = (current_ep % 5 == 0) and not is_big_climax
         
         # 3. 指示内容の決定
         instruction = ""
@@ -1299,20 +3327,1173 @@ class PacingGraph:
         
         final_instruction = f"{instruction}\n{density_instruction}"
 
-        return {
-            "type": "structural",
-            "temperature": temperature,
-            "instruction": final_instruction,
-            "force_catharsis": is_big_climax,
-            "graph_visualization": graph_visualization
-        }
+        return {
+            "type": "structural",
+            "temperature": temperature,
+            "instruction": final_instruction,
+            "force_catharsis": is_big_climax,
+            "graph_visualization": graph_visualization
+        }
+
+# ==========================================
+# 4a. Token Accounting & Model Router (コスト/レイテンシ考慮カスケード)
+# ==========================================
+# book_id 確定前（企画・プロット生成）のAPIコールに付けるキー。保存後に同じキーのコールだけをそのブックへ紐付ける
+_planning_key = contextvars.ContextVar("planning_key", default=None)
+# 直前の _generate_with_retry が実際に呼び出したモデル（代替モデルへ切り替えた場合のコスト・成績の集計用）
+_routed_model = contextvars.ContextVar("routed_model", default=None)
+# 企画で抽選したシード (seed_id, genre, style_key)。ブック保存に成功した時点で使用履歴へ記録する
+_pending_seed_use = contextvars.ContextVar("pending_seed_use", default=None)
+
+def extract_usage(response) -> Dict[str, int]:
+    """レスポンスのusage_metadataからトークン数を取り出す"""
+    usage = getattr(response, 'usage_metadata', None)
+    return {
+        "prompt": getattr(usage, 'prompt_token_count', None) or 0,
+        "candidates": getattr(usage, 'candidates_token_count', None) or 0,
+        "cached": getattr(usage, 'cached_content_token_count', None) or 0,
+        "thinking": getattr(usage, 'thoughts_token_count', None) or 0,
+        "total": getattr(usage, 'total_token_count', None) or 0,
+    }
+
+def usage_cost(model: str, usage: Dict[str, int]) -> float:
+    """トークン数からUSDコストを算出（prompt に含まれるキャッシュ分はキャッシュ単価、思考トークンは出力として課金）"""
+    in_price, out_price = MODEL_PRICING.get(model, MODEL_PRICING[MODEL_LITE])
+    cached_price = MODEL_CACHED_PRICING.get(model, in_price)
+    prompt = usage.get('prompt', 0)
+    cached = min(usage.get('cached', 0), prompt)
+    return ((prompt - cached) * in_price + cached * cached_price
+            + (usage.get('candidates', 0) + usage.get('thinking', 0)) * out_price) / 1_000_000
+
+class ModelRouter:
+    """
+    安価モデルから開始し、品質ゲートに落ちた場合のみ上位モデルへ昇格するカスケード。
+    昇格までの試行回数はDBに蓄積したモデル別の採用率・レイテンシ・コストから決定し、
+    上位モデルで確定させる話数は1冊あたりPRO_MAX_SHAREで制限する。
+    """
+    def __init__(self, repo, cheap_model=MODEL_LITE, strong_model=MODEL_PRO):
+        self.repo = repo
+        self.cheap_model = cheap_model
+        self.strong_model = strong_model
+
+    @staticmethod
+    def estimate_cost(model: str, response, prompt_chars: int = 0) -> float:
+        """usage_metadataからコストを算出（取得できない場合は文字数から概算）"""
+        usage = extract_usage(response)
+        if not usage['prompt']:
+            usage['prompt'] = prompt_chars
+        if not usage['candidates']:
+            usage['candidates'] = len(getattr(response, 'text', '') or '')
+        return usage_cost(model, usage)
+
+    @staticmethod
+    def _cost_per_accept(stats: Dict[str, Any]) -> float:
+        accept_rate = max(stats['accept_rate'] or 0.0, 0.05)
+        return ((stats['avg_cost'] or 0.0) + (stats['avg_latency'] or 0.0) * LATENCY_COST_WEIGHT) / accept_rate
+
+    async def escalate_after(self) -> int:
+        """上位モデルへ昇格するまでに許容する安価モデルの失敗回数"""
+        stats = {r['model']: r for r in await self.repo.get_model_stats()}
+        cheap = stats.get(self.cheap_model)
+        strong = stats.get(self.strong_model)
+        if not cheap or cheap['attempts'] < CASCADE_MIN_SAMPLES:
+            return 2 # 学習データ不足時の既定値
+
+        # 安価モデルの採用1件あたりの実効コストが上位モデルより悪ければ、1回で見切る
+        if strong and strong['attempts'] >= CASCADE_MIN_SAMPLES and self._cost_per_accept(cheap) >= self._cost_per_accept(strong):
+            return 1
+
+        # 累積採用確率が90%に届く試行回数まで安価モデルで粘る
+        p = min(max(cheap['accept_rate'] or 0.0, 0.01), 0.99)
+        needed = math.ceil(math.log(0.1) / math.log(1.0 - p))
+        return max(1, min(CASCADE_MAX_CHEAP_ATTEMPTS, needed))
+
+    async def strong_quota_left(self, book_id: int, target_eps: int) -> bool:
+        used = await self.repo.count_model_accepts(book_id, self.strong_model)
+        return used < max(1, int(target_eps * PRO_MAX_SHARE))
+
+    async def select(self, book_id: int, target_eps: int, cheap_failures: int) -> str:
+        """直前までの失敗回数に応じて今回の試行モデルを決定"""
+        if cheap_failures == 0:
+            return self.cheap_model
+        if cheap_failures >= await self.escalate_after() and await self.strong_quota_left(book_id, target_eps):
+            return self.strong_model
+        return self.cheap_model
+
+# ==========================================
+# 4b. Critic Stage (非同期品質審査)
+# ==========================================
+class CriticStage:
+    """
+    執筆チェーンとは独立したバックグラウンド品質審査。
+    完成済みチャプターを安価なモデルで数話まとめて採点し、結果をchaptersテーブルに記録する。
+    基準未達の話のみ plot.status='rework' としてリワーク待ちに積むため、執筆チェーンは止まらない。
+    """
+    def __init__(self, engine, model=MODEL_CRITIC, batch_size=CRITIC_BATCH_SIZE):
+        self.engine = engine
+        self.model = model
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue()
+        self._worker_task = None
+        self._draining = False
+        self._failures = {}      # (book_id, ep_num) -> 採点失敗回数
+
+    def submit(self, book_id: int, ep_num: int):
+        """採点待ちキューに積む（待機しない）"""
+        if self._worker_task is None or self._worker_task.done():
+            self._worker_task = asyncio.create_task(self._worker())
+        self.queue.put_nowait((book_id, ep_num))
+
+    async def drain(self):
+        """採点待ちを全て処理し終えるまで待機する"""
+        if self._worker_task is None:
+            return
+        self._draining = True
+        try:
+            await self.queue.join()
+        finally:
+            self._draining = False
+
+    async def stop(self):
+        """ワーカーを止める（採点待ちだった話は critic_status が未設定のまま残る）"""
+        if self._worker_task and not self._worker_task.done():
+            self._worker_task.cancel()
+            await asyncio.gather(self._worker_task, return_exceptions=True)
+
+    @staticmethod
+    def is_flagged(report: QualityReport) -> bool:
+        return bool(report.fatal_errors) or \
+            report.consistency_score < CRITIC_CONSISTENCY_THRESHOLD or \
+            report.cliffhanger_score < CRITIC_CLIFFHANGER_THRESHOLD
+
+    async def _collect_batch(self):
+        items = [await self.queue.get()]
+        deadline = time.monotonic() + CRITIC_BATCH_WAIT
+        while len(items) < self.batch_size:
+            try:
+                items.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            if self._draining or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(0.5)
+        return items
+
+    async def _worker(self):
+        while True:
+            items = await self._collect_batch()
+            by_book = {}
+            for book_id, ep_num in items:
+                by_book.setdefault(book_id, set()).add(ep_num)
+            try:
+                # 書籍ごとに採点し、失敗した書籍の話だけを積み直す（他の書籍の結果は巻き込まない）
+                for book_id, eps in by_book.items():
+                    try:
+                        scored = await self._score_batch(book_id, sorted(eps))
+                    except Exception as e:
+                        print(f"Critic Error (Book {book_id}): {e}")
+                        scored = set()
+                    for ep_num in sorted(eps - scored):
+                        await self._retry_or_fail(book_id, ep_num)
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    async def _retry_or_fail(self, book_id: int, ep_num: int):
+        """採点できなかった話を積み直す。CRITIC_MAX_ATTEMPTS 回失敗したら error として記録する"""
+        key = (book_id, ep_num)
+        self._failures[key] = self._failures.get(key, 0) + 1
+        if self._failures[key] < CRITIC_MAX_ATTEMPTS:
+            self.queue.put_nowait(key)
+            return
+        self._failures.pop(key, None)
+        print(f"⚠️ Critic gave up on Ep {ep_num} (Book {book_id}) after {CRITIC_MAX_ATTEMPTS} attempts")
+        try:
+            await self.engine.repo.mark_critic_error(book_id, ep_num)
+        except Exception as e:
+            print(f"Critic Error (Book {book_id}): {e}")
+
+    async def _score_batch(self, book_id: int, ep_nums: List[int]):
+        """採点を記録した話数（採点対象外の話を含む）を返す。レポートが返らなかった話は含めない"""
+        repo = self.engine.repo
+        rows = await repo.get_chapters_for_review(book_id, ep_nums)
+        if not rows:
+            return set(ep_nums)
+        print(f"🔎 Critic Reviewing Ep {[r['ep_num'] for r in rows]} (Book {book_id})...")
+
+        bible_context = await DynamicBibleManager(book_id).get_prompt_context()
+        episodes_text = "\n\n".join(
+            f"=== 第{r['ep_num']}話 {r['title']} ===\n{DraftReviser.numbered(r['content'])}" for r in rows
+        )
+        prompt = self.engine.prompt_manager.get(
+            "critic_batch",
+            bible_context=bible_context,
+            episodes_text=episodes_text,
+            schema=json.dumps(CriticBatch.model_json_schema(), ensure_ascii=False)
+        )
+        res = await self.engine._generate_deferred(
+            model=self.model,
+            contents=prompt,
+            stage="critic",
+            book_id=book_id,
+            config=types.GenerateContentConfig(
+                response_mime_type="application/json",
+                safety_settings=self.engine.safety_settings
+            )
+        )
+        text_content = res.text.strip() if res.text else ""
+        if not text_content:
+            raise ValueError("Empty response from Critic")
+
+        batch = CriticBatch.model_validate(self.engine._parse_json_response(text_content))
+        reviewed = {r['ep_num'] for r in rows}
+        done = set(ep_nums) - reviewed
+        for verdict in batch.verdicts:
+            if verdict.ep_num not in reviewed or verdict.ep_num in done:
+                continue
+            done.add(verdict.ep_num)
+            self._failures.pop((book_id, verdict.ep_num), None)
+            flagged = self.is_flagged(verdict.report)
+            await repo.save_critic_report(book_id, verdict.ep_num, verdict.report, 'flagged' if flagged else 'passed')
+            if flagged:
+                await repo.update_plot_status(book_id, verdict.ep_num, 'rework')
+                print(f"⚠️ Critic Flagged Ep {verdict.ep_num} (Consistency: {verdict.report.consistency_score}, Cliffhanger: {verdict.report.cliffhanger_score}, Fatal: {len(verdict.report.fatal_errors)})")
+        return done
+
+# ==========================================
+# 4c. Arc Planner (長期連載の階層プランニング)
+# ==========================================
+class ArcPlanner:
+    """
+    長期連載（FACTORY_SERIAL_MODE=long）の階層プランニング。
+    企画時はアーク構成だけを決め、各話プロットとアーク終端のアンカーは執筆の直前にアーク単位で生成する。
+    1回の生成に渡すのは基本設定・直近アークの要約・直前の到達状態だけなので、話数が増えてもプロンプトは一定サイズ。
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.repo = engine.repo
+        self._locks = {}   # book_id -> Lock（アークは前のアークの到達状態を起点に順番に生成する）
+
+    @staticmethod
+    def normalize(arcs, total_eps):
+        """モデル出力のアーク境界を 1〜total_eps の連続区間に揃え、ARC_MAX_EPS を超えるアークは分割して連番を振り直す"""
+        arcs = sorted((a.model_dump() if isinstance(a, BaseModel) else dict(a) for a in arcs), key=lambda a: a['start_ep'])
+        segments, start = [], 1
+        for i, a in enumerate(arcs):
+            if start > total_eps:
+                break
+            end = total_eps if i == len(arcs) - 1 else min(max(a['end_ep'], start), total_eps)
+            segments.append((a, start, end))
+            start = end + 1
+        if not segments:
+            segments = [({"title": "本編", "synopsis": "", "climax": ""}, 1, total_eps)]
+
+        fixed = []
+        for a, start, end in segments:
+            parts = math.ceil((end - start + 1) / ARC_MAX_EPS)
+            size = math.ceil((end - start + 1) / parts)
+            for k in range(parts):
+                s_ep = start + k * size
+                title = a['title'] if parts == 1 else f"{a['title']}（{k + 1}/{parts}）"
+                fixed.append(dict(a, title=title, start_ep=s_ep, end_ep=min(end, s_ep + size - 1)))
+        for n, a in enumerate(fixed, 1):
+            a['arc_no'] = n
+        return fixed
+
+    @staticmethod
+    def arc_for(arcs, ep_num):
+        for a in arcs or []:
+            if a['start_ep'] <= ep_num <= a['end_ep']:
+                return a
+        return None
+
+    @staticmethod
+    def anchor_eps(arcs) -> List[int]:
+        return [a['end_ep'] for a in arcs]
+
+    async def ensure_plotted(self, book_data, through_ep: int) -> int:
+        """through_ep を含むアークまで、プロット未生成のアークを先頭から順に生成する。戻り値: 生成したアーク数"""
+        bid = book_data['book_id']
+        count = 0
+        async with self._locks.setdefault(bid, asyncio.Lock()):
+            arcs = [dict(a) for a in await self.repo.get_arcs(bid)]
+            for arc in arcs:
+                if arc['start_ep'] > through_ep:
+                    break
+                if arc['status'] != 'plotted':
+                    with tracer.span("arc_plot", book_id=bid, arc=arc['arc_no']):
+                        await self.plot_arc(book_data, arc, arcs)
+                    count += 1
+        return count
+
+    async def _book_brief(self, book_data) -> str:
+        book = await self.repo.get_book(book_data['book_id'])
+        mc = book_data['mc_profile']
+        lines = [
+            f"- タイトル: {book_data['title']}",
+            f"- コンセプト: {book.get('concept') or ''}",
+            f"- あらすじ: {book.get('synopsis') or ''}",
+            f"- 主人公: {mc.get('name')}（{mc.get('personality', '')}）能力: {mc.get('ability', '')}",
+        ]
+        lines += [f"- {c.get('name')}（{c.get('role')}）: {c.get('personality', '')}" for c in book_data.get('sub_characters', [])]
+        return "\n".join(lines)
+
+    @staticmethod
+    def _arc_text(arc) -> str:
+        return f"第{arc['arc_no']}アーク「{arc['title']}」(第{arc['start_ep']}〜{arc['end_ep']}話)\n  あらすじ: {arc['synopsis']}\n  山場: {arc['climax']}"
+
+    async def plot_arc(self, book_data, arc, arcs):
+        """1アーク分の各話プロットと終端アンカーを生成して保存する"""
+        engine = self.engine
+        bid = book_data['book_id']
+        idx = next(i for i, a in enumerate(arcs) if a['arc_no'] == arc['arc_no'])
+        previous = arcs[max(0, idx - ARC_CONTEXT_ARCS):idx]
+        next_arc = arcs[idx + 1] if idx + 1 < len(arcs) else None
+        prev_row = await self.repo.get_latest_chapter(bid, arc['start_ep'])
+        prev_state = f"{prev_row['summary']}\n{prev_row['world_state'] or ''}" if prev_row else "（物語開始）"
+        arc_eps = arc['end_ep'] - arc['start_ep'] + 1
+        print(f"Planning Arc {arc['arc_no']} (Ep {arc['start_ep']}-{arc['end_ep']})...")
+
+        prompt = engine.prompt_manager.get(
+            "generate_arc_plot_flow",
+            total_eps=book_data['target_eps'],
+            arc_no=arc['arc_no'],
+            arc_title=arc['title'],
+            start_ep=arc['start_ep'],
+            end_ep=arc['end_ep'],
+            arc_eps=arc_eps,
+            prev_ep=arc['start_ep'] - 1,
+            book_brief=await self._book_brief(book_data),
+            previous_arcs="\n".join(self._arc_text(a) for a in previous) or "（なし: 最初のアーク）",
+            prev_state=prev_state,
+            arc_outline=self._arc_text(arc),
+            next_arc=self._arc_text(next_arc) if next_arc else "（なし: 最終アーク。物語を完結させよ）",
+            FATAL_FLAWS_GUIDELINES=FATAL_FLAWS_GUIDELINES,
+            schema=json.dumps(ArcPlotBlueprint.model_json_schema(), ensure_ascii=False, separators=(',', ':'))
+        )
+        res = await engine._generate_deferred(
+            model=MODEL_ULTRALONG,
+            contents=prompt,
+            stage="arc_plot",
+            book_id=bid,
+            ep_num=arc['start_ep'],
+            config=types.GenerateContentConfig(
+                response_mime_type="application/json",
+                safety_settings=engine.safety_settings
+            )
+        )
+        text_content = res.text.strip() if res.text else ""
+        if not text_content:
+            raise ValueError(f"Empty response from Arc {arc['arc_no']} plot generation")
+        blueprint = ArcPlotBlueprint.model_validate(engine._parse_json_response(text_content))
+
+        plots = {p.ep_num: p for p in blueprint.plots if arc['start_ep'] <= p.ep_num <= arc['end_ep']}
+        missing = [ep for ep in range(arc['start_ep'], arc['end_ep'] + 1) if ep not in plots]
+        if missing:
+            raise ValueError(f"Arc {arc['arc_no']} plot is missing episodes: {missing}")
+        await self.repo.add_plots(bid, {"plots": [plots[ep].model_dump() for ep in sorted(plots)]})
+
+        # 終端アンカー（執筆済みの話は上書きしない）
+        if not await self.repo.check_chapter_exists(bid, arc['end_ep']):
+            ws_data = blueprint.end_state.world_state.model_dump()
+            await self.repo.save_chapter(
+                bid, arc['end_ep'], f"ANCHOR_EP_{arc['end_ep']}", "(ANCHOR_STATE_ONLY)",
+                blueprint.end_state.summary, json.dumps(ws_data, ensure_ascii=False)
+            )
+        await self.repo.update_arc_status(bid, arc['arc_no'], 'plotted')
+        arc['status'] = 'plotted'
+        print(f"Arc {arc['arc_no']} Plotted: {len(plots)} episodes.")
+
+# ==========================================
+# 4d. Story Memory (階層ローリング要約)
+# ==========================================
+class StoryMemory:
+    """
+    話の要約（chapters.summary）→ ブロック要約 → 全体あらすじ の3階層で物語の記憶を持つ。
+    ブロックは長期連載ではアーク、それ以外は STORY_BLOCK_EPS 話ごと。書き上がったブロックから安価モデルで
+    バックグラウンド要約し、STORY_RECENT_BLOCKS より古いブロックは全体あらすじへ1ブロックずつ畳み込む。
+    執筆プロンプトへ渡す「これまでのあらすじ」は各層の文字数上限で固定長になり、話数が増えても一定。
+    """
+    def __init__(self, engine, model=MODEL_SUMMARY):
+        self.engine = engine
+        self.repo = engine.repo
+        self.model = model
+        self._tasks = set()
+        self._locks = {}   # book_id -> Lock（畳み込みは古いブロックから順に行う）
+
+    @staticmethod
+    def blocks(book_data) -> List[tuple]:
+        """(start_ep, end_ep) のブロック一覧"""
+        arcs = book_data.get('arcs')
+        if arcs:
+            return [(a['start_ep'], a['end_ep']) for a in arcs]
+        total = book_data.get('target_eps') or STANDARD_TARGET_EPS
+        return [(s, min(total, s + STORY_BLOCK_EPS - 1)) for s in range(1, total + 1, STORY_BLOCK_EPS)]
+
+    @staticmethod
+    def _clip(text, limit) -> str:
+        text = " ".join(str(text or "").split())
+        return text if len(text) <= limit else text[:limit - 1] + "…"
+
+    @staticmethod
+    def _source_hash(*parts) -> str:
+        return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def notify(self, book_data, ep_num: int):
+        """話の保存後に呼ぶ（待機しない）。その話でブロックが揃えば要約・畳み込みを行う"""
+        task = asyncio.create_task(self._on_saved(book_data, ep_num))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def stop(self):
+        """実行中の要約を打ち切る（ブロック要約は次にそのブロックの話が保存されたときに作り直される）"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def _on_saved(self, book_data, ep_num: int):
+        bid = book_data['book_id']
+        blocks = self.blocks(book_data)
+        try:
+            async with self._locks.setdefault(bid, asyncio.Lock()):
+                with tracer.span("story_memory", book_id=bid, ep_num=ep_num):
+                    block = next((b for b in blocks if b[0] <= ep_num <= b[1]), None)
+                    if block:
+                        await self._summarize_block(book_data, *block)
+                    await self._fold(book_data, blocks)
+        except Exception as e:
+            print(f"Story Memory Error (Book {bid}, Ep {ep_num}): {e}")
+
+    async def _generate(self, book_id: int, ep_num: int, prompt: str, limit: int) -> str:
+        res = await self.engine._generate_deferred(
+            model=self.model,
+            contents=prompt,
+            stage="summary",
+            book_id=book_id,
+            ep_num=ep_num,
+            config=types.GenerateContentConfig(safety_settings=self.engine.safety_settings)
+        )
+        text = res.text.strip() if res.text else ""
+        if not text:
+            raise ValueError("Empty response from summary")
+        return self._clip(text, limit)
+
+    async def _summarize_block(self, book_data, start_ep: int, end_ep: int):
+        """
+        ブロック内の全話が揃っていれば要約する。リワークで話の要約が変わった場合のみ作り直す
+        エラー話も「揃った」扱いにして要約からは除く（ブロックが永久に未完成になり畳み込みが止まるのを防ぐ）。
+        """
+        bid = book_data['book_id']
+        rows = await self.repo.get_episode_summaries(bid, start_ep, end_ep, include_errors=True)
+        if len(rows) < end_ep - start_ep + 1:
+            return
+        lines = [f"第{r['ep_num']}話: {self._clip(r['summary'], STORY_EP_SUMMARY_CHARS)}" for r in rows if r['summary'] != 'エラー']
+        source_hash = self._source_hash(*lines)
+        existing = await self.repo.get_story_summaries(bid, 'block', end_ep + 1, 1)
+        if existing and existing[0]['start_ep'] == start_ep and existing[0]['source_hash'] == source_hash:
+            return
+        if not lines:
+            await self.repo.save_story_summary(bid, 'block', start_ep, end_ep, f"（第{start_ep}-{end_ep}話は生成エラーのため欠番）", source_hash)
+            return
+        prompt = self.engine.prompt_manager.get(
+            "story_block_summary",
+            title=book_data['title'], start_ep=start_ep, end_ep=end_ep,
+            max_chars=STORY_BLOCK_CHARS, episode_summaries="\n".join(lines)
+        )
+        summary = await self._generate(bid, end_ep, prompt, STORY_BLOCK_CHARS)
+        await self.repo.save_story_summary(bid, 'block', start_ep, end_ep, summary, source_hash)
+        print(f"Story Memory: Block Ep {start_ep}-{end_ep} summarized (Book {bid}).")
+
+    async def _fold(self, book_data, blocks):
+        """
+        先頭から連続して要約済みのブロックのうち、直近 STORY_RECENT_BLOCKS 個より古いものを全体あらすじへ畳み込む。
+        全体あらすじの source_hash はブロックハッシュの連鎖なので、リワークで作り直されたブロックがあれば
+        そのブロックから先を畳み込み直す。
+        """
+        bid = book_data['book_id']
+        done = {r['start_ep']: r for r in await self.repo.get_story_summaries(bid, 'block', 10 ** 9, len(blocks))}
+        contiguous = []
+        for start_ep, end_ep in blocks:
+            row = done.get(start_ep)
+            if not row or row['end_ep'] != end_ep:
+                break
+            contiguous.append(row)
+        stored = {r['end_ep']: r for r in await self.repo.get_story_summaries(bid, 'story', 10 ** 9, len(blocks))}
+        story = None
+        for row in contiguous[:max(0, len(contiguous) - STORY_RECENT_BLOCKS)]:
+            expected = row['source_hash'] if story is None else self._source_hash(story['source_hash'], row['source_hash'])
+            saved = stored.get(row['end_ep'])
+            if saved and saved['source_hash'] == expected:
+                story = saved
+                continue
+            story_end = story['end_ep'] if story else 0
+            if story is None:
+                summary, source_hash = row['summary'], row['source_hash']
+            else:
+                prompt = self.engine.prompt_manager.get(
+                    "story_fold_summary",
+                    title=book_data['title'], story_end_ep=story_end, story=story['summary'],
+                    start_ep=row['start_ep'], end_ep=row['end_ep'], block=row['summary'],
+                    max_chars=STORY_SUMMARY_CHARS
+                )
+                summary = await self._generate(bid, row['end_ep'], prompt, STORY_SUMMARY_CHARS)
+                source_hash = expected
+            await self.repo.save_story_summary(bid, 'story', 1, row['end_ep'], summary, source_hash)
+            story = {"end_ep": row['end_ep'], "summary": summary, "source_hash": source_hash}
+
+    async def context_for(self, book_id: int, ep_num: int) -> str:
+        """ep_num 執筆用の「これまでのあらすじ」ブロック（第1話や要約が未作成のときは空文字）"""
+        # 直前話は Bridge Context で渡しているので、要約の対象は第 ep_num-2 話まで
+        blocks = await self.repo.get_story_summaries(book_id, 'block', ep_num - 1, STORY_RECENT_BLOCKS)
+        story_cutoff = min(b['start_ep'] for b in blocks) if blocks else ep_num - 1
+        story = await self.repo.get_story_summaries(book_id, 'story', story_cutoff, 1)
+        # ブロック要約に含まれない直近の話は、話ごとの要約を最大 STORY_RECENT_EPS 話
+        recent_start = max(blocks[0]['end_ep'] + 1 if blocks else 1, ep_num - 1 - STORY_RECENT_EPS)
+        recent = await self.repo.get_episode_summaries(book_id, recent_start, ep_num - 2) if ep_num > 2 else []
+        if not (recent or blocks or story):
+            return ""
+        lines = ["【Story So Far (これまでのあらすじ。長期の因果・人物関係の根拠として参照せよ)】"]
+        lines += [f"- 第1〜{s['end_ep']}話: {s['summary']}" for s in story]
+        lines += [f"- 第{b['start_ep']}〜{b['end_ep']}話: {b['summary']}" for b in reversed(blocks)]
+        lines += [f"- 第{r['ep_num']}話: {self._clip(r['summary'], STORY_EP_SUMMARY_CHARS)}" for r in recent]
+        return "\n".join(lines)
+
+# ==========================================
+# 4e. Batch Submitter (遅延可能な生成のバッチ投入)
+# ==========================================
+class BatchSubmitter:
+    """
+    レイテンシを問わない生成（Critic採点・要約・アンカー・アーク単位のプロット）を BATCH_WINDOW 秒ぶん集め、
+    モデルごとに1つのバッチファイル（JSONL）へ書き出して投入する。呼び出し側は通常の生成と同じくレスポンスを待つだけ。
+    - provider: 提供元のバッチAPI（割引単価・別クォータ）へ投入し、BATCH_POLL_SECONDS ごとに完了を確認する
+      （BATCH_PROVIDER_TIMEOUT 超過または実行予算の degraded でキャンセルし、残りは同期呼び出しで処理）
+    - local: 同じバッチファイルを手元で処理する代替実装（執筆チェーンとは別枠の BATCH_LOCAL_CONCURRENCY 並列）
+    バッチ単位の状態は batches テーブルに、各リクエストのトークン・コストは通常どおり api_calls に記録する。
+    """
+    _TERMINAL = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED", "JOB_STATE_PARTIALLY_SUCCEEDED"}
+
+    def __init__(self, engine, mode=BATCH_MODE, stages=BATCH_STAGES, batch_dir=BATCH_DIR):
+        self.engine = engine
+        self.repo = engine.repo
+        self.mode = mode
+        self.stages = stages
+        self.batch_dir = batch_dir
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self._local_sem = asyncio.Semaphore(BATCH_LOCAL_CONCURRENCY)
+
+    def accepts(self, stage: str) -> bool:
+        return self.mode in ("local", "provider") and stage in self.stages
+
+    async def generate(self, model, contents, config, stage="misc", book_id=None, ep_num=None):
+        """バッチに積み、結果が戻るまで待つ（戻り値は generate_content と同じレスポンス）"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append({
+            "key": uuid.uuid4().hex, "model": model, "contents": contents, "config": config,
+            "stage": stage, "book_id": book_id, "ep_num": ep_num, "future": future,
+        })
+        if len(self._pending) >= BATCH_MAX_REQUESTS:
+            self.flush()
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(BATCH_WINDOW)
+        self.flush()
+
+    def flush(self):
+        """待機中のリクエストをモデルごとのバッチとして投入する（待機しない）"""
+        if self._timer and not self._timer.done() and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        items, self._pending = self._pending, []
+        by_model = {}
+        for item in items:
+            by_model.setdefault(item['model'], []).append(item)
+        for model, group in by_model.items():
+            task = asyncio.create_task(self._run_batch(model, group))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def drain(self):
+        """待機中のリクエストを投入し、全バッチの完了を待つ"""
+        if self._pending:
+            self.flush()
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def stop(self):
+        """投入待ち・実行中のバッチを打ち切る（待っている呼び出し側はキャンセルされる）"""
+        if self._timer and not self._timer.done():
+            self._timer.cancel()
+        items, self._pending = self._pending, []
+        for item in items:
+            item['future'].cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def _write_file(self, batch_id: str, items) -> str:
+        """バッチファイル: 1行1リクエスト {"key", "request": {"contents", "config"}, "stage", "book_id", "ep_num"}"""
+        os.makedirs(self.batch_dir, exist_ok=True)
+        path = os.path.join(self.batch_dir, f"{batch_id}.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for item in items:
+                line = {
+                    "key": item['key'],
+                    "request": {"contents": item['contents'], "config": item['config'].model_dump(mode="json", exclude_none=True)},
+                    "stage": item['stage'], "book_id": item['book_id'], "ep_num": item['ep_num'],
+                }
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        return path
+
+    @staticmethod
+    def _read_file(path: str):
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    async def _run_batch(self, model: str, items):
+        batch_id = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        futures = {item['key']: item['future'] for item in items}
+        results = {}
+        try:
+            path = self._write_file(batch_id, items)
+            await self.repo.save_batch(batch_id, self.mode, model, len(items), path)
+            print(f"Batch {batch_id}: {len(items)} requests ({model}, {self.mode})")
+            with tracer.span("batch", batch_id=batch_id, mode=self.mode, model=model, requests=len(items)):
+                if self.mode == "provider":
+                    results = await self._run_provider(batch_id, model, path)
+                else:
+                    results = await self._run_local(model, path)
+            errors = sum(1 for r in results.values() if isinstance(r, Exception))
+            await self.repo.finish_batch(batch_id, 'completed', len(results) - errors, errors)
+        except Exception as e:
+            print(f"Batch Error ({batch_id}): {e}")
+            await self.repo.finish_batch(batch_id, 'failed', 0, len(items), str(e)[:500])
+
+        # 結果が戻らなかったリクエストは通常の同期呼び出しで処理する（作業を失わない）
+        for item in items:
+            future = futures[item['key']]
+            if future.done():
+                continue
+            result = results.get(item['key'])
+            if result is None:
+                BATCH_REQUESTS.inc(mode=self.mode, stage=item['stage'], outcome="fallback")
+                try:
+                    result = await self.engine._generate_with_retry(
+                        model, item['contents'], item['config'], stage=item['stage'], book_id=item['book_id'], ep_num=item['ep_num']
+                    )
+                except Exception as e:
+                    result = e
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _run_local(self, model: str, path: str):
+        """バッチファイルを読み、別枠の並列数で通常の生成APIに流す代替実装"""
+        async def run(line):
+            config = types.GenerateContentConfig.model_validate(line['request']['config'])
+            async with self._local_sem:
+                try:
+                    res = await self.engine._generate_with_retry(
+                        model, line['request']['contents'], config, stage=line['stage'], book_id=line['book_id'], ep_num=line['ep_num']
+                    )
+                    BATCH_REQUESTS.inc(mode="local", stage=line['stage'], outcome="ok")
+                    return line['key'], res
+                except Exception as e:
+                    BATCH_REQUESTS.inc(mode="local", stage=line['stage'], outcome="error")
+                    return line['key'], e
+        return dict(await asyncio.gather(*(run(line) for line in self._read_file(path))))
+
+    async def _run_provider(self, batch_id: str, model: str, path: str):
+        """バッチファイルの内容を提供元のバッチAPIへインラインで投入し、完了までポーリングする"""
+        lines = self._read_file(path)
+        src = [
+            types.InlinedRequest(
+                contents=line['request']['contents'],
+                config=types.GenerateContentConfig.model_validate(line['request']['config']),
+                metadata={"key": line['key']}
+            )
+            for line in lines
+        ]
+        started = time.monotonic()
+        # バッチはキー（プロジェクト）に属するので、投入したキーのクライアントで完了を確認する
+        async with self.engine.clients.lease(model) as slot:
+            client, key_id = slot.client, slot.key_id
+            job = await client.aio.batches.create(model=model, src=src, config=types.CreateBatchJobConfig(display_name=batch_id))
+        await self.repo.update_batch_provider(batch_id, job.name)
+        while self._state(job) not in self._TERMINAL:
+            # 待ち切れない場合はキャンセルして例外にし、_run_batch の同期フォールバックに任せる
+            if time.monotonic() - started > BATCH_PROVIDER_TIMEOUT or self.engine.budget.degraded:
+                reason = "run budget" if self.engine.budget.degraded else f"timeout {BATCH_PROVIDER_TIMEOUT:.0f}s"
+                try:
+                    await client.aio.batches.cancel(name=job.name)
+                except Exception as e:
+                    print(f"Batch cancel failed ({job.name}): {e}")
+                raise TimeoutError(f"batch {job.name} still {self._state(job)} ({reason}); cancelled")
+            await self.engine.budget.sleep(BATCH_POLL_SECONDS)
+            job = await client.aio.batches.get(name=job.name)
+        state = self._state(job)
+        if state not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+            raise RuntimeError(f"batch {job.name} ended in {state}: {job.error}")
+
+        elapsed = time.monotonic() - started
+        results = {}
+        by_key = {line['key']: line for line in lines}
+        responses = (job.dest.inlined_responses if job.dest else None) or []
+        for i, item in enumerate(responses):
+            # metadata が返らない場合は投入順で対応付ける
+            key = (item.metadata or {}).get("key") or (lines[i]['key'] if i < len(lines) else None)
+            line = by_key.get(key)
+            if line is None:
+                continue
+            if item.response is not None and not item.error:
+                usage = extract_usage(item.response)
+                await self.repo.record_api_call(line['book_id'], line['ep_num'], line['stage'], model, 1, True, None,
+                                                elapsed, usage, usage_cost(model, usage) * BATCH_PRICE_FACTOR, api_key=key_id)
+                BATCH_REQUESTS.inc(mode="provider", stage=line['stage'], outcome="ok")
+                results[key] = item.response
+            else:
+                await self.repo.record_api_call(line['book_id'], line['ep_num'], line['stage'], model, 1, False, str(item.error)[:500],
+                                                elapsed, {}, 0.0, api_key=key_id)
+                BATCH_REQUESTS.inc(mode="provider", stage=line['stage'], outcome="error")
+                results[key] = RuntimeError(f"batch request failed: {item.error}")
+        return results
+
+    @staticmethod
+    def _state(job) -> str:
+        state = job.state
+        return getattr(state, "value", None) or str(state or "")
+
+# ==========================================
+# 4f. API Error Classification & Circuit Breaker
+# ==========================================
+class GenerationBlocked(RuntimeError):
+    """安全フィルタ等でブロックされた応答（同じプロンプトの再送では解消しないため再試行しない）"""
+
+class CircuitOpen(RuntimeError):
+    """モデルのサーキットが開いたまま再試行回数を使い切った"""
+
+def classify_api_error(e) -> str:
+    """
+    再試行方針を決めるためのエラー分類:
+    quota (429) / auth (401・API_KEY_INVALID: キー自体が無効) / forbidden (その他の403: モデル単位の権限・一時的な拒否) /
+    invalid (400・404 等、再送しても通らない) / blocked / transient (5xx・タイムアウト・接続断)
+    """
+    if isinstance(e, GenerationBlocked):
+        return "blocked"
+    code = getattr(e, 'code', None)
+    text = str(e)
+    if code == 429 or "RESOURCE_EXHAUSTED" in text:
+        return "quota"
+    if code == 401 or "API_KEY_INVALID" in text:
+        return "auth"
+    if code == 403 or "PERMISSION_DENIED" in text:
+        return "forbidden"
+    if code in (400, 404) or "INVALID_ARGUMENT" in text or "FAILED_PRECONDITION" in text:
+        return "invalid"
+    if code is None and isinstance(e, (TypeError, ValueError, AttributeError, KeyError)):
+        return "invalid"   # SDK呼び出し側の不具合。再送しても結果は変わらない
+    return "transient"
+
+def retry_after_hint(e) -> Optional[float]:
+    """クォータエラーに付くサーバー指定の待機秒数（RetryInfo / Retry-After / メッセージ内の "retry in Ns"）"""
+    details = getattr(e, 'details', None)
+    if isinstance(details, dict):
+        for d in (details.get('error') or {}).get('details') or []:
+            if isinstance(d, dict) and str(d.get('@type', '')).endswith('RetryInfo'):
+                m = re.match(r'([\d.]+)s', str(d.get('retryDelay', '')))
+                if m:
+                    return float(m.group(1))
+    headers = getattr(getattr(e, 'response', None), 'headers', None)
+    if headers and str(headers.get('retry-after', '')).replace('.', '', 1).isdigit():
+        return float(headers['retry-after'])
+    m = re.search(r'retry in ([\d.]+)\s*s', str(e), re.IGNORECASE)
+    return float(m.group(1)) if m else None
+
+def blocked_reason(response) -> Optional[str]:
+    """プロンプトのブロック、または安全系の終了理由で打ち切られた応答なら理由を返す"""
+    feedback = getattr(response, 'prompt_feedback', None)
+    if feedback and feedback.block_reason:
+        return f"prompt {getattr(feedback.block_reason, 'value', feedback.block_reason)}"
+    for c in getattr(response, 'candidates', None) or []:
+        reason = getattr(c.finish_reason, 'value', c.finish_reason)
+        if reason in BLOCK_FINISH_REASONS:
+            return f"finish {reason}"
+    return None
+
+class CircuitBreaker:
+    """
+    モデル単位のサーキットブレーカー。直近 BREAKER_WINDOW 秒の quota / transient エラー率が閾値を超えると open にし、
+    BREAKER_OPEN_SECONDS の間はそのモデルへ送信しない。経過後は1件だけ試し（half_open）、成功で closed、失敗で open 期間を倍にする。
+    """
+    def __init__(self, model: str):
+        self.model = model
+        self.state = "closed"
+        self.events = collections.deque()   # (time.monotonic(), 成功なら True)
+        self.opened_at = 0.0
+        self.open_for = BREAKER_OPEN_SECONDS
+        self._probing = False
+        self._probe_at = 0.0
+
+    def allow(self) -> bool:
+        """送信してよいか（half_open では試行を1件だけ通す）"""
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.open_for:
+            self._set_state("half_open")
+            self._probing = False
+        if self.state == "closed":
+            return True
+        # 試行がキャンセル等で結果を返さなかった場合は一定時間後に次の試行を通す
+        if self.state == "half_open" and (not self._probing or time.monotonic() - self._probe_at > BREAKER_OPEN_SECONDS):
+            self._probing = True
+            self._probe_at = time.monotonic()
+            return True
+        return False
+
+    def remaining(self) -> float:
+        if self.state == "open":
+            return max(0.0, self.opened_at + self.open_for - time.monotonic())
+        return 1.0 if self.state == "half_open" else 0.0
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        if self.state == "half_open":
+            if ok:
+                self.open_for = BREAKER_OPEN_SECONDS
+                self.events.clear()
+                self._set_state("closed")
+            else:
+                self.open_for = min(self.open_for * 2, BREAKER_OPEN_MAX)
+                self._open(now)
+            return
+        self.events.append((now, ok))
+        while self.events and self.events[0][0] < now - BREAKER_WINDOW:
+            self.events.popleft()
+        failures = sum(1 for _, success in self.events if not success)
+        if self.state == "closed" and len(self.events) >= BREAKER_MIN_CALLS and failures / len(self.events) >= BREAKER_ERROR_RATE:
+            self._open(now)
+
+    def _open(self, now):
+        self.opened_at = now
+        self._probing = False
+        self._set_state("open")
+        print(f"⚠️ Circuit open for {self.model} ({self.open_for:.0f}s)")
+
+    def _set_state(self, state):
+        self.state = state
+        BREAKER_STATE.set({"closed": 0, "half_open": 1, "open": 2}[state], model=self.model)
+
+# ==========================================
+# 4g. Client Pool (複数APIキーの負荷分散)
+# ==========================================
+class _KeySlot:
+    """APIキー1つ分のクライアントとモデル別の利用状況"""
+    def __init__(self, key_id: str, client):
+        self.key_id = key_id
+        self.client = client          # プロセス内で使い回す（HTTP接続をキーごとに keep-alive で再利用）
+        self.inflight = {}            # model -> 実行中件数
+        self.recent = {}              # model -> deque[送信時刻]（直近60秒、KEY_RPM_LIMITS の判定用）
+        self.cooldown_until = {}      # model -> time.monotonic()。クォータ・403エラー後はこの時刻まで選ばない
+        self.strikes = {}             # model -> 連続クォータ・403エラー数
+        self.disabled = None          # 認証エラーで外した場合の理由
+
+class ClientPool:
+    """
+    GEMINI_API_KEYS の各キーに genai.Client を1つずつ持ち、モデル単位で呼び出し先のキーを選ぶ。
+    選択は実行中件数の少ないキー（least_loaded）または順番（round_robin）。RPM上限に達したキーは避ける。
+    クォータエラー・403を返したキーはそのモデルについて KEY_COOLDOWN_BASE 秒から倍々で外し（成功で復帰）、
+    無効なキー（401・API_KEY_INVALID）は以後使わない。ただし最後の1本は外さずに同じく一時的に外すだけにする。
+    使えるキーがなければ最も早く空くまで待つ。
+    """
+    def __init__(self, api_keys, policy=KEY_SELECT_POLICY, rpm_limits=None, client_factory=None):
+        if isinstance(api_keys, str):
+            api_keys = [api_keys]
+        client_factory = client_factory or (lambda key: genai.Client(api_key=key))
+        keys = list(dict.fromkeys(k for k in api_keys or [] if k))
+        # ログ・メトリクスにはキー本体ではなく連番を使う
+        self.slots = [_KeySlot(f"k{i + 1}", client_factory(k)) for i, k in enumerate(keys)]
+        self.policy = policy
+        self.rpm_limits = KEY_RPM_LIMITS if rpm_limits is None else rpm_limits
+        self._rr = {}                 # model -> 次に選ぶ位置（round_robin）
+
+    def __len__(self):
+        return len(self.slots)
+
+    @staticmethod
+    def is_quota_error(e) -> bool:
+        return classify_api_error(e) == "quota"
+
+    @staticmethod
+    def is_auth_error(e) -> bool:
+        return classify_api_error(e) == "auth"
+
+    def _recent(self, slot, model, now):
+        q = slot.recent.setdefault(model, collections.deque())
+        while q and q[0] <= now - 60:
+            q.popleft()
+        return q
+
+    def _usable(self, slot, model, now) -> bool:
+        if slot.disabled or slot.cooldown_until.get(model, 0) > now:
+            return False
+        limit = self.rpm_limits.get(model)
+        return not limit or len(self._recent(slot, model, now)) < limit
+
+    def has_capacity(self, model: str) -> bool:
+        now = time.monotonic()
+        return any(self._usable(s, model, now) for s in self.slots)
+
+    def pick(self, model: str):
+        """今すぐ使えるキーを選ぶ（なければ None）。件数は加算しない"""
+        now = time.monotonic()
+        usable = [i for i, s in enumerate(self.slots) if self._usable(s, model, now)]
+        if not usable:
+            return None
+        start = self._rr.get(model, 0)
+        # 同点は前回選んだキーの次から（round_robin はこの順序だけで選ぶ）
+        order = sorted(usable, key=lambda i: (i - start) % len(self.slots))
+        if self.policy == "least_loaded":
+            order.sort(key=lambda i: (self.slots[i].inflight.get(model, 0), len(self._recent(self.slots[i], model, now))))
+        chosen = order[0]
+        self._rr[model] = (chosen + 1) % len(self.slots)
+        return self.slots[chosen]
+
+    async def acquire(self, model: str):
+        while True:
+            slot = self.pick(model)
+            if slot:
+                slot.inflight[model] = slot.inflight.get(model, 0) + 1
+                self._recent(slot, model, time.monotonic()).append(time.monotonic())
+                KEY_INFLIGHT.inc(key=slot.key_id, model=model)
+                return slot
+            live = [s for s in self.slots if not s.disabled]
+            if not live:
+                raise RuntimeError("No usable API key (set GEMINI_API_KEY or GEMINI_API_KEYS)")
+            now = time.monotonic()
+            waits = []
+            for s in live:
+                q = self._recent(s, model, now)
+                rpm_wait = q[0] + 60 - now if self.rpm_limits.get(model) and len(q) >= self.rpm_limits[model] else 0
+                waits.append(max(s.cooldown_until.get(model, 0) - now, rpm_wait))
+            await asyncio.sleep(min(max(0.5, min(waits)), KEY_COOLDOWN_MAX))
+
+    def _unlease(self, slot, model: str):
+        slot.inflight[model] = max(0, slot.inflight.get(model, 0) - 1)
+        KEY_INFLIGHT.dec(key=slot.key_id, model=model)
+
+    def release(self, slot, model: str, error=None):
+        self._unlease(slot, model)
+        if error is None:
+            slot.strikes[model] = 0
+            return
+        kind = classify_api_error(error)
+        if kind == "auth" and any(s is not slot and not s.disabled for s in self.slots):
+            if slot.disabled is None:
+                slot.disabled = str(error)[:200]
+                KEY_DRAINS.inc(key=slot.key_id, reason="auth")
+                print(f"API key {slot.key_id} disabled: {slot.disabled}")
+        elif kind in ("quota", "forbidden", "auth"):
+            # 最後の有効なキーの認証エラーは外さずに一時的に外すだけ（誤判定でも実行全体を止めない）
+            if slot.cooldown_until.get(model, 0) > time.monotonic():
+                return   # 外す前に送信済みだったリクエストの失敗は数えない
+            strikes = slot.strikes.get(model, 0) + 1
+            slot.strikes[model] = strikes
+            # サーバーが待機秒数を指定していればそれに従う
+            cooldown = min(KEY_COOLDOWN_MAX, retry_after_hint(error) or KEY_COOLDOWN_BASE * 2 ** (strikes - 1))
+            slot.cooldown_until[model] = time.monotonic() + cooldown
+            KEY_DRAINS.inc(key=slot.key_id, reason=kind)
+            print(f"API key {slot.key_id} drained for {model} ({kind}, {cooldown:.0f}s, strike {strikes})")
+
+    @contextlib.asynccontextmanager
+    async def lease(self, model: str):
+        """キーを1つ借りて呼び出し、結果（成功・クォータ・403・認証エラー）をキーの状態に反映する"""
+        slot = await self.acquire(model)
+        try:
+            yield slot
+        except Exception as e:
+            self.release(slot, model, e)
+            raise
+        except BaseException:
+            self._unlease(slot, model)   # キャンセルは成功でも失敗でもない（連続エラー数を変えない）
+            raise
+        self.release(slot, model)
+
+# ==========================================
+# 4h. Run Budget (実行期限と縮退モード)
+# ==========================================
+class RunBudget:
+    """
+    ジョブ全体の実行期限（FACTORY_RUN_MINUTES）。エンジン経由で各段階が残り時間を参照する。
+    - degraded: 残り BUDGET_DEGRADE_MINUTES 未満。品質リトライを減らして採用ラインを下げ、上位モデルへの昇格・リワーク・バッチ投入を行わない
+    - cutoff: 残り BUDGET_RESERVE_MINUTES 未満。新しい話・ブック・ジョブに着手せず、完成分のエクスポートと送信に時間を残す
+    API呼び出しのタイムアウトも、cutoff までの残り時間を超えないよう短くなる。期限なし（0）ではどちらにもならない。
+    """
+    def __init__(self, minutes=RUN_DEADLINE_MINUTES):
+        self.deadline = time.monotonic() + minutes * 60 if minutes and minutes > 0 else None
+        self._announced = set()
+
+    def remaining(self) -> float:
+        if self.deadline is None:
+            return float('inf')
+        left = self.deadline - time.monotonic()
+        RUN_BUDGET_LEFT.set(max(0.0, left))
+        return left
+
+    def _reached(self, mode: str, minutes: float) -> bool:
+        reached = self.remaining() < minutes * 60
+        if reached and mode not in self._announced:
+            self._announced.add(mode)
+            print(f"⏱️ Run budget: entering {mode} mode ({self.remaining() / 60:.0f} min left)")
+        return reached
+
+    @property
+    def degraded(self) -> bool:
+        return self._reached("degraded", BUDGET_DEGRADE_MINUTES)
+
+    @property
+    def cutoff(self) -> bool:
+        return self._reached("cutoff", BUDGET_RESERVE_MINUTES)
+
+    def call_timeout(self) -> Optional[float]:
+        """API呼び出し1回の上限秒数（cutoff までの残り時間で頭打ち。ただし BUDGET_MIN_CALL_TIMEOUT は確保）。期限なしでは None"""
+        if self.deadline is None:
+            return None
+        return max(BUDGET_MIN_CALL_TIMEOUT, min(API_CALL_TIMEOUT, self.remaining() - BUDGET_RESERVE_MINUTES * 60))
+
+    async def sleep(self, seconds: float):
+        """cutoff を越えない範囲で待つ"""
+        await asyncio.sleep(max(0.0, min(seconds, self.remaining() - BUDGET_RESERVE_MINUTES * 60)))
+
+# ==========================================
+# 4i. Draft Reviser (段落単位のパッチ改稿)
+# ==========================================
+class DraftReviser:
+    """
+    品質ゲートやCriticで不合格になった草稿を、全文の再生成ではなく部分改稿で直す。
+    本文を段落番号付きで渡し、モデルには段落単位の差し替え（ParagraphEdit）だけを出力させてローカルで適用する。
+    段落番号は空行を除いた行に振り、空行による「溜め」は元の位置のまま残す。
+    """
+    _LABEL = re.compile(r'^\[P\d+\]\s*', re.M)
+
+    def __init__(self, engine, mode=REVISION_MODE, max_edits=REVISION_MAX_EDITS):
+        self.engine = engine
+        self.mode = mode
+        self.max_edits = max_edits
+
+    @staticmethod
+    def _split(content: str):
+        lines = str(content or "").split("\n")
+        return lines, [i for i, line in enumerate(lines) if line.strip()]
+
+    @classmethod
+    def numbered(cls, content: str) -> str:
+        lines, index = cls._split(content)
+        return "\n".join(f"[P{n}] {lines[i].strip()}" for n, i in enumerate(index, 1))
+
+    @classmethod
+    def apply(cls, content: str, edits, max_edits=REVISION_MAX_EDITS):
+        """
+        段落番号は改稿前の草稿基準で解釈する。範囲外・同じ段落への2件目以降の差し替えは無視。
+        戻り値: (改稿後の本文, 適用した件数)
+        """
+        lines, index = cls._split(content)
+        replaced, inserted, applied = {}, {}, 0
+        for edit in list(edits)[:max_edits]:
+            e = edit.model_dump() if hasattr(edit, 'model_dump') else edit
+            try:
+                n = int(e.get('index'))
+            except (TypeError, ValueError):
+                continue
+            if not 1 <= n <= len(index):
+                continue
+            line_no = index[n - 1]
+            action = e.get('action') or 'replace'
+            text = cls._LABEL.sub("", str(e.get('text') or '')).strip()
+            if action == 'insert_after' and text:
+                inserted.setdefault(line_no, []).append(text)
+            elif action in ('replace', 'delete') and line_no not in replaced and (text or action == 'delete'):
+                replaced[line_no] = text if action == 'replace' else None
+            else:
+                continue
+            applied += 1
+
+        out = []
+        for i, line in enumerate(lines):
+            if i not in replaced:
+                out.append(line)
+            elif replaced[i] is not None:
+                out.append(replaced[i])
+            out.extend(inserted.get(i, []))
+        return re.sub(r'\n{3,}', '\n\n', "\n".join(out)).strip(), applied
+
+    def next_revision(self, previous, ep_data, reason, score):
+        """不合格の草稿を次の試行でパッチ改稿するか判断する。全文書き直しに戻す場合は None"""
+        if self.mode != "patch" or not ep_data.get('content') or score < REVISION_MIN_SCORE:
+            return None
+        rounds = previous['rounds'] + 1 if previous else 0
+        if rounds >= REVISION_MAX_ROUNDS:
+            REVISIONS.inc(result="exhausted")
+            return None
+        return {"data": ep_data, "critique": reason, "rounds": rounds}
+
+    async def revise(self, revision, model, config_args, book_id, ep_num, episode_plot_text, must_resolve_instruction=""):
+        """
+        差し替えを生成して草稿に適用する。
+        戻り値: (ep_data, 推定コスト)。有効な差し替えが1件もなければ ep_data は None
+        """
+        base = revision['data']
+        prompt = self.engine.prompt_manager.get(
+            "episode_revision",
+            current_model=model,
+            ep_num=ep_num,
+            critique=revision['critique'],
+            must_resolve_instruction=must_resolve_instruction,
+            episode_plot_text=episode_plot_text,
+            numbered_draft=self.numbered(base['content']),
+            max_edits=self.max_edits,
+            schema=json.dumps(RevisionResponse.model_json_schema(), ensure_ascii=False)
+        )
+        res = await self.engine._generate_with_retry(
+            model=model,
+            contents=prompt,
+            stage="revise",
+            book_id=book_id,
+            ep_num=ep_num,
+            config=types.GenerateContentConfig(**config_args)
+        )
+        cost = ModelRouter.estimate_cost(_routed_model.get() or model, res, len(prompt))
+        text_content = res.text.strip() if res.text else ""
+        if not text_content:
+            raise ValueError("No text content returned from API")
+
+        parsed = RevisionResponse.model_validate(self.engine._parse_json_response(text_content))
+        content, applied = self.apply(base['content'], parsed.edits, self.max_edits)
+        if not applied:
+            REVISIONS.inc(result="empty")
+            return None, cost
+        REVISIONS.inc(result="applied")
+        print(f"✂️ Revised Ep {ep_num}: {applied} paragraph edit(s) applied (round {revision['rounds'] + 1})")
+        return dict(
+            base,
+            content=content,
+            summary=parsed.summary or base.get('summary', ''),
+            self_evaluation_score=parsed.self_evaluation_score,
+            low_quality_reason=parsed.low_quality_reason or revision['critique']
+        ), cost
 
 # ==========================================
 # 5. ULTRA Engine (Autopilot)
 # ==========================================
 class UltraEngine:
-    def __init__(self, api_key):
-        self.client = genai.Client(api_key=api_key) if api_key else None
+    def __init__(self, api_keys):
+        self.clients = ClientPool(api_keys)
         self.safety_settings = [
             types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="BLOCK_NONE"),
             types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_NONE"),
@@ -1322,28 +4503,154 @@ class UltraEngine:
         self.prompt_manager = PromptManager()
         self.repo = NovelRepository(db)
         self.formatter = TextFormatter(self)
-
-    async def _generate_with_retry(self, model, contents, config):
+        self.critic = CriticStage(self)
+        self.arcs = ArcPlanner(self)
+        self.memory = StoryMemory(self)
+        self.batch = BatchSubmitter(self)
+        self.breakers = {}   # model -> CircuitBreaker
+        self.budget = RunBudget()
+        self.reviser = DraftReviser(self)
+        self.router = ModelRouter(self.repo)
+        self.exporter = IncrementalExporter(self.repo)
+        self.seeds = SeedRegistry()
+        self.retriever = PassageRetriever(self.repo)
+        self.ledger = ForeshadowingLedger(self.repo)
+
+    async def shutdown(self, timeout=SHUTDOWN_DRAIN_SECONDS):
+        """
+        db.stop() の前に呼ぶ。バックグラウンドの採点・要約・バッチを timeout 秒まで待ち、残りはキャンセルする。
+        cutoff 後（縮退で drain を飛ばした場合を含む）は待たずにキャンセルし、DB停止後にタスクが書き込まないようにする。
+        """
+        if not self.budget.cutoff:
+            async def drain_all():
+                await self.critic.drain()
+                await self.memory.drain()
+                await self.batch.drain()
+            try:
+                await asyncio.wait_for(drain_all(), timeout)
+            except asyncio.TimeoutError:
+                print(f"Shutdown: background work still running after {timeout:g}s; cancelling.")
+        await self.critic.stop()
+        await self.memory.stop()
+        await self.batch.stop()
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(model)
+        return self.breakers[model]
+
+    def _route_model(self, model: str, stage: str = "misc") -> Optional[str]:
+        """サーキットが開いていれば代替モデル（MODEL_FALLBACK_STAGES 以外、または代替も開いていれば None）"""
+        if self._breaker(model).allow():
+            return model
+        fallback = MODEL_FALLBACKS.get(model) if stage in MODEL_FALLBACK_STAGES else None
+        if fallback and self._breaker(fallback).allow():
+            API_FAILOVERS.inc(model=model, fallback=fallback)
+            return fallback
+        return None
+
+    def _retry_delay(self, kind: str, error, model: str, attempt: int) -> float:
+        if kind in ("quota", "forbidden", "auth") and self.clients.has_capacity(model):
+            return random.uniform(0.1, 1.0)   # 他のキーへ切り替える
+        if kind == "quota":
+            hint = retry_after_hint(error)
+            if hint is not None:
+                return min(hint, API_RETRY_AFTER_MAX) + random.uniform(0.1, 1.0)
+        # Full jitter backoff
+        return random.uniform(0.1, min(API_BACKOFF_CAP, API_BACKOFF_BASE * 2 ** attempt))
+
+    async def _generate_with_retry(self, model, contents, config, stage="misc", book_id=None, ep_num=None):
+        """
+        エラー種別ごとに再試行する: quota / transient は API_MAX_RETRIES 回まで（quota はサーバー指定の待機秒数を優先）、
+        invalid / blocked は即失敗、空応答は API_EMPTY_RETRIES 回だけ再送。
+        モデルのサーキットが開いている間は MODEL_FALLBACKS の代替モデルへ切り替え（MODEL_FALLBACK_STAGES のみ）、
+        切り替えられなければ送信せずに最大 BREAKER_MAX_WAITS 回待つ。実際に呼んだモデルは _routed_model に残す。
+        """
         retries = 0
-        max_retries = 8
-        base_delay = 5.0
+        empty_retries = 0
+        circuit_waits = 0
+        _routed_model.set(None)
 
         while True:
+            target = self._route_model(model, stage)
+            if target is None:
+                if circuit_waits >= BREAKER_MAX_WAITS or self.budget.cutoff:
+                    raise CircuitOpen(f"circuit open for {model}")
+                delay = max(1.0, self._breaker(model).remaining())
+                print(f"⚠️ Circuit open for {model}, waiting {delay:.0f}s...")
+                await asyncio.sleep(delay)
+                circuit_waits += 1
+                continue
+            _routed_model.set(target)
+
+            key_id = None
             try:
-                return await self.client.aio.models.generate_content(
-                    model=model, 
-                    contents=contents, 
-                    config=config
-                )
+                async with self.clients.lease(target) as slot:
+                    key_id = slot.key_id
+                    started = time.monotonic()
+                    API_INFLIGHT.inc(model=target)
+                    with tracer.span("api_call", stage=stage, model=target, attempt=retries + 1, book_id=book_id, ep_num=ep_num, key=key_id) as sp:
+                        try:
+                            res = await asyncio.wait_for(
+                                slot.client.aio.models.generate_content(model=target, contents=contents, config=config),
+                                timeout=self.budget.call_timeout()
+                            )
+                        finally:
+                            API_INFLIGHT.dec(model=target)
+                            API_LATENCY.observe(time.monotonic() - started, model=target, stage=stage)
+                        usage = extract_usage(res)
+                        sp.set(prompt_tokens=usage['prompt'], output_tokens=usage['candidates'])
             except Exception as e:
-                if retries >= max_retries:
-                    raise e
-                
-                # Simple exponential backoff
-                delay = (base_delay * (2 ** retries)) + random.uniform(0.1, 1.0)
-                print(f"⚠️ API Error: {e}. Retry {retries+1}/{max_retries} in {delay:.2f}s...")
+                if key_id is None:
+                    raise   # 使えるキーがない
+                kind = classify_api_error(e)
+                API_REQUESTS.inc(model=target, stage=stage, outcome=kind)
+                await self.repo.record_api_call(book_id, ep_num, stage, target, retries + 1, False, f"[{kind}] {e}"[:500],
+                                                time.monotonic() - started, {}, 0.0, api_key=key_id)
+                if kind in ("quota", "transient"):
+                    self._breaker(target).record(False)
+                else:
+                    self._breaker(target).record(True)   # サーバーは応答している
+                retryable = kind in ("quota", "transient", "forbidden") or (kind == "auth" and self.clients.has_capacity(target))
+                if not retryable or retries >= API_MAX_RETRIES or self.budget.cutoff:
+                    raise
+                API_RETRIES.inc(model=target, stage=stage)
+                delay = self._retry_delay(kind, e, target, retries)
+                print(f"⚠️ API Error [{kind}]: {e}. Retry {retries+1}/{API_MAX_RETRIES} in {delay:.2f}s...")
                 await asyncio.sleep(delay)
                 retries += 1
+                continue
+
+            self._breaker(target).record(True)
+            latency = time.monotonic() - started
+            cost = usage_cost(target, usage)
+            reason = blocked_reason(res)
+            if reason:
+                API_REQUESTS.inc(model=target, stage=stage, outcome="blocked")
+                await self.repo.record_api_call(book_id, ep_num, stage, target, retries + 1, False, f"[blocked] {reason}",
+                                                latency, usage, cost, api_key=key_id)
+                raise GenerationBlocked(f"{target} response blocked ({reason})")
+            try:
+                has_text = bool(res.text)
+            except Exception:
+                has_text = False
+            if not has_text and empty_retries < API_EMPTY_RETRIES:
+                API_REQUESTS.inc(model=target, stage=stage, outcome="empty")
+                await self.repo.record_api_call(book_id, ep_num, stage, target, retries + 1, False, "[empty] no text in response",
+                                                latency, usage, cost, api_key=key_id)
+                empty_retries += 1
+                await asyncio.sleep(random.uniform(0.1, 1.0))
+                continue
+            API_REQUESTS.inc(model=target, stage=stage, outcome="ok" if has_text else "empty")
+            await self.repo.record_api_call(book_id, ep_num, stage, target, retries + 1, True, None,
+                                            latency, usage, cost, api_key=key_id)
+            return res
+
+    async def _generate_deferred(self, model, contents, config, stage="misc", book_id=None, ep_num=None):
+        """レイテンシを問わない生成。バッチモードでは対象ステージをバッチ投入し、それ以外は通常の呼び出し"""
+        if self.batch.accepts(stage) and not self.budget.degraded:
+            return await self.batch.generate(model, contents, config, stage=stage, book_id=book_id, ep_num=ep_num)
+        return await self._generate_with_retry(model, contents, config, stage=stage, book_id=book_id, ep_num=ep_num)
 
     def _parse_json_response(self, text: str) -> Dict[str, Any]:
         """
@@ -1364,12 +4671,14 @@ class UltraEngine:
         # Try Method A: Direct Parse
         try:
             data = json.loads(text, strict=False)
+            PARSE_RESULTS.inc(method="direct")
         except:
             # Try Method B: Regex Extraction
             match = re.search(r'(\{.*\})', text, re.DOTALL)
             if match:
                 try:
                     data = json.loads(match.group(1), strict=False)
+                    PARSE_RESULTS.inc(method="regex")
                 except:
                     pass
         
@@ -1387,6 +4696,7 @@ class UltraEngine:
                 fixed_text = re.sub(r',\s*}', '}', fixed_text)
                 
                 data = json.loads(fixed_text, strict=False)
+                PARSE_RESULTS.inc(method="repair")
             except:
                 pass
 
@@ -1405,6 +4715,7 @@ class UltraEngine:
 
             if fallback_content:
                 print("⚠️ Warning: JSON parse failed, using RegEx/Raw text fallback.")
+                PARSE_RESULTS.inc(method="fallback")
                 data = {
                     "content": fallback_content,
                     "summary": fallback_content[:200] + "...", # 簡易要約
@@ -1412,6 +4723,7 @@ class UltraEngine:
                 }
             else:
                 # 救済不可能
+                PARSE_RESULTS.inc(method="failed")
                 raise ValueError(f"Failed to parse JSON and text does not look like a novel snippet. Length: {len(text)}")
 
         # 4. キーの正規化 (Pydantic対応)
@@ -1452,13 +4764,19 @@ class UltraEngine:
     # Core Logic
     # ---------------------------------------------------------
 
-    async def generate_universe_blueprint_phase1(self):
-        """
-        第1段階: メガ・プロンプトによる一括生成
-        トレンド分析、企画立案、世界観設定、キャラ設定、アンカー生成を1コールで実行
-        """
-        print("Step 1-1: Generating World Bible (Planning & Settings via Mega-Prompt)...")
-        
+    def _structure_fields(self, total_eps, plot_structure_instruction):
+        """企画プロンプトの構成タスク部分。standard はアンカー話数、long はアーク分割を指示する"""
+        if SERIAL_MODE == "long":
+            task = self.prompt_manager.get(
+                "structure_task_arcs", total_eps=total_eps, arc_min=ARC_MIN_EPS, arc_max=ARC_MAX_EPS,
+                plot_structure_instruction=plot_structure_instruction
+            )
+            return {"structure_name": "アーク構成（Arc）", "total_eps": total_eps, "structure_task": task}
+        task = self.prompt_manager.get("structure_task_anchors", anchor_eps=ANCHOR_EPS, part_end_ep=WRITE_PHASE_EPS)
+        return {"structure_name": "章ごとのマイルストーン（Anchor）", "total_eps": total_eps, "structure_task": task}
+
+    def _legacy_bible_prompt(self, bible_schema, structure_fields):
+        """従来のトレンド分析メガ・プロンプト（シード未同梱時のフォールバック）"""
         # Hardcoded Trends
         trend_context = """
         【2026年2月 Web小説最新トレンド】
@@ -1472,21 +4790,63 @@ class UltraEngine:
         # Style List for Selection
         style_list_text = "\n".join([f"- {k}: {v['name']}" for k, v in STYLE_DEFINITIONS.items()])
         
-        # Schema 1: WorldBible (Extended with planning fields)
-        bible_schema = WorldBible.model_json_schema()
-        
-        prompt_bible = self.prompt_manager.get(
+        return self.prompt_manager.get(
             "generate_world_bible",
             trend_context=trend_context,
             style_list=style_list_text,
-            schema=json.dumps(bible_schema, ensure_ascii=False)
+            schema=json.dumps(bible_schema, ensure_ascii=False),
+            **structure_fields
         )
 
+    async def generate_universe_blueprint_phase1(self):
+        """
+        第1段階: 企画・世界観設定・キャラ設定・アンカー生成を1コールで実行
+        シードが利用可能ならローカルで企画（シード・文体）を抽選し、絞り込んだ企画書をモデルに渡す。
+        利用できない場合は従来のトレンド分析メガ・プロンプトにフォールバックする。
+        長期連載モードではアンカーの代わりにアーク構成を生成し、各話プロットは執筆直前に ArcPlanner が作る。
+        """
+        long_serial = SERIAL_MODE == "long"
+        total_eps = LONG_TARGET_EPS if long_serial else STANDARD_TARGET_EPS
+        # Schema 1: WorldBible (Extended with planning fields)
+        bible_model = SerialBible if long_serial else WorldBible
+        bible_schema = bible_model.model_json_schema()
+        seed, seed_style = None, None
+        _pending_seed_use.set(None)
+
+        # --- Select Plot Structure based on AI decision (or random fallback) ---
+        # ここではシンプルにランダム選択を維持するが、AIが選んだジャンルに親和性の高いものを優先するロジックも追加可能
+        # 今回は既存のロジック（ランダム）を使用
+        selected_pattern_id = random.choice(list(PLOT_STRUCTURES.keys()))
+        pattern = PLOT_STRUCTURES[selected_pattern_id]
+        plot_structure_instruction = f"【採用プロットパターン: {pattern['name']}】\n{pattern['flow']}"
+        structure_fields = self._structure_fields(total_eps, plot_structure_instruction)
+
+        if self.seeds.available:
+            print("Step 1-1: Generating World Bible (Seed Brief)...")
+            history = await self.repo.get_recent_seed_uses(SEED_HISTORY_WINDOW)
+            seed, seed_style = self.seeds.pick(history)
+            # 使用履歴は保存成功後に save_blueprint_to_db が記録する（失敗した試行を履歴に含めない）
+            _pending_seed_use.set((seed['seed_id'], seed['genre'], seed_style))
+            print(f"★ Selected Seed: [{seed['genre']}] {seed['type']} / Style: {seed_style}")
+            prompt_bible = self.prompt_manager.get(
+                "generate_world_bible_seeded",
+                seed_brief=self.seeds.seed_brief(seed),
+                style_brief=self.seeds.style_brief(seed_style),
+                genre=seed['genre'],
+                style_key=seed_style,
+                schema=json.dumps(bible_schema, ensure_ascii=False, separators=(',', ':')),
+                **structure_fields
+            )
+        else:
+            print("Step 1-1: Generating World Bible (Planning & Settings via Mega-Prompt)...")
+            prompt_bible = self._legacy_bible_prompt(bible_schema, structure_fields)
+
         try:
-            # Call 1: Mega Prompt
+            # Call 1: World Bible (Seed Brief / Mega Prompt)
             res_bible = await self._generate_with_retry(
                 model=MODEL_ULTRALONG,
                 contents=prompt_bible,
+                stage="bible",
                 config=types.GenerateContentConfig(
                     response_mime_type="application/json",
                     safety_settings=self.safety_settings
@@ -1517,26 +4877,44 @@ class UltraEngine:
                     if isinstance(char.get('relations'), dict): char['relations'] = json.dumps(char['relations'], ensure_ascii=False)
                     if isinstance(char.get('dialogue_samples'), dict): char['dialogue_samples'] = json.dumps(char['dialogue_samples'], ensure_ascii=False)
 
-            world_bible = WorldBible.model_validate(data_bible)
+            if seed:
+                # 抽選済みの企画を優先（モデルの言い換え・別キー選択を無効化）
+                data_bible['genre'] = seed['genre']
+                data_bible['style_key'] = seed_style
+
+            world_bible = bible_model.model_validate(data_bible)
             print(f"World Bible Generated. Genre: {world_bible.genre}, Style: {world_bible.style_key}")
 
+            if long_serial:
+                # 各話プロットは執筆直前にアーク単位で生成する（Call 2 は行わない）
+                arcs = ArcPlanner.normalize(world_bible.arcs, total_eps)
+                print(f"★ Selected Narrative Arc: {pattern['name']} / {len(arcs)} arcs for {total_eps} episodes")
+                final_structure = NovelStructure(
+                    title=world_bible.title,
+                    concept=world_bible.concept,
+                    synopsis=world_bible.synopsis,
+                    mc_profile=world_bible.mc_profile,
+                    sub_characters=world_bible.sub_characters,
+                    marketing_assets=world_bible.marketing_assets,
+                    plots=[],
+                    anchors=[],
+                    arcs=arcs,
+                    target_eps=total_eps
+                )
+                return final_structure, world_bible.genre, world_bible.style_key
+
             # Call 2
-            print("Step 1-2: Generating Plot Flow (Ep 1-50)...")
+            print(f"Step 1-2: Generating Plot Flow (Ep 1-{total_eps})...")
             plot_schema = PlotBlueprint.model_json_schema()
             
             # Serialize WorldBible for prompt
             bible_json_str = world_bible.model_dump_json(ensure_ascii=False)
             
-            # --- Select Plot Structure based on AI decision (or random fallback) ---
-            # ここではシンプルにランダム選択を維持するが、AIが選んだジャンルに親和性の高いものを優先するロジックも追加可能
-            # 今回は既存のロジック（ランダム）を使用
-            selected_pattern_id = random.choice(list(PLOT_STRUCTURES.keys()))
-            pattern = PLOT_STRUCTURES[selected_pattern_id]
-            plot_structure_instruction = f"【採用プロットパターン: {pattern['name']}】\n{pattern['flow']}"
             print(f"★ Selected Narrative Arc: {pattern['name']}")
 
             prompt_plot = self.prompt_manager.get(
                 "generate_plot_flow",
+                total_eps=total_eps,
                 world_bible_json=bible_json_str,
                 plot_structure_instruction=plot_structure_instruction, # Injected here
                 FATAL_FLAWS_GUIDELINES=FATAL_FLAWS_GUIDELINES, 
@@ -1546,6 +4924,7 @@ class UltraEngine:
             res_plot = await self._generate_with_retry(
                 model=MODEL_ULTRALONG,
                 contents=prompt_plot,
+                stage="plot",
                 config=types.GenerateContentConfig(
                     response_mime_type="application/json",
                     safety_settings=self.safety_settings
@@ -1603,9 +4982,12 @@ class UltraEngine:
         )
 
         try:
-            res = await self._generate_with_retry(
+            res = await self._generate_deferred(
                 model=MODEL_ULTRALONG, 
                 contents=prompt,
+                stage="anchor",
+                book_id=book_data['book_id'],
+                ep_num=target_ep,
                 config=types.GenerateContentConfig(
                     response_mime_type="application/json",
                     safety_settings=self.safety_settings
@@ -1640,10 +5022,11 @@ class UltraEngine:
             print(f"Anchor Gen Error Ep {target_ep}: {e}")
             return False
 
-    async def write_episodes(self, book_data, start_ep, end_ep, style_dna_str="style_web_standard", target_model=MODEL_LITE, semaphore=None):
+    async def write_episodes(self, book_data, start_ep, end_ep, style_dna_str="style_web_standard", target_model=MODEL_LITE, semaphore=None, rework_feedback=None):
         """
         1エピソード1リクエスト化: 本文・要約・Bible更新を一括実行
         ContextBuilderとNovelRepositoryによる最適化済み
+        rework_feedback: {ep_num: 差し戻し理由} が渡された話はCriticの指摘を反映して書き直す（REVISION_MODE=patch では保存済みの本文を段落単位で改稿）
         """
         all_plots = sorted(book_data['plots'], key=lambda x: x.get('ep_num', 999))
         target_plots = [p for p in all_plots if start_ep <= p.get('ep_num', -1) <= end_ep]
@@ -1651,7 +5034,6 @@ class UltraEngine:
 
         full_chapters = []
         bible_synchronizer = BibleSynchronizer(book_data['book_id'])
-        bible_manager = bible_synchronizer.bible_manager
         
         # CharacterRegistry 構築 (Main Character)
         try:
@@ -1659,13 +5041,12 @@ class UltraEngine:
         except:
             char_registry = CharacterRegistry(name="主人公", role="主人公", tone="標準", personality="", ability="", monologue_style="", pronouns="{}", keyword_dictionary="{}", relations="{}", dialogue_samples="{}")
         
-        # Sub Characters Context 構築
-        sub_chars_context = ""
+        # Sub Characters
+        sub_regs = []
         sub_chars_data = book_data.get('sub_characters', [])
         for sc in sub_chars_data:
             try:
-                sc_reg = CharacterRegistry(**sc)
-                sub_chars_context += sc_reg.get_context_prompt() + "\n"
+                sub_regs.append(CharacterRegistry(**sc))
             except: pass
 
         # 前話の文脈取得
@@ -1681,30 +5062,66 @@ class UltraEngine:
             else:
                 prev_last_sentence = content_str[-20:]
 
-        style_instruction = self.prompt_manager.apply_style(style_dna_str)
+        # キャラ定義・文体などの書籍単位の断片は PromptManager で全レンジ共有
+        prompt_fragments = self.prompt_manager.book_fragments(book_data['book_id'], char_registry, sub_regs, style_dna_str)
         
-        for plot in target_plots:
-            ep_num = plot['ep_num']
-            print(f"Hyper-Narrative Engine Writing Ep {ep_num}...")
-            
-            pacing_data = await PacingGraph.analyze(book_data['book_id'], ep_num, total_eps=50)
-            pacing_instruction = pacing_data['instruction']
-            pacing_graph = pacing_data.get('graph_visualization', '')
-            gen_temp = pacing_data['temperature']
-
-            current_model = target_model
-            if (1 <= ep_num <= 3) or ep_num == 25 or ep_num == 50 or plot.get('tension', 50) >= 80:
-                current_model = MODEL_PRO
-            
-            scenes_str = ""
-            if isinstance(plot.get('scenes'), list):
-                for s in plot['scenes']:
-                    s_dict = s.model_dump() if hasattr(s, 'model_dump') else s
-                    scenes_str += f"- {s_dict.get('location','')}: {s_dict.get('action','')} ({s_dict.get('dialogue_point','')} - {s_dict.get('role', '')})\n"
+        range_ctx = {
+            "bible_synchronizer": bible_synchronizer,
+            "retrieval_vocab": PassageRetriever.build_vocab([char_registry] + sub_regs),
+            "prompt_fragments": prompt_fragments,
+            "target_model": target_model,
+            "semaphore": semaphore,
+            "rework_feedback": rework_feedback,
+            "prev_context_text": prev_context_text,
+            "prev_last_sentence": prev_last_sentence,
+            "full_chapters": full_chapters,
+        }
+        with tracer.span("write_range", book_id=book_data['book_id'], range=f"{start_ep}-{end_ep}"):
+            for plot in target_plots:
+                if self.budget.cutoff:
+                    print(f"⏱️ Run budget cutoff: stopping before Ep {plot['ep_num']} (Range {start_ep}-{end_ep})")
+                    break
+                with tracer.span("episode", book_id=book_data['book_id'], ep_num=plot['ep_num'], range=f"{start_ep}-{end_ep}"):
+                    await self._write_single_episode(book_data, plot, range_ctx)
 
-            blueprint_str = plot.get('detailed_blueprint', '')
-            
-            episode_plot_text = f"""
+        return {"chapters": full_chapters}
+
+    async def _write_single_episode(self, book_data, plot, range_ctx):
+        """1話分の執筆・品質ゲート・保存。range_ctx の前話文脈を次話用に更新する"""
+        bible_synchronizer = range_ctx['bible_synchronizer']
+        bible_manager = bible_synchronizer.bible_manager
+        prompt_fragments = range_ctx['prompt_fragments']
+        target_model = range_ctx['target_model']
+        semaphore = range_ctx['semaphore']
+        rework_feedback = range_ctx['rework_feedback']
+        full_chapters = range_ctx['full_chapters']
+        prev_context_text = range_ctx['prev_context_text']
+        prev_last_sentence = range_ctx['prev_last_sentence']
+
+        ep_num = plot['ep_num']
+        print(f"Hyper-Narrative Engine Writing Ep {ep_num}...")
+        
+        with tracer.span("pacing", book_id=book_data['book_id'], ep_num=ep_num):
+            pacing_data = await PacingGraph.analyze(
+                book_data['book_id'], ep_num,
+                total_eps=book_data.get('target_eps') or STANDARD_TARGET_EPS,
+                arc=ArcPlanner.arc_for(book_data.get('arcs'), ep_num)
+            )
+        pacing_instruction = pacing_data['instruction']
+        pacing_graph = pacing_data.get('graph_visualization', '')
+        gen_temp = pacing_data['temperature']
+
+        current_model = target_model
+        
+        scenes_str = ""
+        if isinstance(plot.get('scenes'), list):
+            for s in plot['scenes']:
+                s_dict = s.model_dump() if hasattr(s, 'model_dump') else s
+                scenes_str += f"- {s_dict.get('location','')}: {s_dict.get('action','')} ({s_dict.get('dialogue_point','')} - {s_dict.get('role', '')})\n"
+
+        blueprint_str = plot.get('detailed_blueprint', '')
+        
+        episode_plot_text = f"""
 【Episode Title】{plot['title']}
 【Detailed Blueprint (500文字以上の詳細設計図)】
 {blueprint_str}
@@ -1716,178 +5133,282 @@ class UltraEngine:
 【Scenes】
 {scenes_str}
 """
-            
-            world_state, expected_version = await bible_manager.get_current_state()
-            bible_context = await bible_manager.get_prompt_context()
-            
-            entity_context = char_registry.get_context_prompt()
-            if sub_chars_context:
-                entity_context += "\n【IMPORTANT: SUB CHARACTERS (Must reflect their personalities)】\n" + sub_chars_context
+        
+        world_state, expected_version = await bible_manager.get_current_state()
+        bible_context = await bible_manager.get_prompt_context(recent_facts=RETRIEVAL_RECENT_FACTS if db.fts_enabled else None)
+        
+        due_items = await self.ledger.due(book_data['book_id'], ep_num)
+        must_resolve = [r['fs_id'] for r in due_items]
+        # ネタバレ禁止リストは未回収の伏線のみ（今回回収する分は除く）
+        open_texts = await self.ledger.open_texts(book_data['book_id'])
+        pending_foreshadowing = [t for t in open_texts if t not in {r['text'] for r in due_items}] if open_texts else world_state.pending_foreshadowing
+        
+        must_resolve_instruction = ""
+        if must_resolve:
+            lines = [f"- {r['fs_id']}" + (f": {r['text']}" if r['text'] != r['fs_id'] else "") for r in due_items]
+            must_resolve_instruction = (
+                "\n【IMPORTANT: Fulfilling Foreshadowing】\n以下の伏線を本エピソードで必ず回収・言及し、回収したIDを resolved_foreshadowing に記載せよ:\n"
+                + "\n".join(lines)
+            )
 
-            must_resolve = []
-            try:
-                dep_graph = json.loads(world_state.dependency_graph)
-                for fs_id, target_ep in dep_graph.items():
-                    if target_ep == ep_num:
-                        must_resolve.append(fs_id)
-            except: pass
+        with tracer.span("retrieve", book_id=book_data['book_id'], ep_num=ep_num):
+            retrieved_context = await self.retriever.context_for(
+                book_data['book_id'], ep_num, episode_plot_text, range_ctx['retrieval_vocab'], must_resolve
+            )
+            story_so_far = await self.memory.context_for(book_data['book_id'], ep_num)
+
+        async with instrumented_acquire(semaphore, book_id=book_data['book_id'], ep_num=ep_num):
+            write_prompt = self.prompt_manager.build_writing_prompt(
+                prompt_fragments,
+                pacing_instruction=pacing_instruction,
+                pacing_graph=pacing_graph,
+                prev_last_sentence=prev_last_sentence,
+                ep_num=ep_num,
+                pending_foreshadowing=json.dumps(pending_foreshadowing, ensure_ascii=False),
+                must_resolve_instruction=must_resolve_instruction,
+                retrieved_context=retrieved_context,
+                story_so_far=story_so_far,
+                prev_context_text=prev_context_text,
+                episode_plot_text=episode_plot_text,
+                expected_version=expected_version,
+                bible_context=bible_context
+            )
+
+            if rework_feedback and rework_feedback.get(ep_num):
+                write_prompt += f"\n\n【編集部からの差し戻し（最優先で修正せよ）】\n{rework_feedback[ep_num]}"
             
-            must_resolve_instruction = ""
-            if must_resolve:
-                must_resolve_instruction = f"\n【IMPORTANT: Fulfilling Foreshadowing】\n以下の伏線を本エピソードで必ず回収・言及せよ: {', '.join(must_resolve)}"
-
-            async with semaphore:
-                write_prompt = self.prompt_manager.build_writing_prompt(
-                    mc_name=char_registry.name,
-                    mc_tone=char_registry.tone,
-                    pronouns=char_registry.pronouns,
-                    relations=char_registry.relations,
-                    mc_dialogue_samples=char_registry.dialogue_samples,
-                    style_instruction=style_instruction,
-                    entity_context=entity_context,
-                    pacing_instruction=pacing_instruction,
-                    pacing_graph=pacing_graph,
-                    prev_last_sentence=prev_last_sentence,
-                    current_model=current_model,
-                    ep_num=ep_num,
-                    pending_foreshadowing=json.dumps(world_state.pending_foreshadowing, ensure_ascii=False),
-                    must_resolve_instruction=must_resolve_instruction,
-                    prev_context_text=prev_context_text,
-                    episode_plot_text=episode_plot_text,
-                    expected_version=expected_version,
-                    bible_context=bible_context,
-                    FATAL_FLAWS_GUIDELINES=FATAL_FLAWS_GUIDELINES
-                )
-                
+            # パッチ改稿: 差し戻しの書き直しは保存済みの本文を草稿として段落単位で直す
+            revision = None
+            if self.reviser.mode == "patch" and rework_feedback and rework_feedback.get(ep_num):
+                draft = await self.repo.get_chapter(book_data['book_id'], ep_num)
+                if draft and draft['content'] and draft['summary'] != 'エラー':
+                    try:
+                        draft_state = json.loads(draft['world_state']) if draft['world_state'] else {}
+                    except json.JSONDecodeError:
+                        draft_state = {}
+                    revision = {
+                        # from_saved: 整形済みの保存本文。改稿後も Formatter・Bible マージを再適用しない（改稿の各ラウンドへ引き継がれる）
+                        "data": {"content": draft['content'], "summary": draft['summary'] or '', "next_world_state": draft_state, "from_saved": True},
+                        "critique": rework_feedback[ep_num],
+                        "rounds": 0
+                    }
+
+            retry_count = 0
+            max_retries = 5
+            best_attempt = None
+
+            while retry_count < max_retries:
+                # 縮退モード: リトライ回数と採用ラインを下げ、上位モデルへは昇格しない
+                degraded = self.budget.degraded
+                if degraded:
+                    max_retries = min(max_retries, DEGRADED_MAX_RETRIES)
+                # カスケード: 安価モデルから開始し、品質ゲート失敗が続いた場合のみ上位モデルへ昇格
+                current_model = await self.router.select(book_data['book_id'], book_data.get('target_eps') or STANDARD_TARGET_EPS, 0 if degraded else retry_count)
                 gen_config_args = {"temperature": gen_temp, "safety_settings": self.safety_settings}
                 if "gemini" in current_model.lower() and "gemma" not in current_model.lower():
                     gen_config_args["response_mime_type"] = "application/json"
-                
-                retry_count = 0
-                max_retries = 5
-                best_attempt = None
-
-                while retry_count < max_retries:
-                    try:
-                        await asyncio.sleep(5.0) 
+                attempt_started = time.monotonic()
+                attempt_cost = 0.0
+                current_score = 0
+                revising, rejected = revision is not None, False
 
+                try:
+                    await asyncio.sleep(5.0) 
+                    attempt_started = time.monotonic() # レイテンシは待機後から計測（ルーターの学習値に待機を含めない）
+
+                    if revising:
+                        # 前回の草稿 + 指摘だけを渡し、段落の差し替えを受け取ってローカルで適用
+                        with tracer.span("revise", book_id=book_data['book_id'], ep_num=ep_num, round=revision['rounds'] + 1):
+                            ep_data, attempt_cost = await self.reviser.revise(
+                                revision, current_model, gen_config_args,
+                                book_data['book_id'], ep_num, episode_plot_text, must_resolve_instruction
+                            )
+                        current_model = _routed_model.get() or current_model # 代替モデルで書いた場合はそのモデルの成績として記録
+                        if ep_data is None:
+                            raise ValueError("Revision returned no applicable edits")
+                    else:
                         res = await self._generate_with_retry(
                             model=current_model, 
                             contents=write_prompt,
+                            stage="rework" if rework_feedback else "write",
+                            book_id=book_data['book_id'],
+                            ep_num=ep_num,
                             config=types.GenerateContentConfig(**gen_config_args)
                         )
+                        current_model = _routed_model.get() or current_model # 代替モデルで書いた場合はそのモデルの成績として記録
+                        attempt_cost = ModelRouter.estimate_cost(current_model, res, len(write_prompt))
                         
                         # Safe text access
                         text_content = res.text.strip() if res.text else ""
                         if not text_content:
                             raise ValueError("No text content returned from API")
                         
-                        ep_data = self._parse_json_response(text_content)
-                        
-                        current_score = ep_data.get('self_evaluation_score', 0)
-                        if best_attempt is None or current_score > best_attempt['score']:
-                            best_attempt = {
-                                "score": current_score,
-                                "content": ep_data.get('content', ''),
-                                "summary": ep_data.get('summary', ''),
-                                "data": ep_data
-                            }
+                        with tracer.span("parse", ep_num=ep_num):
+                            ep_data = self._parse_json_response(text_content)
+                    
+                    current_score = ep_data.get('self_evaluation_score', 0)
+                    if best_attempt is None or current_score > best_attempt['score']:
+                        best_attempt = {
+                            "score": current_score,
+                            "content": ep_data.get('content', ''),
+                            "summary": ep_data.get('summary', ''),
+                            "data": ep_data
+                        }
 
-                        threshold = 90
-                        if current_score < threshold:
-                             reason = ep_data.get('low_quality_reason', '理由不明')
-                             write_prompt += f"\n\n【前回の反省点（重要）】\n直前の出力は以下の理由で却下されました：『{reason}』\nこの点を絶対に改善して執筆し直してください。"
-                             print(f"⚠️ Low Quality Detected (Score: {current_score}/{threshold}): {reason}. Triggering Retry...")
-                             raise ValueError(f"Self-evaluated score is too low ({current_score} < {threshold}). Reason: {reason}")
-                        
-                        full_content = ep_data.get('content', '')
+                    threshold = DEGRADED_SCORE_THRESHOLD if degraded else INLINE_SCORE_THRESHOLD
+                    if current_score < threshold:
+                         reason = ep_data.get('low_quality_reason', '理由不明')
+                         write_prompt += f"\n\n【前回の反省点（重要）】\n直前の出力は以下の理由で却下されました：『{reason}』\nこの点を絶対に改善して執筆し直してください。"
+                         # 次の試行は全文を書き直さず、この草稿への段落差し替えで直す（見込みが薄い草稿は全文書き直し）
+                         revision, rejected = self.reviser.next_revision(revision, ep_data, reason, current_score), True
+                         print(f"⚠️ Low Quality Detected (Score: {current_score}/{threshold}): {reason}. Triggering {'Patch Revision' if revision else 'Retry'}...")
+                         QUALITY_GATE.inc(model=current_model, result="rejected")
+                         raise ValueError(f"Self-evaluated score is too low ({current_score} < {threshold}). Reason: {reason}")
+
+                    QUALITY_GATE.inc(model=current_model, result="accepted")
+                    await self.repo.record_model_outcome(book_data['book_id'], ep_num, current_model, True, current_score, time.monotonic() - attempt_started, attempt_cost)
+                    
+                    from_saved = bool(ep_data.get('from_saved'))
+                    full_content = ep_data.get('content', '')
+                    if not from_saved:
                         full_content = self.formatter.force_connect(full_content, prev_last_sentence)
-                        ep_summary = ep_data.get('summary', '')
-                        
-                        next_state_obj = WorldState(**ep_data['next_world_state']) if isinstance(ep_data.get('next_world_state'), dict) else ep_data.get('next_world_state', {})
-                        
-                        chapter_save_data = {
-                            'ep_num': ep_num,
-                            'title': plot['title'],
-                            'content': full_content,
-                            'summary': ep_summary
-                        }
-                        
-                        await bible_synchronizer.save_atomic(chapter_save_data, next_state_obj)
-                        
-                        prev_context_text = f"（第{ep_num}話要約）{ep_summary}\n（直近の文）{full_content[-200:]}"
-                        content_str = full_content.strip()
-                        match = re.search(r'[^。]+。$', content_str)
-                        if match:
-                            prev_last_sentence = match.group(0)
-                        else:
-                            prev_last_sentence = content_str[-20:]
-
-                        full_chapters.append({
-                            "ep_num": ep_num,
-                            "title": plot['title'],
-                            "content": full_content,
-                            "summary": ep_summary,
-                            "world_state": ep_data.get('next_world_state', {})
-                        })
-                        
-                        break
+                    ep_summary = ep_data.get('summary', '')
+                    
+                    next_state_obj = WorldState(**ep_data['next_world_state']) if isinstance(ep_data.get('next_world_state'), dict) else ep_data.get('next_world_state', {})
+                    
+                    chapter_save_data = {
+                        'ep_num': ep_num,
+                        'title': plot['title'],
+                        'content': full_content,
+                        'summary': ep_summary
+                    }
+                    
+                    with tracer.span("save_atomic", book_id=book_data['book_id'], ep_num=ep_num):
+                        await bible_synchronizer.save_atomic(chapter_save_data, next_state_obj, from_saved=from_saved)
+                    self.critic.submit(book_data['book_id'], ep_num)
+                    self.exporter.notify(book_data['book_id'])
+                    self.memory.notify(book_data, ep_num)
+                    
+                    prev_context_text = f"（第{ep_num}話要約）{ep_summary}\n（直近の文）{full_content[-200:]}"
+                    content_str = full_content.strip()
+                    match = re.search(r'[^。]+。$', content_str)
+                    if match:
+                        prev_last_sentence = match.group(0)
+                    else:
+                        prev_last_sentence = content_str[-20:]
+
+                    full_chapters.append({
+                        "ep_num": ep_num,
+                        "title": plot['title'],
+                        "content": full_content,
+                        "summary": ep_summary,
+                        "world_state": ep_data.get('next_world_state', {})
+                    })
+                    
+                    break
 
-                    except Exception as e:
-                        retry_count += 1
-                        print(f"Writing Error Ep{ep_num} (Attempt {retry_count}/{max_retries}): {e}")
-                        
-                        if retry_count >= max_retries:
-                            if best_attempt:
-                                print(f"⚠️ Adopting Best Effort (Score: {best_attempt['score']}) for Ep {ep_num}")
-                                full_content = best_attempt['content']
+                except Exception as e:
+                    await self.repo.record_model_outcome(book_data['book_id'], ep_num, current_model, False, current_score, time.monotonic() - attempt_started, attempt_cost)
+                    retry_count += 1
+                    print(f"Writing Error Ep{ep_num} [{current_model}] (Attempt {retry_count}/{max_retries}): {e}")
+                    if revising and not rejected:
+                        revision = None # 改稿自体が失敗したら次は全文を書き直す
+                    
+                    # cutoff 後は再試行せず、最良の試行があれば採用して保存する
+                    if retry_count >= max_retries or self.budget.cutoff:
+                        if best_attempt:
+                            print(f"⚠️ Adopting Best Effort (Score: {best_attempt['score']}) for Ep {ep_num}")
+                            from_saved = bool(best_attempt['data'].get('from_saved'))
+                            full_content = best_attempt['content']
+                            if not from_saved:
                                 full_content = self.formatter.force_connect(full_content, prev_last_sentence)
-                                ep_summary = best_attempt['summary']
-                                
-                                next_state_data = best_attempt['data'].get('next_world_state', {})
-                                next_state_obj = WorldState(**next_state_data) if isinstance(next_state_data, dict) else next_state_data
-                                
-                                chapter_save_data = {
-                                    'ep_num': ep_num,
-                                    'title': plot['title'],
-                                    'content': full_content,
-                                    'summary': ep_summary
-                                }
-                                
-                                await bible_synchronizer.save_atomic(chapter_save_data, next_state_obj)
-                                
-                                prev_context_text = f"（第{ep_num}話要約）{ep_summary}\n（直近の文）{full_content[-200:]}"
-                                content_str = full_content.strip()
-                                match = re.search(r'[^。]+。$', content_str)
-                                if match:
-                                    prev_last_sentence = match.group(0)
-                                else:
-                                    prev_last_sentence = content_str[-20:]
-
-                                full_chapters.append({
-                                    "ep_num": ep_num,
-                                    "title": plot['title'],
-                                    "content": full_content,
-                                    "summary": ep_summary,
-                                    "world_state": best_attempt['data'].get('next_world_state', {})
-                                })
+                            ep_summary = best_attempt['summary']
+                            
+                            next_state_data = best_attempt['data'].get('next_world_state', {})
+                            next_state_obj = WorldState(**next_state_data) if isinstance(next_state_data, dict) else next_state_data
+                            
+                            chapter_save_data = {
+                                'ep_num': ep_num,
+                                'title': plot['title'],
+                                'content': full_content,
+                                'summary': ep_summary
+                            }
+                            
+                            with tracer.span("save_atomic", book_id=book_data['book_id'], ep_num=ep_num, best_effort=True):
+                                await bible_synchronizer.save_atomic(chapter_save_data, next_state_obj, from_saved=from_saved)
+                            self.critic.submit(book_data['book_id'], ep_num)
+                            self.exporter.notify(book_data['book_id'])
+                            self.memory.notify(book_data, ep_num)
+                            
+                            prev_context_text = f"（第{ep_num}話要約）{ep_summary}\n（直近の文）{full_content[-200:]}"
+                            content_str = full_content.strip()
+                            match = re.search(r'[^。]+。$', content_str)
+                            if match:
+                                prev_last_sentence = match.group(0)
                             else:
-                                await self.repo.save_error_chapter(book_data['book_id'], ep_num, plot['title'], "リトライ上限到達")
-                                full_chapters.append({
-                                    "ep_num": ep_num,
-                                    "title": plot['title'],
-                                    "content": "（生成エラーが発生しました）",
-                                    "summary": "エラー",
-                                    "world_state": {}
-                                })
+                                prev_last_sentence = content_str[-20:]
+
+                            full_chapters.append({
+                                "ep_num": ep_num,
+                                "title": plot['title'],
+                                "content": full_content,
+                                "summary": ep_summary,
+                                "world_state": best_attempt['data'].get('next_world_state', {})
+                            })
                         else:
-                            await asyncio.sleep(2)
-
-        return {"chapters": full_chapters}
+                            await self.repo.save_error_chapter(book_data['book_id'], ep_num, plot['title'], "リトライ上限到達")
+                            self.memory.notify(book_data, ep_num) # ブロック末尾の話がエラーでもブロック要約を進める
+                            full_chapters.append({
+                                "ep_num": ep_num,
+                                "title": plot['title'],
+                                "content": "（生成エラーが発生しました）",
+                                "summary": "エラー",
+                                "world_state": {}
+                            })
+                    else:
+                        await asyncio.sleep(2)
+
+        range_ctx['prev_context_text'] = prev_context_text
+        range_ctx['prev_last_sentence'] = prev_last_sentence
+
+    async def rework_flagged(self, book_data, start_ep, end_ep, style_dna_str="style_web_standard", semaphore=None):
+        """Criticに差し戻された話だけを書き直す（1バッチにつき1回まで）"""
+        flagged = await self.repo.get_flagged_chapters(book_data['book_id'], start_ep, end_ep)
+        if not flagged:
+            return 0
+
+        print(f"Rework Queue: {[r['ep_num'] for r in flagged]}")
+        count = 0
+        for row in flagged:
+            try:
+                fatal_errors = json.loads(row['fatal_errors']) if row['fatal_errors'] else []
+            except:
+                fatal_errors = []
+            feedback = f"整合性: {row['consistency_score']}/100, 引き: {row['cliffhanger_score']}/100\n"
+            if fatal_errors:
+                feedback += "致命的な問題:\n" + "\n".join(f"- {err}" for err in fatal_errors) + "\n"
+            feedback += f"改善指示: {row['ai_insight'] or 'なし'}"
+            if row['suggested_diff']:
+                feedback += f"\n修正案:\n{row['suggested_diff']}"
+
+            res = await self.write_episodes(
+                book_data, row['ep_num'], row['ep_num'],
+                style_dna_str=style_dna_str,
+                semaphore=semaphore,
+                rework_feedback={row['ep_num']: feedback}
+            )
+            if res:
+                count += len(res['chapters'])
+        return count
 
     async def save_blueprint_to_db(self, data, genre, style_dna_str):
         # Delegate to Repository
-        return await self.repo.create_novel(data, genre, style_dna_str)
+        result = await self.repo.create_novel(data, genre, style_dna_str)
+        seed_use = _pending_seed_use.get()
+        if seed_use:
+            _pending_seed_use.set(None)
+            await self.repo.record_seed_use(*seed_use)
+        return result
 
     async def save_additional_plots_to_db(self, book_id, data_p2):
         # Delegate to Repository
@@ -1896,10 +5417,47 @@ class UltraEngine:
 # ==========================================
 # Task Functions (Updated to use Repository)
 # ==========================================
-async def task_write_batch(engine, bid, start_ep, end_ep):
-    repo = engine.repo
+async def save_pregenerated_anchors(repo, bid, data1):
+    """企画段階で生成したアンカー状態（standard の全話分）をANCHOR_EP_*として保存"""
+    if hasattr(data1, 'anchors') and data1.anchors:
+        print("Saving Pre-generated Anchors...")
+        for anchor in data1.anchors:
+            ws_data = anchor.world_state.model_dump()
+            if 'dependency_graph' in ws_data and isinstance(ws_data['dependency_graph'], (dict, list)):
+                ws_data['dependency_graph'] = json.dumps(ws_data['dependency_graph'], ensure_ascii=False)
+            
+            await repo.save_chapter(
+                bid,
+                anchor.ep_num,
+                f"ANCHOR_EP_{anchor.ep_num}",
+                "(ANCHOR_STATE_ONLY)",
+                anchor.summary,
+                json.dumps(ws_data, ensure_ascii=False)
+            )
+
+def process_plot_rows(plots):
+    processed_plots = []
+    for p in plots:
+        p_dict = dict(p)
+        if p_dict.get('scenes'):
+            try: p_dict['scenes'] = json.loads(p_dict['scenes'])
+            except: pass
+        if 'resolution' in p_dict:
+             p_dict['next_hook'] = p_dict['resolution']
+        processed_plots.append(p_dict)
+    return processed_plots
+
+async def load_book_data(repo, bid, start_ep=None, end_ep=None):
+    """
+    執筆に必要なブック情報（キャラ・プロット・文体・アーク）をDBから組み立てる。戻り値: (full_data, saved_style)
+    アーク構成のあるブック（長期連載）は start_ep〜end_ep のプロットだけを読み込む。
+    """
     book_info = await repo.get_book(bid)
-    plots = await repo.get_plots(bid)
+    arcs = [dict(a) for a in await repo.get_arcs(bid)]
+    if arcs and start_ep is not None:
+        plots = await repo.get_plots_between(bid, start_ep, end_ep)
+    else:
+        plots = await repo.get_plots(bid)
     mc = await repo.get_main_character(bid)
     sub_chars = await repo.get_characters(bid)
 
@@ -1924,27 +5482,15 @@ async def task_write_batch(engine, bid, start_ep, end_ep):
                 sub_char_list.append(json.loads(char['registry_data']))
             except: pass
 
-    processed_plots = []
-    for p in plots:
-        p_dict = dict(p)
-        if p_dict.get('scenes'):
-            try: p_dict['scenes'] = json.loads(p_dict['scenes'])
-            except: pass
-        if 'resolution' in p_dict:
-             p_dict['next_hook'] = p_dict['resolution']
-        processed_plots.append(p_dict)
+    full_data = {
+        "book_id": bid, "title": book_info['title'], "target_eps": book_info.get('target_eps') or STANDARD_TARGET_EPS,
+        "mc_profile": mc_profile, "sub_characters": sub_char_list, "plots": process_plot_rows(plots), "arcs": arcs
+    }
+    return full_data, saved_style
 
-    full_data = {"book_id": bid, "title": book_info['title'], "mc_profile": mc_profile, "sub_characters": sub_char_list, "plots": processed_plots}
-    
-    # 50話構成用のアンカー
-    anchors = [10, 25, 35, 45, 50]
-    
+def plan_write_ranges(start_ep, end_ep, anchors=ANCHOR_EPS):
+    """アンカー話で区切った並列執筆レンジ。戻り値: (区間内のアンカー, [(開始話, 終了話), ...])"""
     relevant_anchors = [a for a in anchors if start_ep <= a < end_ep] 
-    
-    for anchor in relevant_anchors:
-        chk = await repo.check_chapter_exists(bid, anchor)
-        if not chk:
-             await engine.generate_anchor_state(full_data, anchor)
 
     boundaries = sorted([start_ep - 1] + relevant_anchors + [end_ep])
     boundaries = sorted(list(set(boundaries)))
@@ -1955,29 +5501,81 @@ async def task_write_batch(engine, bid, start_ep, end_ep):
         e = boundaries[i+1]
         if s <= e:
             ranges.append((s, e))
+    return relevant_anchors, ranges
+
+async def finish_write_batch(engine, full_data, start_ep, end_ep, style_dna_str, semaphore=None):
+    """Critic採点の完了を待ち、差し戻された話のみリワークしてからエクスポート・伏線チェックを行う"""
+    bid = full_data['book_id']
+    reworked = 0
+    if engine.budget.degraded:
+        print(f"⏱️ Run budget: skipping critic wait and rework (Book {bid}).")
+    else:
+        with tracer.span("critic_drain", book_id=bid):
+            await engine.critic.drain()
+            await engine.memory.drain()
+        reworked = await engine.rework_flagged(full_data, start_ep, end_ep, style_dna_str=style_dna_str, semaphore=semaphore)
+        if reworked:
+            await engine.critic.drain()
+            await engine.memory.drain() # 書き直した話の要約でブロック要約を作り直してからエクスポートへ
+            print(f"Rework Done: {reworked} episodes rewritten.")
+    await engine.exporter.flush(bid)
+
+    overdue = await engine.ledger.overdue(bid, end_ep)
+    if overdue:
+        print(f"Overdue Foreshadowing (Book {bid}, through Ep {end_ep}): {len(overdue)}")
+        for r in overdue:
+            print(f"  - {r['fs_id']} (planted Ep {r['planted_ep']}, target Ep {r['target_ep']})")
+    return reworked
+
+async def write_planned_range(engine, book_data, start_ep, end_ep, style_dna_str, semaphore=None):
+    """レンジを執筆する。長期連載ではアークのプロット（と終端アンカー）を直前に生成し、そのレンジのプロットだけを読み込む"""
+    if book_data.get('arcs'):
+        await engine.arcs.ensure_plotted(book_data, end_ep)
+        plots = await engine.repo.get_plots_between(book_data['book_id'], start_ep, end_ep)
+        book_data = dict(book_data, plots=process_plot_rows(plots))
+    return await engine.write_episodes(
+        book_data, 
+        start_ep, 
+        end_ep, 
+        style_dna_str=style_dna_str, 
+        target_model=MODEL_LITE, 
+        semaphore=semaphore
+    )
+
+async def task_write_batch(engine, bid, start_ep, end_ep):
+    repo = engine.repo
+    full_data, saved_style = await load_book_data(repo, bid, start_ep, end_ep)
+    arcs = full_data['arcs']
+    relevant_anchors, ranges = plan_write_ranges(start_ep, end_ep, ArcPlanner.anchor_eps(arcs) if arcs else ANCHOR_EPS)
     
+    # 長期連載のアンカーはアークのプロット生成時に作られる
+    for anchor in ([] if arcs else relevant_anchors):
+        chk = await repo.check_chapter_exists(bid, anchor)
+        if not chk:
+            with tracer.span("anchor", book_id=bid, ep_num=anchor):
+                await engine.generate_anchor_state(full_data, anchor)
+
     print(f"Parallel Schedule: {ranges}")
+    await repo.record_write_ranges(bid, ranges)
     
     semaphore = asyncio.Semaphore(5)
 
     tasks = [] 
 
     for s, e in ranges:
-        tasks.append(engine.write_episodes(
-            full_data, 
-            s, 
-            e, 
-            style_dna_str=saved_style, 
-            target_model=MODEL_LITE, 
-            semaphore=semaphore
-        ))
+        tasks.append(write_planned_range(engine, full_data, s, e, saved_style, semaphore=semaphore))
 
-    results = await asyncio.gather(*tasks)
+    with tracer.span("write_batch", book_id=bid, range=f"{start_ep}-{end_ep}", ranges=len(ranges)):
+        results = await asyncio.gather(*tasks)
 
     total_count = 0
     for res in results:
         if res and 'chapters' in res:
             total_count += len(res['chapters'])
+
+    if arcs: # リワーク用に、執筆中に生成されたアークのプロットを読み直す
+        full_data['plots'] = process_plot_rows(await repo.get_plots_between(bid, start_ep, end_ep))
+    await finish_write_batch(engine, full_data, start_ep, end_ep, saved_style, semaphore=semaphore)
             
     print(f"Batch Done (Ep {start_ep}-{end_ep}). Total Episodes Written: {total_count}")
     return total_count, full_data, saved_style
@@ -1986,115 +5584,692 @@ async def task_write_batch(engine, bid, start_ep, end_ep):
 # 3. Main Logic
 # ==========================================
 
-async def create_zip_package(book_id, title):
-    print("Packing ZIP...")
-    buffer = io.BytesIO()
-    
-    repo = NovelRepository(db)
-    current_book = await repo.get_book(book_id)
-    db_chars = await repo.get_characters(book_id)
-    db_plots = await repo.get_plots(book_id)
-    chapters = await repo.get_chapters(book_id)
-    
+def clean_filename_title(t):
+    return re.sub(r'[\\/:*?"<>|]', '', re.sub(r'^第\d+話[\s　]*', '', t)).strip()
+
+def iter_export_files(conn, book_id, title):
+    """
+    スナップショットDBから (ZIP内パス, 本文) を1ファイルずつ生成する。
+    チャプターはカーソルを回しながら1行ずつ読むため、話数に関わらずメモリは一定。
+    """
+    conn.row_factory = sqlite3.Row
+    current_book = conn.execute("SELECT title, synopsis, special_ability, marketing_data, target_eps FROM books WHERE id=?", (book_id,)).fetchone()
+    current_book = dict(current_book) if current_book else {}
+
     marketing_data = {}
     if current_book.get('marketing_data'):
         try:
-                marketing_data = json.loads(current_book['marketing_data'])
+            marketing_data = json.loads(current_book['marketing_data'])
         except: pass
 
-    def clean_filename_title(t):
-        return re.sub(r'[\\/:*?"<>|]', '', re.sub(r'^第\d+話[\s　]*', '', t)).strip()
+    yield "00_作品登録用データ.txt", f"【タイトル】\n{title}\n\n【あらすじ】\n{current_book.get('synopsis') or ''}\n"
+
+    parts = [f"【世界観・特殊能力設定】\n{current_book.get('special_ability') or 'なし'}\n\n", "【キャラクター設定】\n"]
+    for char in conn.execute("SELECT name, role, monologue_style, registry_data FROM characters WHERE book_id=?", (book_id,)):
+        parts.append(f"■ {char['name']} ({char['role']})\n")
+        if char['monologue_style']:
+            parts.append(f"  - モノローグ癖: {char['monologue_style']}\n")
+        parts.append(f"  - Registry Data: {char['registry_data']}\n\n")
+    yield "00_キャラクター・世界観設定資料.txt", "".join(parts)
+
+    target_eps = current_book.get('target_eps') or STANDARD_TARGET_EPS
+    parts = [f"【タイトル】{title}\n【全話プロット構成案 (全{target_eps}話)】\n\n"]
+    arcs = conn.execute("SELECT arc_no, title, start_ep, end_ep, synopsis, climax, status FROM arcs WHERE book_id=? ORDER BY arc_no", (book_id,)).fetchall()
+    if arcs:
+        # 長期連載: プロット未生成のアークも構成として残す
+        parts.append("【アーク構成】\n")
+        for a in arcs:
+            mark = "" if a['status'] == 'plotted' else "（各話プロット未生成）"
+            parts.append(f"■ 第{a['arc_no']}アーク「{a['title']}」第{a['start_ep']}〜{a['end_ep']}話{mark}\n  {a['synopsis'] or ''}\n  山場: {a['climax'] or ''}\n")
+        parts.append("\n")
+    for p in conn.execute(
+        "SELECT ep_num, title, main_event, detailed_blueprint, setup, conflict, climax, resolution, tension FROM plot WHERE book_id=? ORDER BY ep_num",
+        (book_id,)
+    ):
+        parts.append(
+            f"--------------------------------------------------\n"
+            f"第{p['ep_num']}話：{p['title']}\n"
+            f"--------------------------------------------------\n"
+            f"・メインイベント: {p['main_event'] or ''}\n"
+            f"・詳細設計図: {p['detailed_blueprint'] or ''}\n"
+            f"・導入 (Setup): {p['setup'] or ''}\n"
+            f"・展開 (Conflict): {p['conflict'] or ''}\n"
+            f"・見せ場 (Climax): {p['climax'] or ''}\n"
+            f"・引き (Next Hook): {p['resolution'] or ''}\n"
+            f"・テンション: {p['tension'] if p['tension'] is not None else '-'}/100\n\n"
+        )
+    yield "00_全話プロット構成案.txt", "".join(parts)
+
+    for ch in conn.execute(
+        "SELECT ep_num, title, content FROM chapters WHERE book_id=? AND title NOT LIKE 'ANCHOR_EP_%' ORDER BY ep_num",
+        (book_id,)
+    ):
+        yield f"chapters/{ch['ep_num']:0{3 if target_eps >= 100 else 2}d}_{clean_filename_title(ch['title'])}.txt", ch['content'] or ""
+
+    if marketing_data:
+        meta = f"【タイトル】\n{title}\n\n"
+        meta += f"【キャッチコピー】\n" + "\n".join(marketing_data.get('catchcopies', [])) + "\n\n"
+        meta += f"【検索タグ】\n{' '.join(marketing_data.get('tags', []))}\n\n"
+        yield "marketing_assets.txt", meta
+        try:
+            yield "marketing_raw.json", json.dumps(marketing_data, ensure_ascii=False)
+        except: pass
 
-    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as z:
-        reg_info = f"【タイトル】\n{title}\n\n【あらすじ】\n{current_book.get('synopsis', '')}\n"
-        z.writestr("00_作品登録用データ.txt", reg_info)
+    usage_rows = [dict(r) for r in conn.execute(NovelRepository.API_USAGE_SUMMARY_SQL, (book_id,))]
+    yield "00_APIコストレポート.txt", format_usage_report(title, usage_rows)
 
-        setting_txt = f"【世界観・特殊能力設定】\n{current_book.get('special_ability', 'なし')}\n\n"
-        setting_txt += "【キャラクター設定】\n"
-        for char in db_chars:
-            setting_txt += f"■ {char['name']} ({char['role']})\n"
-            if char.get('monologue_style'):
-                setting_txt += f"  - モノローグ癖: {char['monologue_style']}\n"
-            try:
-                setting_txt += f"  - Registry Data: {char['registry_data']}\n"
-            except:
-                setting_txt += "\n"
-            setting_txt += "\n"
-        z.writestr("00_キャラクター・世界観設定資料.txt", setting_txt)
-
-        plot_txt = f"【タイトル】{title}\n【全話プロット構成案 (全50話)】\n\n"
-        for p in db_plots:
-            plot_txt += f"--------------------------------------------------\n"
-            plot_txt += f"第{p['ep_num']}話：{p['title']}\n"
-            plot_txt += f"--------------------------------------------------\n"
-            plot_txt += f"・メインイベント: {p.get('main_event', '')}\n"
-            plot_txt += f"・詳細設計図: {p.get('detailed_blueprint', '')}\n"
-            plot_txt += f"・導入 (Setup): {p.get('setup', '')}\n"
-            plot_txt += f"・展開 (Conflict): {p.get('conflict', '')}\n"
-            plot_txt += f"・見せ場 (Climax): {p.get('climax', '')}\n"
-            plot_txt += f"・引き (Next Hook): {p.get('resolution', '')}\n" 
-            plot_txt += f"・テンション: {p.get('tension', '-')}/100\n\n"
-        z.writestr("00_全話プロット構成案.txt", plot_txt)
-
-        for ch in chapters:
-            if ch['title'].startswith("ANCHOR_EP_"):
-                continue
-                
-            clean_title = clean_filename_title(ch['title'])
-            fname = f"chapters/{ch['ep_num']:02d}_{clean_title}.txt"
-            z.writestr(fname, ch['content'])
-        
-        if marketing_data:
-            meta = f"【タイトル】\n{title}\n\n"
-            meta += f"【キャッチコピー】\n" + "\n".join(marketing_data.get('catchcopies', [])) + "\n\n"
-            meta += f"【検索タグ】\n{' '.join(marketing_data.get('tags', []))}\n\n"
-            z.writestr("marketing_assets.txt", meta)
-            
-            try:
-                z.writestr("marketing_raw.json", json.dumps(marketing_data, ensure_ascii=False))
-            except: pass
-        
+    ledger_rows = [dict(r) for r in conn.execute(NovelRepository.FORESHADOWING_LEDGER_SQL, (book_id,))]
+    if ledger_rows:
+        through_ep = conn.execute(
+            "SELECT MAX(ep_num) FROM chapters WHERE book_id=? AND title NOT LIKE 'ANCHOR_EP_%'", (book_id,)
+        ).fetchone()[0] or 0
+        yield "00_伏線回収レポート.txt", format_foreshadowing_report(title, ledger_rows, through_ep)
+
+def build_zip_package(book_id, title, zip_path):
+    """
+    ZIPをディスク上に直接書き出す（同期処理）。
+    DBはバックアップAPIで取得したスナップショットから読み、同じスナップショットを同梱する。
+    """
+    snapshot_path = zip_path + ".snapshot.db"
+    try:
+        db.backup_to(snapshot_path, book_id=book_id)
+        conn = sqlite3.connect(snapshot_path)
         try:
-             z.write(DB_FILE, "factory_run.db")
-        except Exception as e:
-             print(f"DB Backup Error: {e}")
+            with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as z:
+                for arcname, text in iter_export_files(conn, book_id, title):
+                    z.writestr(arcname, text)
+                z.write(snapshot_path, "factory_run.db")
+        finally:
+            conn.close()
+    finally:
+        try: os.remove(snapshot_path)
+        except OSError: pass
+    return zip_path
 
-    buffer.seek(0)
-    return buffer.getvalue()
+async def create_zip_package(book_id, title):
+    """パッケージZIPを一時ファイルに生成してパスを返す。圧縮はイベントループ外のスレッドで行う"""
+    print("Packing ZIP...")
+    fd, zip_path = tempfile.mkstemp(prefix=f"factory_book{book_id}_", suffix=".zip")
+    os.close(fd)
+    try:
+        return await asyncio.to_thread(build_zip_package, book_id, title, zip_path)
+    except:
+        try: os.remove(zip_path)
+        except OSError: pass
+        raise
 
-def send_email(zip_data, title):
-    if not GMAIL_USER or not GMAIL_PASS:
-        print("Skipping Email: Credentials not found.")
-        return
+def write_export_delta(book_id, manifest, dest, mode):
+    """
+    前回エクスポート時のハッシュ(manifest)と比較し、変更のあったファイルだけを書き出す（同期処理）。
+    mode='dir': dest/book{ID}_{タイトル}/ 配下へ上書き。 mode='zip': dest/ に差分ZIPを作成。
+    戻り値: (更新ファイル{path: hash}, 削除ファイル[path], 書き出し先)
+    """
+    conn = sqlite3.connect(db.book_path(book_id), check_same_thread=False)
+    try:
+        conn.execute("BEGIN") # WAL上の読み取りスナップショットを固定（全ファイルを同一時点の内容で揃える）
+        row = conn.execute("SELECT title FROM books WHERE id=?", (book_id,)).fetchone()
+        title = row[0] if row and row[0] else f"book{book_id}"
+
+        changed, seen = {}, set()
+        clean_title = re.sub(r'[\\/:*?"<>|]', '', title)
+        book_dir = os.path.join(dest, f"book{book_id}_{clean_title}")
+        zip_path = os.path.join(dest, f"book{book_id}_delta_{datetime.datetime.now():%Y%m%d_%H%M%S_%f}.zip")
+        z = None
+        try:
+            for arcname, text in iter_export_files(conn, book_id, title):
+                seen.add(arcname)
+                digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                if manifest.get(arcname) == digest:
+                    continue
+                changed[arcname] = digest
+                if mode == "zip":
+                    if z is None:
+                        os.makedirs(dest, exist_ok=True)
+                        z = zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED)
+                    z.writestr(arcname, text)
+                else:
+                    out_path = os.path.join(book_dir, arcname)
+                    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                    with open(out_path + ".tmp", "w", encoding="utf-8") as f:
+                        f.write(text)
+                    os.replace(out_path + ".tmp", out_path)
+
+            removed = sorted(set(manifest) - seen) # 改題などで出力されなくなったファイル
+            if mode == "zip":
+                if removed:
+                    if z is None:
+                        os.makedirs(dest, exist_ok=True)
+                        z = zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED)
+                    z.writestr("_removed.txt", "\n".join(removed) + "\n")
+            else:
+                for arcname in removed:
+                    try: os.remove(os.path.join(book_dir, arcname))
+                    except OSError: pass
+        finally:
+            if z is not None:
+                z.close()
+    finally:
+        conn.close()
+
+    target = zip_path if mode == "zip" else book_dir
+    return changed, removed, (target if changed or removed else None)
+
+class IncrementalExporter:
+    """
+    export_manifestのコンテンツハッシュを基準に、変更分だけを書き出す差分エクスポート。
+    執筆中は notify() で完了話数を数え、EXPORT_EVERY_EPS 話ごとにバックグラウンドで公開用出力を更新する。
+    """
+    def __init__(self, repo, dest=EXPORT_DIR, mode=EXPORT_MODE, every=EXPORT_EVERY_EPS):
+        self.repo = repo
+        self.dest = dest
+        self.mode = mode
+        self.every = every
+        self._pending = {}
+        self._tasks = {}
+
+    @property
+    def target_key(self):
+        return f"{self.mode}:{os.path.abspath(self.dest)}"
+
+    def notify(self, book_id: int):
+        """1話保存ごとに呼ぶ（待機しない）"""
+        if not self.dest:
+            return
+        self._pending[book_id] = self._pending.get(book_id, 0) + 1
+        task = self._tasks.get(book_id)
+        if self._pending[book_id] >= self.every and (task is None or task.done()):
+            self._pending[book_id] = 0
+            self._tasks[book_id] = asyncio.create_task(self.export(book_id))
+
+    async def flush(self, book_id: int):
+        """実行中のエクスポートを待ち、未反映の話があれば書き出す"""
+        if not self.dest:
+            return
+        task = self._tasks.pop(book_id, None)
+        if task:
+            await asyncio.gather(task, return_exceptions=True)
+        if self._pending.pop(book_id, 0):
+            await self.export(book_id)
+
+    async def export(self, book_id: int):
+        try:
+            with tracer.span("export_delta", book_id=book_id, mode=self.mode):
+                manifest = await self.repo.get_export_manifest(book_id, self.target_key)
+                changed, removed, target = await asyncio.to_thread(write_export_delta, book_id, manifest, self.dest, self.mode)
+                await self.repo.update_export_manifest(book_id, self.target_key, changed, removed)
+            if target:
+                print(f"Incremental Export (Book {book_id}): {len(changed)} updated, {len(removed)} removed -> {target}")
+            return target
+        except Exception as e:
+            print(f"Incremental Export Error (Book {book_id}): {e}")
+            return None
+
+def format_usage_report(title, rows) -> str:
+    """get_api_usage_summaryの結果をステージ別コストレポートに整形"""
+    lines = [f"【APIコストレポート】{title}", ""]
+    lines.append(f"{'stage':<10}{'model':<26}{'kind':<7}{'calls':>6}{'errors':>7}{'prompt':>11}{'output':>10}{'cached':>10}{'thinking':>10}{'cost($)':>10}{'latency(s)':>12}")
+    totals = {"calls": 0, "prompt": 0, "output": 0, "cost": 0.0}
+    stage_costs = {}
+    for r in rows:
+        lines.append(
+            f"{r['stage'] or '-':<10}{r['model'] or '-':<26}{r['attempt_kind']:<7}{r['calls']:>6}{r['errors'] or 0:>7}"
+            f"{r['prompt_tokens'] or 0:>11}{r['candidates_tokens'] or 0:>10}{r['cached_tokens'] or 0:>10}{r['thinking_tokens'] or 0:>10}"
+            f"{r['cost'] or 0.0:>10.4f}{r['latency'] or 0.0:>12.1f}"
+        )
+        totals["calls"] += r['calls']
+        totals["prompt"] += r['prompt_tokens'] or 0
+        totals["output"] += (r['candidates_tokens'] or 0) + (r['thinking_tokens'] or 0)
+        totals["cost"] += r['cost'] or 0.0
+        stage_costs[r['stage']] = stage_costs.get(r['stage'], 0.0) + (r['cost'] or 0.0)
+
+    lines.append("")
+    lines.append("【ステージ別コスト】")
+    for stage, cost in sorted(stage_costs.items(), key=lambda x: -x[1]):
+        share = (cost / totals["cost"] * 100) if totals["cost"] else 0.0
+        lines.append(f"- {stage}: ${cost:.4f} ({share:.1f}%)")
+    lines.append("")
+    lines.append(f"合計: {totals['calls']} calls, 入力 {totals['prompt']} tokens, 出力 {totals['output']} tokens, ${totals['cost']:.4f}")
+    return "\n".join(lines) + "\n"
+
+def format_foreshadowing_report(title, rows, through_ep) -> str:
+    """伏線台帳を 期限超過 / 未回収 / 回収済み に分けて整形（through_ep: 執筆済みの最終話）"""
+    overdue, pending, resolved = [], [], []
+    for r in rows:
+        label = r['fs_id'] if r['text'] == r['fs_id'] else f"{r['fs_id']}: {r['text']}"
+        target = f"第{r['target_ep']}話" if r['target_ep'] is not None else "未定"
+        if r['status'] == 'resolved':
+            resolved.append(f"- {label}（第{r['planted_ep']}話で設置 → 第{r['resolved_ep']}話で回収 / 予定 {target}）")
+        elif r['target_ep'] is not None and r['target_ep'] <= through_ep:
+            overdue.append(f"- {label}（第{r['planted_ep']}話で設置 → 予定 {target}）")
+        else:
+            pending.append(f"- {label}（第{r['planted_ep']}話で設置 → 予定 {target}）")
 
-    print(f"Sending Email to {TARGET_EMAIL}...")
-    msg = MIMEMultipart()
-    msg['Subject'] = f"【AI Novel Factory】{title} (Phase 1: Ep 1-25 Completed)"
-    msg['From'] = GMAIL_USER
-    msg['To'] = TARGET_EMAIL
+    lines = [f"【伏線回収レポート】{title}（第{through_ep}話まで執筆済み）", ""]
+    lines.append(f"期限超過: {len(overdue)}件 / 未回収: {len(pending)}件 / 回収済み: {len(resolved)}件")
+    for heading, items in (("期限超過（回収予定話を過ぎて未回収）", overdue), ("未回収", pending), ("回収済み", resolved)):
+        lines += ["", f"■ {heading}"] + (items or ["(なし)"])
+    return "\n".join(lines) + "\n"
 
-    part = MIMEBase('application', 'zip')
-    part.set_payload(zip_data)
-    encoders.encode_base64(part)
-    clean_title = re.sub(r'[\\/:*?"<>|]', '', title)
-    part.add_header('Content-Disposition', f'attachment; filename="{clean_title}_Part1.zip"')
-    msg.attach(part)
+# ==========================================
+# Delivery Outbox (非同期メール配送)
+# ==========================================
+def split_attachment(path, limit=None) -> List[str]:
+    """上限を超える添付をバイト単位で .001, .002 ... に分割する（受信側で cat により結合）"""
+    limit = limit or MAX_ATTACHMENT_BYTES
+    if os.path.getsize(path) <= limit:
+        return [path]
+    chunks = []
+    with open(path, "rb") as src:
+        for i in itertools.count(1):
+            data = src.read(limit)
+            if not data:
+                break
+            chunk_path = f"{path}.{i:03d}"
+            with open(chunk_path, "wb") as dst:
+                dst.write(data)
+            chunks.append(chunk_path)
+    os.remove(path)
+    return chunks
+
+class DeliveryOutbox:
+    """
+    結果メールの永続キュー。
+    enqueue() はoutboxテーブルに積むだけで即座に戻り、SMTP送信はバックグラウンドスレッドが行う。
+    失敗時は指数バックオフで再試行し、未送信分は次回起動時に再開する。
+    DB更新は他の書き込みと同様にイベントループ経由でDatabaseManagerの書き込みスレッドへ渡す。
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self._loop = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        # SSL(本番プロバイダ)は認証必須。平文はローカルのスタンドインを想定
+        return bool(TARGET_EMAIL) and (bool(GMAIL_USER and GMAIL_PASS) or not SMTP_USE_SSL)
+
+    def start(self):
+        if not self.enabled:
+            print("Outbox: Credentials not found. Email delivery disabled.")
+            return
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.Thread(target=self._run, name="outbox-sender", daemon=True)
+        self._thread.start()
+
+    async def enqueue(self, book_id, zip_path, title):
+        if not self.enabled:
+            print("Skipping Email: Credentials not found.")
+            os.remove(zip_path)
+            return []
+        clean_title = re.sub(r'[\\/:*?"<>|]', '', title)
+        name = f"{clean_title}_Part1.zip"
+
+        def _stage():
+            os.makedirs(OUTBOX_DIR, exist_ok=True)
+            staged = os.path.join(OUTBOX_DIR, f"book{book_id}_{int(time.time())}_{name}")
+            os.replace(zip_path, staged)
+            return split_attachment(staged)
+
+        chunks = await asyncio.to_thread(_stage)
+        parts = [(c, name if len(chunks) == 1 else f"{name}.{i:03d}") for i, c in enumerate(chunks, 1)]
+        subject = f"【AI Novel Factory】{title} (Phase 1: Ep 1-{WRITE_PHASE_EPS} Completed)"
+        ids = await self.repo.enqueue_outbox(book_id, TARGET_EMAIL, subject, parts)
+        print(f"Queued Email for {TARGET_EMAIL}: {len(parts)} message(s)")
+        self._wake.set()
+        return ids
+
+    async def stop(self, timeout=300.0):
+        """現時点で送信可能な分を送り切ってからスレッドを止める（バックオフ待ちの分はDBに残る）"""
+        if not self._thread:
+            return
+        self._stop.set()
+        self._wake.set()
+        await asyncio.to_thread(self._thread.join, timeout)
+        if self._thread.is_alive():
+            print("Outbox: sender still busy at shutdown. Remaining mail stays queued.")
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _run(self):
+        while True:
+            try:
+                row = self._call(self.repo.get_due_outbox(time.time()))
+                if row:
+                    self._deliver(row)
+                    continue
+                if self._stop.is_set():
+                    return
+                next_due = self._call(self.repo.get_next_outbox_due())
+            except Exception as e:
+                print(f"Outbox Error: {e}")
+                if self._stop.is_set():
+                    return
+                next_due = None
+            timeout = 60.0 if next_due is None else min(max(next_due - time.time(), 0.0), 60.0)
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def _deliver(self, row):
+        attempts = row['attempts'] + 1
+        try:
+            with tracer.span("smtp_send", book_id=row['book_id'], outbox_id=row['id'], attempt=attempts):
+                self._send(row)
+        except Exception as e:
+            permanent = isinstance(e, (smtplib.SMTPAuthenticationError, smtplib.SMTPRecipientsRefused, FileNotFoundError)) or \
+                (isinstance(e, smtplib.SMTPResponseException) and 500 <= e.smtp_code < 600)
+            if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+                OUTBOX_DELIVERIES.inc(outcome="failed")
+                print(f"Email Failed (outbox #{row['id']}, attempt {attempts}): {e}")
+                self._call(self.repo.mark_outbox(row['id'], 'failed', attempts, error=repr(e)[:500]))
+            else:
+                OUTBOX_DELIVERIES.inc(outcome="retry")
+                delay = min(OUTBOX_BACKOFF_CAP, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+                print(f"Email Retry (outbox #{row['id']}, attempt {attempts}) in {delay:.0f}s: {e}")
+                self._call(self.repo.mark_outbox(row['id'], 'pending', attempts, time.time() + delay, repr(e)[:500]))
+            return
+
+        OUTBOX_DELIVERIES.inc(outcome="sent")
+        print(f"Email Sent Successfully! ({row['subject']})")
+        self._call(self.repo.mark_outbox(row['id'], 'sent', attempts))
+        try: os.remove(row['attachment_path'])
+        except OSError: pass
+
+    def _send(self, row):
+        msg = MIMEMultipart()
+        msg['Subject'] = row['subject']
+        msg['From'] = GMAIL_USER or TARGET_EMAIL
+        msg['To'] = row['recipient']
+        if row['part_total'] > 1:
+            base = row['attachment_name'].rsplit('.', 1)[0]
+            msg.attach(MIMEText(
+                f"添付は分割されています ({row['part_no']}/{row['part_total']})。\n"
+                f"全パート受信後に `cat {base}.* > {base}` で結合してください。\n", "plain", "utf-8"
+            ))
+
+        part = MIMEBase('application', 'zip' if row['part_total'] == 1 else 'octet-stream')
+        with open(row['attachment_path'], "rb") as f:
+            part.set_payload(f.read())
+        encoders.encode_base64(part)
+        # 日本語のファイル名は RFC 2231 形式で渡す（ヘッダ全体がエンコードされると添付名が読めなくなる）
+        part.add_header('Content-Disposition', 'attachment', filename=('utf-8', '', row['attachment_name']))
+        msg.attach(part)
+
+        if SMTP_USE_SSL:
+            server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=120)
+        else:
+            server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=120)
+            server.ehlo()
+            if server.has_extn("starttls"):
+                server.starttls()
+                server.ehlo()
+        with server:
+            if GMAIL_USER and GMAIL_PASS:
+                server.login(GMAIL_USER, GMAIL_PASS)
+            server.send_message(msg)
 
+async def package_and_deliver(outbox, book_id, title):
+    """ZIP生成→Outbox投入。次のブックの生成と並行して走らせる"""
     try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(GMAIL_USER, GMAIL_PASS)
-            server.send_message(msg)
-        print("Email Sent Successfully!")
+        with tracer.span("package", book_id=book_id):
+            zip_path = await create_zip_package(book_id, title)
+        with tracer.span("email_enqueue", book_id=book_id):
+            await outbox.enqueue(book_id, zip_path, title)
+        await db.close_book(book_id)
     except Exception as e:
-        print(f"Email Failed: {e}")
+        print(f"Packaging Error (Book {book_id}): {e}")
+    finally:
+        tracer.flush()
+
+# ==========================================
+# Job Queue (リース付きジョブテーブル / 複数ワーカープロセス)
+# ==========================================
+class JobQueue:
+    """
+    jobs テーブル（カタログDB）を介してワーカープロセス間で仕事を分け合う。
+    取得は楽観ロック（条件付きUPDATE + lease_token の読み直し）で行い、実行中はハートビートでリースを延長する。
+    ハートビートが途絶えたジョブはリース期限後に別ワーカーが再取得する（試行回数の上限まで）。
+    """
+    def __init__(self, repo, worker_id=None, lease=JOB_LEASE_SECONDS):
+        self.repo = repo
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease = lease
+
+    @staticmethod
+    def blueprint_job(start_ep=1, end_ep=WRITE_PHASE_EPS):
+        return {"job_key": f"blueprint:{uuid.uuid4().hex[:12]}", "kind": "blueprint", "payload": {"start_ep": start_ep, "end_ep": end_ep}}
+
+    @staticmethod
+    def book_jobs(book_id, start_ep, end_ep, arcs=None):
+        """
+        1冊分の執筆ジョブ群: アンカー → （直前のアンカーに依存する）レンジ → （全レンジに依存する）エクスポート。
+        task_write_batch と同じレンジ分割を使う。
+        長期連載（arcs あり）はアンカーの代わりにアーク単位のプロット生成ジョブを前のアークから順に連鎖させ、
+        レンジはそのレンジを含むアークのプロット生成に依存する
+        """
+        if arcs:
+            anchors, ranges = plan_write_ranges(start_ep, end_ep, ArcPlanner.anchor_eps(arcs))
+            jobs = [
+                {
+                    "job_key": f"arc_plot:{book_id}:{a['arc_no']}", "kind": "arc_plot", "book_id": book_id,
+                    "payload": {"arc_no": a['arc_no'], "start_ep": a['start_ep'], "end_ep": a['end_ep']}, "priority": 2,
+                    "depends_on": [f"arc_plot:{book_id}:{a['arc_no'] - 1}"] if a['arc_no'] > 1 else [],
+                }
+                for a in arcs if a['start_ep'] <= end_ep and a['end_ep'] >= start_ep
+            ]
+            range_deps = lambda s, e: [f"arc_plot:{book_id}:{ArcPlanner.arc_for(arcs, e)['arc_no']}"]
+        else:
+            anchors, ranges = plan_write_ranges(start_ep, end_ep)
+            jobs = [
+                {"job_key": f"anchor:{book_id}:{a}", "kind": "anchor", "book_id": book_id, "payload": {"ep": a}, "priority": 2}
+                for a in anchors
+            ]
+            range_deps = lambda s, e: [f"anchor:{book_id}:{s - 1}"] if s - 1 in anchors else []
+        range_keys = []
+        for s, e in ranges:
+            key = f"range:{book_id}:{s}-{e}"
+            range_keys.append(key)
+            jobs.append({
+                "job_key": key, "kind": "range", "book_id": book_id, "payload": {"start_ep": s, "end_ep": e}, "priority": 1,
+                "depends_on": range_deps(s, e),
+            })
+        jobs.append({
+            "job_key": f"export:{book_id}:{start_ep}-{end_ep}", "kind": "export", "book_id": book_id,
+            "payload": {"start_ep": start_ep, "end_ep": end_ep}, "depends_on": range_keys,
+        })
+        return jobs, ranges
+
+    async def enqueue(self, jobs):
+        await self.repo.enqueue_jobs(jobs)
+
+    async def claim(self):
+        """実行可能なジョブを1件リースする（なければ None）"""
+        now = time.time()
+        await self.repo.reap_jobs(now)
+        for row in await self.repo.get_claimable_jobs(now, limit=5):
+            job = await self.repo.try_lease_job(row['id'], self.worker_id, uuid.uuid4().hex, now, self.lease)
+            if job:
+                try: job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+                except json.JSONDecodeError: job['payload'] = {}
+                return job
+        return None
+
+    async def heartbeat(self, job) -> bool:
+        return await self.repo.heartbeat_job(job['id'], job['lease_token'], time.time(), self.lease)
+
+    async def complete(self, job):
+        await self.repo.finish_job(job['id'], job['lease_token'])
+
+    async def fail(self, job, error):
+        delay = JOB_RETRY_BASE * 2 ** (job['attempts'] - 1) * random.uniform(0.5, 1.0)
+        await self.repo.finish_job(job['id'], job['lease_token'], error=repr(error)[:500], retry_at=time.time() + delay)
+
+    async def requeue(self, job, reason):
+        await self.repo.requeue_job(job['id'], job['lease_token'], str(reason)[:500])
+
+    async def has_open_jobs(self) -> bool:
+        return any(r['status'] in ('pending', 'running') for r in await self.repo.get_job_summary())
+
+class BudgetCutoff(RuntimeError):
+    """実行期限（cutoff）で途中までしか進められなかったジョブ。失敗に数えず pending に戻す"""
+
+class FactoryWorker:
+    """
+    ジョブを取得して実行するワーカー（python headless_factory.py worker）。
+    同一マシンの複数プロセス・複数マシン（DBを共有できる場合）で起動してよい。
+    """
+    def __init__(self, engine, jobs: JobQueue, outbox, slots=JOB_WORKER_SLOTS):
+        self.engine = engine
+        self.jobs = jobs
+        self.outbox = outbox
+        self.slots = slots
+        self.semaphore = asyncio.Semaphore(5)
+        self.handlers = {
+            "blueprint": self._run_blueprint,
+            "anchor": self._run_anchor,
+            "arc_plot": self._run_arc_plot,
+            "range": self._run_range,
+            "export": self._run_export,
+        }
+
+    async def run(self, exit_when_idle=False):
+        print(f"Worker {self.jobs.worker_id} started ({self.slots} slots).")
+        running = set()
+        while True:
+            cutoff = self.engine.budget.cutoff
+            job = await self.jobs.claim() if len(running) < self.slots and not cutoff else None
+            if job:
+                running.add(asyncio.create_task(self._execute(job)))
+                continue
+            if not running and exit_when_idle and not await self.jobs.has_open_jobs():
+                print("No open jobs left. Worker exiting.")
+                return
+            if not running and cutoff:
+                print("Run budget cutoff. Worker exiting (remaining jobs stay queued).")
+                return
+            if running:
+                _, running = await asyncio.wait(running, timeout=JOB_POLL_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(JOB_POLL_SECONDS)
+
+    async def _execute(self, job):
+        """ハートビートを送りながらジョブを実行。リースを失ったら（別ワーカーが再取得）中断する"""
+        print(f"Job #{job['id']} {job['job_key']} started (attempt {job['attempts']}/{job['max_attempts']}).")
+        work = asyncio.create_task(self.handlers[job['kind']](job))
+        try:
+            while True:
+                done, _ = await asyncio.wait({work}, timeout=JOB_HEARTBEAT_SECONDS)
+                if done:
+                    break
+                if not await self.jobs.heartbeat(job):
+                    print(f"Job #{job['id']} lease lost. Abandoning.")
+                    work.cancel()
+                    await asyncio.gather(work, return_exceptions=True) # 中断が終わるまで待つ（新しい持ち主と並走させない）
+                    JOB_RUNS.inc(kind=job['kind'], outcome="lease_lost")
+                    return
+            work.result()
+        except BudgetCutoff as e:
+            print(f"Job #{job['id']} {job['job_key']} paused: {e}")
+            JOB_RUNS.inc(kind=job['kind'], outcome="requeued")
+            await self.jobs.requeue(job, e)
+            return
+        except Exception as e:
+            print(f"Job #{job['id']} {job['job_key']} failed: {e}")
+            JOB_RUNS.inc(kind=job['kind'], outcome="failed")
+            await self.jobs.fail(job, e)
+            return
+        finally:
+            tracer.flush()
+        JOB_RUNS.inc(kind=job['kind'], outcome="done")
+        await self.jobs.complete(job)
+        print(f"Job #{job['id']} {job['job_key']} done.")
+
+    async def _run_blueprint(self, job):
+        """企画・設定・プロット生成 → 保存し、そのブックの執筆ジョブ群を登録する"""
+        engine = self.engine
+        _planning_key.set(job['job_key']) # 企画コールをこのジョブのキーで記録（ジョブごとのタスク内なので他ジョブへ漏れない）
+        bid = job.get('book_id')
+        if bid:
+            # 前回の試行で保存済み: 作り直さずに続きから（事前生成アンカーは anchor ジョブが補う）
+            print(f"Resuming {job['job_key']} with saved Book {bid}.")
+        else:
+            with tracer.span("blueprint", job=job['job_key']):
+                data1, generated_genre, generated_style = await engine.generate_universe_blueprint_phase1()
+            if not data1:
+                raise RuntimeError("Blueprint Gen failed")
+            # 生成中にリースを失っていたら保存しない（再取得したワーカーが同じジョブで別のブックを作るため）
+            if not await self.jobs.heartbeat(job):
+                raise RuntimeError("Lease lost before saving the blueprint")
+            bid, _ = await engine.save_blueprint_to_db(data1, generated_genre, generated_style)
+            await engine.repo.set_job_book(job['id'], job['lease_token'], bid)
+            await save_pregenerated_anchors(engine.repo, bid, data1)
+        await engine.repo.claim_unassigned_api_calls(bid, job['job_key'])
+        arcs = [dict(a) for a in await engine.repo.get_arcs(bid)]
+        jobs, ranges = self.jobs.book_jobs(bid, job['payload'].get('start_ep', 1), job['payload'].get('end_ep', WRITE_PHASE_EPS), arcs)
+        await engine.repo.record_write_ranges(bid, ranges)
+        await self.jobs.enqueue(jobs)
+        print(f"Plot Phase Saved. ID: {bid}. Queued {len(jobs)} jobs: {ranges}")
+
+    async def _run_anchor(self, job):
+        bid, ep = job['book_id'], job['payload']['ep']
+        if await self.engine.repo.check_chapter_exists(bid, ep):
+            return
+        full_data, _ = await load_book_data(self.engine.repo, bid)
+        with tracer.span("anchor", book_id=bid, ep_num=ep):
+            if not await self.engine.generate_anchor_state(full_data, ep):
+                raise RuntimeError(f"Anchor generation failed (Ep {ep})")
+
+    async def _run_arc_plot(self, job):
+        """長期連載: 1アーク分の各話プロットと終端アンカーを生成（前のアークのジョブ完了後に実行される）"""
+        payload = job['payload']
+        full_data, _ = await load_book_data(self.engine.repo, job['book_id'], payload['start_ep'], payload['end_ep'])
+        await self.engine.arcs.ensure_plotted(full_data, payload['end_ep'])
+
+    async def _run_range(self, job):
+        """レンジ執筆。再取得時は先頭から連続して完了済みの話を飛ばして再開する"""
+        bid = job['book_id']
+        start_ep, end_ep = job['payload']['start_ep'], job['payload']['end_ep']
+        full_data, saved_style = await load_book_data(self.engine.repo, bid, start_ep, end_ep)
+        completed = {p['ep_num'] for p in full_data['plots'] if p.get('status') == 'completed'}
+        while start_ep <= end_ep and start_ep in completed:
+            start_ep += 1
+        if start_ep > end_ep:
+            return
+        res = await write_planned_range(self.engine, full_data, start_ep, end_ep, saved_style, semaphore=self.semaphore)
+        if len((res or {}).get('chapters', [])) < end_ep - start_ep + 1 and self.engine.budget.cutoff:
+            # 書けた話は保存済み。失敗に数えず pending に戻し、次回の実行で続きから再開させる
+            raise BudgetCutoff(f"run budget cutoff before finishing Ep {start_ep}-{end_ep}")
+        # 採点結果をDBに確定させてから完了扱いにする（エクスポートジョブのリワーク判定に必要）
+        await self.engine.critic.drain()
+        await self.engine.memory.drain()
+
+    async def _run_export(self, job):
+        """全レンジ完了後: リワーク → エクスポート → 完了マーク → ZIP作成・Outbox投入"""
+        bid = job['book_id']
+        full_data, saved_style = await load_book_data(self.engine.repo, bid, job['payload']['start_ep'], job['payload']['end_ep'])
+        await finish_write_batch(self.engine, full_data, job['payload']['start_ep'], job['payload']['end_ep'], saved_style, semaphore=self.semaphore)
+        await self.engine.repo.set_book_status(bid, 'completed')
+        with tracer.span("package", book_id=bid):
+            zip_path = await create_zip_package(bid, full_data['title'])
+        with tracer.span("email_enqueue", book_id=bid):
+            await self.outbox.enqueue(bid, zip_path, full_data['title'])
+        await self.engine.repo.db.close_book(bid) # 長時間動くワーカーでブックごとのシャードが開いたまま溜まらないようにする
+        print(f"Mission Complete: {full_data['title']}")
 
 async def main():
-    if not API_KEY:
-        print("Error: GEMINI_API_KEY is missing.")
+    if not API_KEYS:
+        print("Error: GEMINI_API_KEY (or GEMINI_API_KEYS) is missing.")
         return
 
     await db.start() 
-    engine = UltraEngine(API_KEY)
+    engine = UltraEngine(API_KEYS)
+    metrics.serve()
+    metrics_task = asyncio.create_task(metrics.run_exporter()) if METRICS_FILE else None
+    outbox = DeliveryOutbox(engine.repo)
+    outbox.start()
+    package_tasks = set()
 
     print("Starting Factory Pipeline (Limited to 5 Books)...")
     
@@ -2102,11 +6277,17 @@ async def main():
     book_count = 0
 
     while book_count < max_books:
+        if engine.budget.degraded:
+            print("⏱️ Run budget: not starting another book.")
+            break
         print(f"\n=== Starting New Novel Generation Sequence ({book_count + 1}/{max_books}) at {datetime.datetime.now()} ===")
         try:
             # Step 1: メガプロンプトによる一括生成 (企画 + 設定 + アンカー)
             print("Step 1: Generating Universe Blueprint (Planning & Settings)...")
-            data1, generated_genre, generated_style = await engine.generate_universe_blueprint_phase1()
+            planning_key = f"main:{uuid.uuid4().hex[:12]}"
+            _planning_key.set(planning_key) # このサイクルの企画コールだけを保存後のブックに紐付ける
+            with tracer.span("blueprint", book_seq=book_count + 1):
+                data1, generated_genre, generated_style = await engine.generate_universe_blueprint_phase1()
             
             if not data1: 
                 print("Blueprint Gen failed. Skipping to next cycle.")
@@ -2114,29 +6295,15 @@ async def main():
                 continue
 
             bid, plots_p1 = await engine.save_blueprint_to_db(data1, generated_genre, generated_style)
+            await engine.repo.claim_unassigned_api_calls(bid, planning_key)
             print(f"Plot Phase Saved. ID: {bid}")
             
-            # --- Save Pre-generated Anchors (All 50 eps range) ---
-            if hasattr(data1, 'anchors') and data1.anchors:
-                print("Saving Pre-generated Anchors...")
-                for anchor in data1.anchors:
-                    ws_data = anchor.world_state.model_dump()
-                    if 'dependency_graph' in ws_data and isinstance(ws_data['dependency_graph'], (dict, list)):
-                        ws_data['dependency_graph'] = json.dumps(ws_data['dependency_graph'], ensure_ascii=False)
-                    
-                    await engine.repo.save_chapter(
-                        bid,
-                        anchor.ep_num,
-                        f"ANCHOR_EP_{anchor.ep_num}",
-                        "(ANCHOR_STATE_ONLY)",
-                        anchor.summary,
-                        json.dumps(ws_data, ensure_ascii=False)
-                    )
+            await save_pregenerated_anchors(engine.repo, bid, data1)
             
-            print("Step 2: Execution - Writing Episodes (Ep 1-25 only)...")
+            print(f"Step 2: Execution - Writing Episodes (Ep 1-{WRITE_PHASE_EPS} only)...")
             
-            # 1話〜25話のみ執筆 (50話までのプロットはDBに残る)
-            count_p1, full_data_final, saved_style = await task_write_batch(engine, bid, start_ep=1, end_ep=25)
+            # 1話〜WRITE_PHASE_EPS話のみ執筆 (残りのプロット・アークはDBに残る)
+            count_p1, full_data_final, saved_style = await task_write_batch(engine, bid, start_ep=1, end_ep=WRITE_PHASE_EPS)
             
             # Finalize
             print("Running Final Packaging (Phase 1)...")
@@ -2144,16 +6311,20 @@ async def main():
             # Repository経由でタイトル取得
             book_info = await engine.repo.get_book(bid)
             title = book_info['title']
+            # 期限で途中までしか書けなかった場合も、書けた分をパッケージして送る
+            await engine.repo.set_book_status(bid, 'partial' if engine.budget.cutoff and count_p1 < WRITE_PHASE_EPS else 'completed')
             
-            zip_bytes = await create_zip_package(bid, title)
-            send_email(zip_bytes, title)
+            # パッケージングと送信は次のブックの生成と並行して進める
+            task = asyncio.create_task(package_and_deliver(outbox, bid, title))
+            package_tasks.add(task)
+            task.add_done_callback(package_tasks.discard)
             
             book_count += 1
             print(f"Mission Complete: {title}. Books created: {book_count}/{max_books}")
             
             if book_count < max_books:
                  print("Moving to next creation in 60 seconds...")
-                 await asyncio.sleep(60)
+                 await engine.budget.sleep(60)
             else:
                  print("Target book count reached. Factory shutting down.")
             
@@ -2162,8 +6333,95 @@ async def main():
             import traceback
             traceback.print_exc()
             print("Recovering... sleeping for 300 seconds before retry.")
-            await asyncio.sleep(300)
+            await engine.budget.sleep(300)
+
+    if package_tasks:
+        await asyncio.gather(*package_tasks, return_exceptions=True)
+    await engine.shutdown()
+    await outbox.stop()
+    await db.stop()
+
+    if metrics_task:
+        metrics_task.cancel()
+        metrics.write_textfile()
+    trace_path = tracer.export_chrome_trace()
+    if trace_path:
+        print(f"Trace exported: {trace_path}")
+
+async def export_main(argv):
+    """手動の差分エクスポート: python headless_factory.py export <book_id> [出力先] [--zip]"""
+    args = [a for a in argv if not a.startswith("--")]
+    if not args:
+        print("Usage: python headless_factory.py export <book_id> [dest] [--zip]")
+        return
+    await db.start()
+    exporter = IncrementalExporter(
+        NovelRepository(db),
+        dest=args[1] if len(args) > 1 else (EXPORT_DIR or "export"),
+        mode="zip" if "--zip" in argv else EXPORT_MODE
+    )
+    target = await exporter.export(int(args[0]))
+    if not target:
+        print("No changes since last export.")
+    await db.stop()
+
+def _cli_option(argv, name, default):
+    """--name N 形式のオプションを取り出す"""
+    if name in argv and argv.index(name) + 1 < len(argv):
+        return type(default)(argv[argv.index(name) + 1])
+    return default
+
+async def enqueue_main(argv):
+    """ジョブ投入: python headless_factory.py enqueue [--books N] [--eps N]"""
+    await db.start()
+    jobs = JobQueue(NovelRepository(db))
+    books, eps = _cli_option(argv, "--books", 1), _cli_option(argv, "--eps", WRITE_PHASE_EPS)
+    await jobs.enqueue([JobQueue.blueprint_job(1, eps) for _ in range(books)])
+    print(f"Queued {books} blueprint job(s) (Ep 1-{eps}).")
+    await db.stop()
+
+async def jobs_main(argv):
+    """ジョブ状況の表示: python headless_factory.py jobs"""
+    await db.start()
+    repo = NovelRepository(db)
+    for r in await repo.get_job_summary():
+        print(f"{r['kind']:<10} {r['status']:<8} {r['n']}")
+    now = time.time()
+    for r in await repo.get_active_jobs():
+        lease = f"lease {r['lease_expires_at'] - now:+.0f}s by {r['lease_owner']}" if r['status'] == 'running' and r['lease_expires_at'] else (r['last_error'] or "")
+        print(f"  #{r['id']} {r['job_key']} [{r['status']} {r['attempts']}/{r['max_attempts']}] {lease}")
+    for r in await repo.get_batch_summary():
+        print(f"batch/{r['mode']:<8} {r['status']:<9} {r['n']} ({r['requests']} requests)")
+    await db.stop()
+
+async def worker_main(argv):
+    """ジョブワーカー: python headless_factory.py worker [--slots N] [--deliver] [--exit-when-idle]"""
+    if not API_KEYS:
+        print("Error: GEMINI_API_KEY (or GEMINI_API_KEYS) is missing.")
+        return
+    await db.start()
+    engine = UltraEngine(API_KEYS)
+    metrics.serve()
+    metrics_task = asyncio.create_task(metrics.run_exporter()) if METRICS_FILE else None
+    # SMTP送信は --deliver を付けたワーカーだけが行う（他のワーカーはoutboxに積むのみ）
+    outbox = DeliveryOutbox(engine.repo)
+    if "--deliver" in argv:
+        outbox.start()
+    worker = FactoryWorker(engine, JobQueue(engine.repo), outbox, slots=_cli_option(argv, "--slots", JOB_WORKER_SLOTS))
+    try:
+        await worker.run(exit_when_idle="--exit-when-idle" in argv)
+    finally:
+        await engine.shutdown()
+        await outbox.stop()
+        await db.stop()
+        if metrics_task:
+            metrics_task.cancel()
+            metrics.write_textfile()
 
 if __name__ == "__main__":
-
-    asyncio.run(main())
+    import sys
+    commands = {"export": export_main, "enqueue": enqueue_main, "jobs": jobs_main, "worker": worker_main}
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        asyncio.run(commands[sys.argv[1]](sys.argv[2:]))
+    else:
+        asyncio.run(main())
@@ -0,0 +1,71 @@
+"""
+ForeshadowingLedger の往復検証（設置 → 回収予定話で due → 回収報告で resolved）。
+"""
+import asyncio
+
+import headless_factory as hf
+
+
+async def _with_ledger(tmp_path, body):
+    database = hf.DatabaseManager(str(tmp_path / "factory_run.db"))
+    await database.start()
+    try:
+        repo = hf.NovelRepository(database)
+        return await body(repo, hf.ForeshadowingLedger(repo))
+    finally:
+        await database.stop()
+
+
+def test_planted_thread_becomes_due_then_resolved(tmp_path):
+    async def body(repo, ledger):
+        planted = hf.WorldState(planted_foreshadowing=[{"id": "F1", "text": "主人公の左手に浮かぶ黒い紋章", "target_ep": "第3話"}])
+        await ledger.apply(1, 1, planted)
+        assert await ledger.due(1, 2) == []
+        due = await ledger.due(1, 3)
+        assert [(r['fs_id'], r['text'], r['planted_ep']) for r in due] == [("F1", "主人公の左手に浮かぶ黒い紋章", 1)]
+
+        # 回収報告はIDではなく言い換えの本文で返ってくることがある
+        await ledger.apply(1, 3, hf.WorldState(resolved_foreshadowing=["主人公の左手に浮かんだ黒い紋章の正体"]))
+        assert await ledger.due(1, 3) == []
+        assert await ledger.overdue(1, 10) == []
+        assert await ledger.open_texts(1) == []
+
+    asyncio.run(_with_ledger(tmp_path, body))
+
+
+def test_legacy_texts_are_linked_to_graph_ids(tmp_path):
+    async def body(repo, ledger):
+        legacy = hf.WorldState(
+            pending_foreshadowing=["[F2] 図書館の閉ざされた扉", "老人が残した青い鍵"],
+            dependency_graph='{"F2": 4, "F3": "第5話"}',
+        )
+        await ledger.apply(1, 1, legacy)
+        assert [(r['fs_id'], r['text']) for r in await ledger.due(1, 4)] == [("F2", "[F2] 図書館の閉ざされた扉")]
+        assert [(r['fs_id'], r['text']) for r in await ledger.due(1, 5)] == [("F3", "老人が残した青い鍵")]
+
+        await ledger.apply(1, 5, hf.WorldState(resolved_foreshadowing=["F3"]))
+        assert [r['fs_id'] for r in await ledger.overdue(1, 5)] == ["F2"]
+
+    asyncio.run(_with_ledger(tmp_path, body))
+
+
+def test_ids_match_whole_tokens_and_mysteries_need_explicit_ids(tmp_path):
+    async def body(repo, ledger):
+        planted = hf.WorldState(planted_foreshadowing=[
+            {"id": "F1", "text": "井戸の底から聞こえる歌声", "target_ep": 9},
+            {"id": "F12", "text": "消えた灯台守の日記", "target_ep": 9},
+            {"id": "F13", "text": "双子の片割れが持つ銀の指輪", "target_ep": 9},
+        ])
+        await ledger.apply(1, 1, planted)
+
+        # F12 の回収報告で F1 を回収済みにしない
+        await ledger.apply(1, 2, hf.WorldState(resolved_foreshadowing=["F12の真相が明かされた"]))
+        assert sorted(r['fs_id'] for r in await ledger.due(1, 9)) == ["F1", "F13"]
+
+        # 解明された謎は言い換えでは回収扱いにせず、IDを明示したときだけ回収する
+        await ledger.apply(1, 3, hf.WorldState(revealed_mysteries=["井戸の底から聞こえた歌声の正体"]))
+        assert sorted(r['fs_id'] for r in await ledger.due(1, 9)) == ["F1", "F13"]
+        await ledger.apply(1, 4, hf.WorldState(revealed_mysteries=["[F13] 指輪の持ち主"]))
+        assert [r['fs_id'] for r in await ledger.due(1, 9)] == ["F1"]
+
+    asyncio.run(_with_ledger(tmp_path, body))
@@ -0,0 +1,154 @@
+"""
+DeliveryOutbox の配送検証（ローカルのSMTPスタンドイン相手に送る）。
+FACTORY_SMTP_HOST / FACTORY_SMTP_PORT / FACTORY_SMTP_SSL=0 と同じ設定をモジュール定数で差し替えて使う。
+"""
+import asyncio
+import email
+import threading
+import time
+
+import pytest
+
+smtpd = pytest.importorskip("smtpd")   # 3.12 で標準ライブラリから削除
+asyncore = pytest.importorskip("asyncore")
+
+import headless_factory as hf
+
+
+class StandinServer(smtpd.SMTPServer):
+    """受信したメールを保持し、replies に積んだ応答（例: '451 ...'）を先頭から順に返す"""
+    def __init__(self, replies=()):
+        super().__init__(("127.0.0.1", 0), None, decode_data=False)
+        self.port = self.socket.getsockname()[1]
+        self.replies = list(replies)
+        self.received = []
+        self.rejected = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        if self.replies:
+            self.rejected += 1
+            return self.replies.pop(0)
+        self.received.append(email.message_from_bytes(data))
+        return None
+
+
+@pytest.fixture
+def smtp_server(monkeypatch, tmp_path):
+    servers = []
+
+    def start(replies=()):
+        server = StandinServer(replies)
+        servers.append(server)
+        monkeypatch.setattr(hf, "SMTP_HOST", "127.0.0.1")
+        monkeypatch.setattr(hf, "SMTP_PORT", server.port)
+        monkeypatch.setattr(hf, "SMTP_USE_SSL", False)
+        return server
+
+    monkeypatch.setattr(hf, "TARGET_EMAIL", "reader@example.com")
+    monkeypatch.setattr(hf, "GMAIL_USER", None)
+    monkeypatch.setattr(hf, "GMAIL_PASS", None)
+    monkeypatch.setattr(hf, "OUTBOX_DIR", str(tmp_path / "outbox"))
+    monkeypatch.setattr(hf, "OUTBOX_BACKOFF_BASE", 0.05)
+    monkeypatch.setattr(hf, "OUTBOX_BACKOFF_CAP", 0.2)
+    stop = threading.Event()
+
+    def loop():
+        while not stop.is_set():
+            asyncore.loop(timeout=0.05, count=1)
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    yield start
+    stop.set()
+    thread.join(5)
+    for server in servers:
+        server.close()
+
+
+async def _deliver(tmp_path, payload, timeout=20.0):
+    """ZIPをoutboxに積み、全パートが sent / failed になるまで待って outbox 行を返す"""
+    database = hf.DatabaseManager(str(tmp_path / "factory_run.db"))
+    await database.start()
+    repo = hf.NovelRepository(database)
+    outbox = hf.DeliveryOutbox(repo)
+    outbox.start()
+    zip_path = tmp_path / "book.zip"
+    zip_path.write_bytes(payload)
+    try:
+        ids = await outbox.enqueue(1, str(zip_path), "テスト作品")
+        deadline = time.monotonic() + timeout
+        while True:
+            rows = await database.fetch_all("SELECT * FROM outbox ORDER BY id")
+            if all(r['status'] != 'pending' for r in rows) or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.05)
+        assert [r['id'] for r in rows] == ids
+        return rows
+    finally:
+        await outbox.stop(timeout=10)
+        await database.stop()
+
+
+def _attachment(msg):
+    for part in msg.walk():
+        if part.get_filename():
+            return part.get_filename(), part.get_payload(decode=True)
+    return None, None
+
+
+def test_retries_transient_failure_and_splits_large_attachment(smtp_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(hf, "MAX_ATTACHMENT_BYTES", 1000)
+    server = smtp_server(replies=["451 Try again later"])
+    payload = bytes(range(256)) * 10   # 2560 bytes -> 3 parts
+
+    rows = asyncio.run(_deliver(tmp_path, payload))
+
+    assert [r['status'] for r in rows] == ['sent', 'sent', 'sent']
+    assert [r['attempts'] for r in rows] == [2, 1, 1]   # 1通目は451で再試行
+    assert server.rejected == 1 and len(server.received) == 3
+
+    parts = sorted(server.received, key=lambda m: str(email.header.make_header(email.header.decode_header(m['Subject']))))
+    subjects = [str(email.header.make_header(email.header.decode_header(m['Subject']))) for m in parts]
+    assert [s[-5:] for s in subjects] == ["[1/3]", "[2/3]", "[3/3]"]
+    names, chunks = zip(*(_attachment(m) for m in parts))
+    assert names == ("テスト作品_Part1.zip.001", "テスト作品_Part1.zip.002", "テスト作品_Part1.zip.003")
+    assert b"".join(chunks) == payload
+    assert not list((tmp_path / "outbox").iterdir())   # 送信済みパートは削除
+
+
+def test_permanent_failure_is_not_retried(smtp_server, tmp_path):
+    server = smtp_server(replies=["554 Message rejected"])
+
+    rows = asyncio.run(_deliver(tmp_path, b"PK" * 100))
+
+    assert [(r['status'], r['attempts']) for r in rows] == [('failed', 1)]
+    assert server.rejected == 1 and not server.received
+
+
+def test_backoff_grows_per_attempt(monkeypatch):
+    marks = []
+
+    class Repo:
+        async def mark_outbox(self, outbox_id, status, attempts, next_attempt_at=0, error=None):
+            marks.append((status, attempts, next_attempt_at))
+
+    async def run():
+        outbox = hf.DeliveryOutbox(Repo())
+        outbox._loop = asyncio.get_running_loop()
+
+        def send(row):
+            raise hf.smtplib.SMTPServerDisconnected("connection dropped")
+        outbox._send = send
+        for attempts in range(hf.OUTBOX_MAX_ATTEMPTS):
+            row = {'id': 1, 'book_id': 1, 'attempts': attempts, 'subject': 's', 'attachment_path': 'x'}
+            started = time.time()
+            await asyncio.to_thread(outbox._deliver, row)
+            status, n, due = marks[-1]
+            if status == 'pending':
+                expected = min(hf.OUTBOX_BACKOFF_CAP, hf.OUTBOX_BACKOFF_BASE * 2 ** attempts)
+                assert expected * 0.5 <= due - started <= expected + 1
+
+    monkeypatch.setattr(hf.random, "uniform", lambda a, b: b)
+    asyncio.run(run())
+    assert [m[0] for m in marks] == ['pending'] * (hf.OUTBOX_MAX_ATTEMPTS - 1) + ['failed']
+    assert [m[1] for m in marks] == list(range(1, hf.OUTBOX_MAX_ATTEMPTS + 1))